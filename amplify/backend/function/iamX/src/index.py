@@ -26,7 +26,7 @@ from datetime import datetime, timezone
 from enum import Enum
 from iam_x import IamX
 from pydantic import ValidationError
-from typing import Optional, Union
+from typing import Iterator, Optional, Union
 
 logger = logging.getLogger('IAM-X')
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO'),'INFO'))
@@ -35,6 +35,14 @@ ENV = os.getenv('ENV')
 TABLE_NAME = 's3policy'
 POLICY_NAME_REGEX = r"^([a-zA-Z0-9_-]+)$"
 POLICY_NAME_MAX_SIZE = 256
+# Counter item read by the S3 Object Lambda authorizer to invalidate its policy cache
+# (same key as POLICY_GENERATION_KEY in ol_authorizer.py)
+POLICY_GENERATION_KEY = {'id': '__policy_generation__', 'policy_name': '__policy_generation__'}
+# Attachment items copy the policy document once per access point referenced by its statements.
+# They are indexed by the access_point_arn-index GSI, so the authorizer can Query the policies of an access point.
+# Resources that don't name a single access point are attached to WILDCARD_ATTACHMENT.
+ATTACHMENT_SEPARATOR = '#attachment#'
+WILDCARD_ATTACHMENT = '*'
 
 
 class ApiActions(Enum):
@@ -126,6 +134,61 @@ def validate_policy(document, context) -> dict:
     return policy.dict(by_alias=True, exclude_none=True)
 
 
+def bump_policy_generation():
+    # The policy change is already stored, so a failure here only delays cache invalidation
+    # until the authorizer cache max age expires
+    try:
+        table.update_item(
+            Key=POLICY_GENERATION_KEY,
+            UpdateExpression='ADD generation :one',
+            ExpressionAttributeValues={':one': 1}
+        )
+    except ClientError as e:
+        logger.debug(f'Error in DynamoDB update_item (policy generation): {e}')
+
+
+def resource_access_point(resource: str) -> str:
+    # arn:aws:s3-object-lambda:us-east-1:111111111111:accesspoint/my-access-point/some/key -> access point ARN
+    parts = resource.split(':', 5)
+    if len(parts) < 6 or '*' in ':'.join(parts[:5]) or not parts[5].startswith('accesspoint/'):
+        return WILDCARD_ATTACHMENT
+    name = parts[5].split('/')[1]
+    if not name or '*' in name:
+        return WILDCARD_ATTACHMENT
+    return f'{":".join(parts[:5])}:accesspoint/{name}'
+
+
+def attachment_targets(policy_document: dict) -> list:
+    statements = policy_document['Statement']
+    if isinstance(statements, dict):
+        statements = [statements]
+    targets = set()
+    for statement in statements:
+        resources = statement['Resource']
+        for resource in [resources] if isinstance(resources, str) else resources:
+            targets.add(resource_access_point(resource))
+    return sorted(targets)
+
+
+def sync_attachments(policy_id: str, policy_name: str, policy_document: Optional[dict], previous: list = ()):
+    # Write one attachment item per access point and delete the attachments that are no longer referenced
+    targets = attachment_targets(policy_document) if policy_document else []
+    with table.batch_writer() as batch:
+        for access_point_arn in targets:
+            batch.put_item(Item={
+                'id': f'{policy_id}{ATTACHMENT_SEPARATOR}{access_point_arn}',
+                'policy_name': policy_name,
+                'policy_id': policy_id,
+                'access_point_arn': access_point_arn,
+                'policy_document': policy_document
+            })
+        for access_point_arn in set(previous) - set(targets):
+            batch.delete_item(Key={
+                'id': f'{policy_id}{ATTACHMENT_SEPARATOR}{access_point_arn}',
+                'policy_name': policy_name
+            })
+
+
 def get_policy_params(payload, context):
     try:
         if isinstance(payload, dict):
@@ -157,11 +220,13 @@ def create_policy(payload: str, context: object) -> dict:
             'policy_description': policy_description,
             'policy_document': policy_document,
             'creation_date': creation_date,
-            'last_modified': creation_date
-
+            'last_modified': creation_date,
+            'attachments': attachment_targets(policy_document)
         }
         response = table.put_item(Item=new_policy)
         logger.debug(f'DynamoDB response {response}')
+        sync_attachments(new_policy['id'], policy_name, policy_document)
+        bump_policy_generation()
     except ClientError as e:
         logger.debug(f'Error in DynamoDB put_item: {e}')
         return api_response('Internal error', 400, context)
@@ -188,18 +253,22 @@ def update_policy(payload: str, context: object) -> dict:
         document = json.loads(payload)
         policy_document = validate_policy(document, context)
         policy_description = document.get('policy_description')
-        table.update_item(
+        response = table.update_item(
             Key={
                 'id': policy_id,
                 'policy_name': policy_name
             },
-            UpdateExpression="set policy_description=:e, policy_document=:d",
+            UpdateExpression="set policy_description=:e, policy_document=:d, attachments=:a",
             ExpressionAttributeValues={
                 ':e': policy_description,
-                ':d': policy_document
+                ':d': policy_document,
+                ':a': attachment_targets(policy_document)
             },
-            ReturnValues="UPDATED_NEW"
+            ReturnValues="UPDATED_OLD"
         )
+        previous = response.get('Attributes', {}).get('attachments', [])
+        sync_attachments(policy_id, policy_name, policy_document, previous)
+        bump_policy_generation()
         return api_response(payload, 200, context)
     except ClientError as e:
         logger.debug(f'Error in DynamoDB update_item: {e}')
@@ -225,14 +294,26 @@ def delete_policy(payload: dict, context: object) -> dict:
     if not policy_id or not policy_name:
         return api_response('Missing policy Id and/or policy_name', 400, context)
     try:
-        table.delete_item(Key={'id': policy_id, 'policy_name': policy_name})
+        response = table.delete_item(Key={'id': policy_id, 'policy_name': policy_name}, ReturnValues='ALL_OLD')
+        sync_attachments(policy_id, policy_name, None, response.get('Attributes', {}).get('attachments', []))
     except ClientError as e:
         logger.debug(f'ClientError: {e.response["Error"]["Message"]}')
         return api_response(f'Unable to delete Policy ID: {policy_id}', 400, context)
+    bump_policy_generation()
 
     return api_response(payload, 200, context)
 
 
+def scan_table(**kwargs) -> Iterator[dict]:
+    # Scan returns up to 1MB per call: follow LastEvaluatedKey to return every item
+    while True:
+        response = table.scan(**kwargs)
+        yield from response['Items']
+        if 'LastEvaluatedKey' not in response:
+            return
+        kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+
 def list_policies(payload: str, context: object) -> dict:
 
     logger.debug(payload)
@@ -251,8 +332,33 @@ def list_policies(payload: str, context: object) -> dict:
         response = table.get_item(Key={'id': policy_id, 'policy_name': policy_name})
         return api_response(response['Item'], 200, context)
     else:
-        response = table.scan(ProjectionExpression='id, policy_name, policy_description, creation_date, last_modified')
-        return api_response(response['Items'], 200, context)
+        policies = [
+            item for item in scan_table(
+                ProjectionExpression='id, policy_name, policy_description, creation_date, last_modified'
+            )
+            if item['id'] != POLICY_GENERATION_KEY['id'] and ATTACHMENT_SEPARATOR not in item['id']
+        ]
+        return api_response(policies, 200, context)
+
+
+def attach_all_policies() -> int:
+    # Backfill the attachment items of the policies created before the attachment index existed.
+    # Run once before setting POLICY_LOOKUP=attachment on the authorizer: {"action": "attach_all_policies"}
+    policies = 0
+    for item in scan_table(ProjectionExpression='id, policy_name, policy_document, attachments'):
+        if item['id'] == POLICY_GENERATION_KEY['id'] or ATTACHMENT_SEPARATOR in item['id']:
+            continue
+        targets = attachment_targets(item['policy_document'])
+        table.update_item(
+            Key={'id': item['id'], 'policy_name': item['policy_name']},
+            UpdateExpression="set attachments=:a",
+            ExpressionAttributeValues={':a': targets}
+        )
+        sync_attachments(item['id'], item['policy_name'], item['policy_document'], item.get('attachments', []))
+        policies += 1
+    bump_policy_generation()
+    logger.info(f'Attachments written for {policies} policies')
+    return policies
 
 
 def not_implemented(context) -> dict:
@@ -261,6 +367,9 @@ def not_implemented(context) -> dict:
 
 def handler(event: dict, context: object) -> dict:
     logger.debug(f'received event: {event}')
+    if event.get('action') == 'attach_all_policies':
+        # One-off direct invocation (not routed by API Gateway), see attach_all_policies
+        return {'policies': attach_all_policies()}
     http_method = event.get('httpMethod')
     api_action = None
     for v, s in API_ACTIONS:
@@ -29,9 +29,39 @@ VALID_PRINCIPAL = r"^([*]|" \
                   r"arn:aws:iam::[0-9]{12}:root|" \
                   r"arn:aws:iam::[0-9]{12}:user\/[a-zA-Z0-9-_]+|" \
                   r"arn:aws:iam::[0-9]{12}:role\/[a-zA-Z0-9-+\/]+)"
-EXCLUSIVE_CONDITION_KEYS = ['RemoveData', 'RemoveColumn', 'AnonymizeData']
+# Condition keys compiled into the transform plan of a statement. Several of them can be combined, in one
+# condition or in a list of conditions, and are applied to every column in a fixed order
+TRANSFORM_CONDITION_KEYS = ['RemoveData', 'RemoveColumn', 'AnonymizeData', 'HashData', 'TruncateData']
+# Transform rule: "column_name=col1,col2" followed by optional ";key=value" parameters
+VALID_TRANSFORM_RULE = r"^column_name=[^;=,]+(,[^;=,]+)*(;[a-z_]+=[^;]+)*$"
 resource_pattern = re.compile(VALID_RESOURCE)
 principal_pattern = re.compile(VALID_PRINCIPAL)
+transform_rule_pattern = re.compile(VALID_TRANSFORM_RULE)
+# Parameters accepted by each transform condition key besides column_name. Must be the same as the
+# OPERATION_PARAMETERS of the s3olProcessor transform plan, which rejects the statement of every request otherwise
+TRANSFORM_PARAMETERS = {
+    'RemoveData': [],
+    'RemoveColumn': [],
+    'AnonymizeData': ['value', 'method', 'keep_last', 'buckets', 'granularity', 'format'],
+    'HashData': [],
+    'TruncateData': ['length'],
+}
+# AnonymizeData methods and the parameter each of them requires
+ANONYMIZE_METHODS = {
+    'mask': None,
+    'hmac': None,
+    'bucket': r';buckets=[1-9]\d*(;|$)',
+    'partial': r';keep_last=\d+(;|$)',
+    'date': None,
+}
+DATE_GRANULARITIES = ['year', 'quarter', 'month', 'week', 'day']
+# Row filter: "column_name=region;operator=eq;value=eu". The value can use requester variables
+VALID_FILTER_OPERATORS = ['eq', 'ne', 'gt', 'ge', 'lt', 'le', 'in', 'not_in']
+VALID_FILTER_RULE = r"^column_name=[^;=,]+(;operator=[a-z_]+)?;value=[^;]+$"
+VALID_FILTER_VARIABLES = r"\$\{(aws:userid|aws:username|aws:PrincipalArn|aws:PrincipalAccount|aws:PrincipalType|" \
+                         r"aws:PrincipalTag/[a-zA-Z0-9_.:/=+\-@]+)\}"
+filter_rule_pattern = re.compile(VALID_FILTER_RULE)
+filter_variable_pattern = re.compile(VALID_FILTER_VARIABLES)
 
 
 class IamConditionModel(BaseModel):
@@ -44,10 +74,53 @@ class IamConditionModel(BaseModel):
     remove_data: Optional[StrictStr] = Field(alias='RemoveData')
     remove_column: Optional[StrictStr] = Field(alias='RemoveColumn')
     anonymize_data: Optional[StrictStr] = Field(alias='AnonymizeData')
+    hash_data: Optional[StrictStr] = Field(alias='HashData')
+    truncate_data: Optional[StrictStr] = Field(alias='TruncateData')
+    filter_rows: Optional[StrictStr] = Field(alias='FilterRows')
     audit_request: Optional[StrictStr] = Field(alias='AuditRequest')
 
     @validator('*', pre=False)
-    def condition_key_validator(cls, value):
+    def condition_key_validator(cls, value, field):
+        if field.alias in TRANSFORM_CONDITION_KEYS:
+            if not transform_rule_pattern.match(value):
+                raise ValueError(f'Invalid {field.alias} rule. Must match {VALID_TRANSFORM_RULE}')
+            parameters = TRANSFORM_PARAMETERS[field.alias]
+            unknown = sorted({item.split('=', 1)[0] for item in value.split(';')[1:]} - set(parameters))
+            if unknown:
+                raise ValueError(f'Invalid {field.alias} rule. Unknown parameters {unknown}. '
+                                 f'Must be one of {parameters}')
+        return value
+
+    @validator('truncate_data')
+    def validate_truncate_data(cls, value):
+        if not re.search(r';length=\d+(;|$)', value):
+            raise ValueError('Invalid TruncateData rule. Must contain ;length=<number>')
+        return value
+
+    @validator('filter_rows')
+    def validate_filter_rows(cls, value):
+        if not filter_rule_pattern.match(value):
+            raise ValueError(f'Invalid FilterRows rule. Must match {VALID_FILTER_RULE}')
+        operator = re.search(r';operator=([^;]+)', value)
+        if operator and operator.group(1) not in VALID_FILTER_OPERATORS:
+            raise ValueError(f'Invalid FilterRows operator. Must be one of {VALID_FILTER_OPERATORS}')
+        filter_value = value.split(';value=', 1)[1]
+        if '${' in filter_variable_pattern.sub('', filter_value):
+            raise ValueError(f'Invalid FilterRows variable. Must match {VALID_FILTER_VARIABLES}')
+        return value
+
+    @validator('anonymize_data')
+    def validate_anonymize_data(cls, value):
+        method = re.search(r';method=([^;]+)', value)
+        method = method.group(1) if method else 'mask'
+        if method not in ANONYMIZE_METHODS:
+            raise ValueError(f'Invalid AnonymizeData method {method}. Must be one of {list(ANONYMIZE_METHODS)}')
+        required = ANONYMIZE_METHODS[method]
+        if required and not re.search(required, value):
+            raise ValueError(f'Invalid AnonymizeData rule. Method {method} must match {required}')
+        granularity = re.search(r';granularity=([^;]+)', value)
+        if method == 'date' and granularity and granularity.group(1) not in DATE_GRANULARITIES:
+            raise ValueError(f'Invalid AnonymizeData granularity. Must be one of {DATE_GRANULARITIES}')
         return value
 
 
@@ -94,15 +167,10 @@ class StatementModel(BaseModel):
     @validator('condition')
     def condition_key_validator(cls, value):
         if isinstance(value, List):
-            count = 0
+            keys = set()
             for item in value:
-                condition_statement = item.dict(by_alias=True, exclude_none=True)
-                for k, v in condition_statement.items():
-                    if k in EXCLUSIVE_CONDITION_KEYS:
-                        count += 1
-            if count > 1:
-                raise ValueError(f'Invalid condition statement. Must be one of {EXCLUSIVE_CONDITION_KEYS}')
-            if count < 1:
+                keys.update(item.dict(by_alias=True, exclude_none=True))
+            if not keys.intersection(TRANSFORM_CONDITION_KEYS + ['FilterRows']):
                 raise ValueError('Must contain at least one condition match')
         return value
 
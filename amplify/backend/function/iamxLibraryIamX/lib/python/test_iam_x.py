@@ -0,0 +1,34 @@
+import pytest
+
+pytest.importorskip('pydantic')
+from iam_x import IamConditionModel  # noqa: E402
+from pydantic import ValidationError  # noqa: E402
+
+
+@pytest.mark.parametrize('condition', [
+    {'RemoveColumn': 'column_name=a'},
+    {'RemoveData': 'column_name=a,b'},
+    {'TruncateData': 'column_name=a;length=4'},
+    {'AnonymizeData': 'column_name=a;method=partial;keep_last=4'},
+    {'AnonymizeData': 'column_name=a;method=date;granularity=year;format=%Y%m%d'},
+    {'AnonymizeData': 'column_name=a;value=x'},
+    {'FilterRows': 'column_name=region;operator=in;value=eu,us', 'HashData': 'column_name=a'},
+])
+def test_valid_conditions(condition):
+    IamConditionModel(**condition)
+
+
+@pytest.mark.parametrize('condition, error', [
+    # Rejected by the transform plan of every request (s3olProcessor plan.OPERATION_PARAMETERS)
+    ({'RemoveColumn': 'column_name=a;length=4'}, 'Unknown parameters'),
+    ({'RemoveData': 'column_name=a;value=x'}, 'Unknown parameters'),
+    ({'HashData': 'column_name=a;method=hmac'}, 'Unknown parameters'),
+    ({'TruncateData': 'column_name=a;length=4;keep_last=2'}, 'Unknown parameters'),
+    ({'AnonymizeData': 'column_name=a;method=bucket;buckets=4;salt=x'}, 'Unknown parameters'),
+    ({'TruncateData': 'column_name=a'}, 'Must contain ;length=<number>'),
+    ({'AnonymizeData': 'column_name=a;method=partial'}, 'Method partial must match'),
+    ({'FilterRows': 'column_name=a;operator=like;value=x'}, 'Invalid FilterRows operator'),
+])
+def test_invalid_conditions(condition, error):
+    with pytest.raises(ValidationError, match=error):
+        IamConditionModel(**condition)
@@ -0,0 +1,4 @@
+import os
+
+os.environ.setdefault('ENV', 'test')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
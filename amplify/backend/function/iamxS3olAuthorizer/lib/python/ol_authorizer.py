@@ -18,9 +18,14 @@ import boto3
 import json
 import os
 import logging
+import queue
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from boto3.dynamodb.conditions import Key
 from botocore.exceptions import ClientError
-from typing import Union
+from typing import Iterable, Iterator, Union
+from ol_metrics import current as current_metrics
 
 logger = logging.getLogger('IAM-X_Authorizer')
 logger.addHandler(logging.StreamHandler())
@@ -28,6 +33,24 @@ logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO'),'INFO'))
 dynamodb = boto3.resource('dynamodb')
 ENV = os.getenv('ENV')
 TABLE_NAME = 's3policy'
+# Item bumped by iamX on every policy create/update/delete (same key as in iamX/src/index.py)
+POLICY_GENERATION_KEY = {'id': '__policy_generation__', 'policy_name': '__policy_generation__'}
+# Seconds a cached policy snapshot is used without checking DynamoDB at all
+POLICY_CACHE_TTL = float(os.getenv('POLICY_CACHE_TTL', '30'))
+# Seconds after which the policies are scanned again even if the generation did not change
+POLICY_CACHE_MAX_AGE = float(os.getenv('POLICY_CACHE_MAX_AGE', '300'))
+# Number of DynamoDB parallel scan segments used to load the policies (1 = sequential scan)
+POLICY_SCAN_SEGMENTS = int(os.getenv('POLICY_SCAN_SEGMENTS', '1'))
+# How the policies of a request are loaded:
+#   scan: read the whole policy table
+#   attachment: Query the attachment items of the requested access point (maintained by iamX)
+POLICY_LOOKUP = os.getenv('POLICY_LOOKUP', 'scan')
+POLICY_ATTACHMENT_INDEX = os.getenv('POLICY_ATTACHMENT_INDEX', 'access_point_arn-index')
+# Attachment of the policies with resources that don't name a single access point (same as in iamX/src/index.py)
+WILDCARD_ATTACHMENT = '*'
+# Attributes of the policy items read by the scan lookup (access_point_arn tells the attachment copies apart)
+POLICY_ATTRIBUTES = ['id', 'policy_name', 'policy_document', 'access_point_arn']
+# Resource without a key: the requested resources are objects (access point ARN/key)
 OBJECT_PATTERN = re.compile(r'(https://[a-zA-Z0-9-].+\.s3-object-lambda\.[a-zA-Z0-9-].+-\d\.amazonaws\.com\/)(.+)')
 
 if not ENV:
@@ -35,20 +58,280 @@ if not ENV:
     exit(os.EX_DATAERR)
 
 table = dynamodb.Table(f'{TABLE_NAME}-{ENV}')
+# Module level cache: survives across warm invocations of the same Lambda container
+# Key is the access point ARN for attachment lookups or None for the whole table
+_policy_cache = {}
+
+
+def scan_pages(scan_table, **kwargs) -> Iterator[list]:
+    return query_pages(scan_table.scan, **kwargs)
+
+
+def query_pages(operation, **kwargs) -> Iterator[list]:
+    # Follow LastEvaluatedKey until the whole table, segment or query result has been read
+    while True:
+        resp = operation(**kwargs)
+        yield resp.get('Items', [])
+        if 'LastEvaluatedKey' not in resp:
+            return
+        kwargs['ExclusiveStartKey'] = resp['LastEvaluatedKey']
+
+
+def _scan_parallel(total_segments: int, **kwargs) -> Iterator[list]:
+    # Each segment is scanned by its own thread. The pages are yielded as soon as any segment returns them.
+    pages = queue.Queue()
+    done = object()
+
+    def scan_segment(segment: int):
+        try:
+            # boto3 resources are not thread safe: every thread uses its own session
+            segment_table = boto3.session.Session().resource('dynamodb').Table(table.name)
+            for page in scan_pages(segment_table, Segment=segment, TotalSegments=total_segments, **kwargs):
+                pages.put(page)
+        except Exception as e:
+            pages.put(e)
+        finally:
+            pages.put(done)
+
+    with ThreadPoolExecutor(max_workers=total_segments) as executor:
+        for segment in range(total_segments):
+            executor.submit(scan_segment, segment)
+        pending = total_segments
+        while pending:
+            page = pages.get()
+            if page is done:
+                pending -= 1
+            elif isinstance(page, Exception):
+                raise page
+            else:
+                yield page
+
+
+def iter_policies(segments: int = POLICY_SCAN_SEGMENTS) -> Iterator[dict]:
+    # This function scan the DynamoDB table as an example. Use get_cached_policies to reuse the result across requests
+    # Optimized functions will query only the policies related to the service and resource
+    # To reduce resource consumption we retrieve only the policy document and its id and name (audit records)
+    if segments > 1:
+        pages = _scan_parallel(segments, AttributesToGet=POLICY_ATTRIBUTES)
+    else:
+        pages = scan_pages(table, AttributesToGet=POLICY_ATTRIBUTES)
+    for page in pages:
+        for item in page:
+            # Skip the generation counter and the attachment copies of the policies
+            if 'policy_document' in item and 'access_point_arn' not in item:
+                yield item
+
+
+def iter_attached_policies(access_point_arn: str) -> Iterator[dict]:
+    # Policies attached to the access point plus the ones with wildcard resources
+    for target in (access_point_arn, WILDCARD_ATTACHMENT):
+        pages = query_pages(
+            table.query,
+            IndexName=POLICY_ATTACHMENT_INDEX,
+            KeyConditionExpression=Key('access_point_arn').eq(target),
+            ProjectionExpression='policy_document, policy_id, policy_name'
+        )
+        for page in pages:
+            yield from page
 
 
 def get_policies() -> list:
-    # This function scan the DynamoDB table as an example.
-    # Optimized functions will use caching and query only the policies related to the service and resource
-    # To reduce resource consumption we retrieve only the policy document
-    # TODO: Implement pagination as now we return up to 1MB of policies per request
     try:
-        resp = table.scan(AttributesToGet=['policy_document'])
+        return list(iter_policies())
     except ClientError as e:
         logger.debug('Unable to retrieve DynamoDB items')
         logger.exception(e)
-        resp = {'Items': []}
-    return resp.get('Items', [])
+        return []
+
+
+def load_policies(access_point_arn: Union[str, None] = None) -> (Union[list, None], Union['PolicyIndex', None]):
+    # Build the policy index while the pages are being received.
+    # A partial policy set could miss an explicit Deny, so any error discards everything that was loaded: (None, None)
+    policies = []
+    index = PolicyIndex()
+    metrics = current_metrics()
+    try:
+        with metrics.stage('PolicyLoad'):
+            for policy in iter_attached_policies(access_point_arn) if access_point_arn else iter_policies():
+                policies.append(policy)
+                index.add_policy(policy)
+    except ClientError as e:
+        logger.debug('Unable to retrieve DynamoDB items')
+        logger.exception(e)
+        metrics.add('PolicyLoadErrors', 1)
+        return None, None
+    metrics.add('PoliciesLoaded', len(policies))
+    return policies, index
+
+
+def get_policy_generation() -> Union[int, None]:
+    try:
+        with current_metrics().stage('PolicyGeneration'):
+            resp = table.get_item(Key=POLICY_GENERATION_KEY, ProjectionExpression='generation')
+    except ClientError as e:
+        logger.debug('Unable to retrieve the policy generation')
+        logger.exception(e)
+        return None
+    return resp.get('Item', {}).get('generation')
+
+
+def get_cached_policies(access_point_arn: Union[str, None] = None) -> Union[list, None]:
+    # Serve the policies from the module cache while it is fresh:
+    # - within POLICY_CACHE_TTL the cache is used without any DynamoDB call
+    # - after that, a single GetItem on the generation counter decides if a new scan is needed
+    # - after POLICY_CACHE_MAX_AGE the table is scanned again (protects against a missed generation bump)
+    # A failed load is never cached: the previous snapshot is kept and the load is retried after POLICY_CACHE_TTL.
+    # None when the policies have never been loaded (the next request retries).
+    now = time.monotonic()
+    cache = _policy_cache.get(access_point_arn)
+    if cache is None:
+        cache = _policy_cache[access_point_arn] = {
+            'policies': None, 'index': None, 'generation': None, 'loaded': 0.0, 'checked': 0.0
+        }
+    if cache['policies'] is not None:
+        if now - cache['checked'] < POLICY_CACHE_TTL:
+            return cache['policies']
+        generation = get_policy_generation()
+        if (generation is not None
+                and generation == cache['generation']
+                and now - cache['loaded'] < POLICY_CACHE_MAX_AGE):
+            logger.debug(f'Policy generation {generation} unchanged. Using cached policies')
+            cache['checked'] = now
+            return cache['policies']
+    else:
+        generation = get_policy_generation()
+    logger.debug(f'Loading policies for generation {generation}; access point: {access_point_arn}')
+    policies, index = load_policies(access_point_arn)
+    if policies is None:
+        if cache['policies'] is not None:
+            logger.warning(f'Using the policies loaded {now - cache["loaded"]:.0f}s ago')
+            cache['checked'] = now
+        return cache['policies']
+    cache['policies'], cache['index'] = policies, index
+    cache['generation'] = generation
+    cache['loaded'] = cache['checked'] = now
+    return cache['policies']
+
+
+class _ResourceNode:
+    __slots__ = ('children', 'exact', 'wildcard')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = {}  # principal -> [(order, effect, attrs, source)] for resources ending at this node
+        # principal -> [(order, effect, attrs, source)] for resources ending with * or without * at this node
+        self.wildcard = {}
+
+
+class PolicyIndex:
+    # Decision structure built once per policy snapshot.
+    # Resources are stored in a character trie: a request walks the trie along the requested ARN, collecting the
+    # statements of every wildcard prefix on the way and the exact statements at the end. Each node maps the
+    # statement principals to the statements, so the cost of a lookup depends on the ARN length and the number of
+    # matching statements, not on the number of policies.
+    def __init__(self, policies: Iterable = ()):
+        self.root = _ResourceNode()
+        self._order = 0
+        for policy in policies:
+            self.add_policy(policy)
+
+    def add_policy(self, policy: dict):
+        statements = policy['policy_document']['Statement']
+        if isinstance(statements, dict):
+            statements = [statements]
+        for statement in statements:
+            # Policy and statement that produced a decision (reported by the audit records)
+            # (the attachment copies have their own id, the id of the policy is in policy_id)
+            source = {
+                'PolicyId': policy.get('policy_id', policy.get('id')),
+                'PolicyName': policy.get('policy_name'),
+                'Sid': statement.get('Sid')
+            }
+            entry = (self._order, statement['Effect'], statement.get('Condition', {}), source)
+            self._order += 1
+            resources = statement['Resource']
+            principals = statement['Principal']
+            for resource in [resources] if isinstance(resources, str) else resources:
+                self._add(resource, [principals] if isinstance(principals, str) else principals, entry)
+
+    def _add(self, resource: str, principals: list, entry: tuple):
+        # Same semantics as the regex matching of the statements: a resource ending with * matches its prefix
+        # followed by at least one character, a resource without * matches itself and every resource it prefixes
+        # (eg: an access point ARN matches all its objects)
+        wildcard = resource.endswith('*')
+        if wildcard:
+            resource = resource[:-1]
+            if '*' in resource:
+                logger.debug('Unexpected wildcard in the resource name')
+        node = self.root
+        for char in resource:
+            node = node.children.setdefault(char, _ResourceNode())
+        for principal in principals:
+            node.wildcard.setdefault(principal, []).append(entry)
+            if not wildcard:
+                node.exact.setdefault(principal, []).append(entry)
+
+    def lookup(self, requested_resource: str, principals: tuple) -> list:
+        matches = []
+        node = self.root
+        for char in requested_resource:
+            # A wildcard resource must match at least one character after its prefix
+            for principal in principals:
+                matches.extend(node.wildcard.get(principal, ()))
+            node = node.children.get(char)
+            if node is None:
+                return matches
+        for principal in principals:
+            matches.extend(node.exact.get(principal, ()))
+        return matches
+
+    def lookup_all(self, requested_resource: str) -> list:
+        # Statements matching the resource for any principal (eg: the transforms to precompute for an object),
+        # once each and in policy order
+        matches = {}
+        node = self.root
+        for char in requested_resource:
+            for entries in node.wildcard.values():
+                matches.update((entry[0], entry) for entry in entries)
+            node = node.children.get(char)
+            if node is None:
+                break
+        else:
+            for entries in node.exact.values():
+                matches.update((entry[0], entry) for entry in entries)
+        return [matches[order] for order in sorted(matches)]
+
+    def decide(self, requested_resource: str, identity, account_id: str) -> (str, dict, list):
+        # Returns the effect, the condition attributes and the sources of the statements that decided it
+        principals = ('*', account_id, f'arn:aws:iam::{account_id}:root')
+        if isinstance(identity, str):
+            principals += (identity,)
+        matches = self.lookup(requested_resource, tuple(set(principals)))
+        if not matches:
+            return 'Deny', {'Evaluation': 'Implicit'}, []
+        denies = [source for _, effect, _, source in matches if effect == 'Deny']
+        if denies:
+            logger.debug('Found a match. Effect is: Deny')
+            return 'Deny', {'Evaluation': 'Explicit'}, denies
+        # Same precedence as evaluating the policies in order: the last matching statement wins
+        _, effect, attrs, source = max(matches, key=lambda match: match[0])
+        logger.debug(f'Found a match. Effect is: {effect}')
+        return effect, attrs, [source]
+
+    def evaluate(self, requested_resource: str, identity, account_id: str) -> (str, dict):
+        effect, attrs, _ = self.decide(requested_resource, identity, account_id)
+        return effect, attrs
+
+
+def get_policy_index(access_point_arn: Union[str, None] = None) -> Union[PolicyIndex, None]:
+    # None when the policies could not be loaded
+    policies = get_cached_policies(access_point_arn)
+    if policies is None:
+        return None
+    cache = _policy_cache[access_point_arn]
+    if cache['index'] is None:
+        cache['index'] = PolicyIndex(policies)
+    return cache['index']
 
 
 def get_identity(user_identity: dict) -> (str, Union[str, None]):
@@ -62,36 +345,13 @@ def get_identity(user_identity: dict) -> (str, Union[str, None]):
     return identity, account_id
 
 
-def match_resource(requested_resource: str, resource: Union[str, list]) -> bool:
-    resources = resource
-    if isinstance(resource, str):
-        resources = [resource]
-    for item in resources:
-        if item[-1] == '*':
-            # Replace wildcard with regex expression .+
-            resource_pattern = f'({item[:-1]}.+)'
-            if '*' in resource_pattern:
-                logger.debug('Unexpected wildcard in the resource name')
-        else:
-            resource_pattern = f'({item})'
-        search_resource = re.compile(resource_pattern)
-        if search_resource.match(requested_resource):
-            return True
-    return False
-
-
-def match_principal(identity: str, account_id: str, principal: Union[str, list]) -> bool:
-    root = f'arn:aws:iam::{account_id}:root'
-    if isinstance(principal, list):
-        for item in principal:
-            if item == '*' or identity == item or account_id == item or root == item:
-                return True  # TODO: Optimize to find * early and return instead of iterating over all items
-    elif principal == '*' or identity == principal or account_id == principal or root == principal:
-        return True
-    return False
+def validate_request(request: dict) -> (str, dict):
+    effect, attrs, _ = authorize_request(request)
+    return effect, attrs
 
 
-def validate_request(request: dict) -> (str, dict):
+def authorize_request(request: dict) -> (str, dict, list):
+    # Same as validate_request, also returns the sources (PolicyId, PolicyName, Sid) of the decision
     effect = 'Deny'  # implicit Deny
     attrs = {'Evaluation': 'Implicit'}
     logger.debug(f'Request: {request}')
@@ -103,29 +363,21 @@ def validate_request(request: dict) -> (str, dict):
         logger.debug('Unable to process. Missing required request parameters')
         logger.debug(f'Requested resource: {requested_resource}')
         logger.debug(f'Requester: {identity}')
-        return effect, attrs
+        return effect, attrs, []
     ap_arn = request.get('configuration', {}).get('accessPointArn')
     object_key = OBJECT_PATTERN.match(requested_resource)[2]
     requested_resource = f'{ap_arn}/{object_key}'
     requested_action = 's3lambda:GetObject'  # TODO: Implement logic to receive action from the request.
-    policies = get_policies()
-    # TODO: Instead of looping through all policies, we should just get the policy attached to resource
-    # Implementing a policy attachment to S3 Object Lambda Access points will be much faster than getting all items
-    # The current implementation could match multiple policies with Allow, just the first will be used.
-    for policy in policies:
-        statements = policy['policy_document']['Statement']
-        if isinstance(statements, dict):
-            statements = [statements]
-        for statement in statements:
-            if (match_resource(requested_resource, statement['Resource']) and
-                    match_principal(identity, account_id, statement['Principal'])):
-                effect = statement['Effect']
-                attrs = statement.get('Condition', {})
-                logger.debug(f'Found a match. Effect is: {effect}')
-                if effect == 'Deny':
-                    attrs = {'Evaluation': 'Explicit'}
-                    return effect, attrs
-    return effect, attrs
+    # With POLICY_LOOKUP=attachment only the policies attached to the access point are loaded
+    # The current implementation could match multiple policies with Allow, just the last one will be used.
+    metrics = current_metrics()
+    # PolicyLookup is the policy cache itself, its DynamoDB reads are reported as PolicyGeneration and PolicyLoad
+    with metrics.stage('PolicyLookup'):
+        index = get_policy_index(ap_arn if POLICY_LOOKUP == 'attachment' else None)
+    if index is None:
+        return effect, attrs, []
+    with metrics.stage('PolicyEvaluate'):
+        return index.decide(requested_resource, identity, account_id)
 
 
 # Local testing
@@ -0,0 +1,171 @@
+import contextvars
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Iterator
+
+METRICS_NAMESPACE = os.getenv('METRICS_NAMESPACE', 'IAM-X/ObjectLambda')
+# Fraction of the requests that record and emit metrics (0 disables the instrumentation)
+METRICS_SAMPLE_RATE = float(os.getenv('METRICS_SAMPLE_RATE', '1'))
+
+
+class StdoutSink:
+    # Lambda sends stdout to CloudWatch Logs, which extracts the metrics of the EMF documents
+    def write(self, document: dict):
+        sys.stdout.write(json.dumps(document, default=str) + '\n')
+
+
+class MemorySink:
+    # Keeps the documents in memory, for tests and benchmarks
+    def __init__(self):
+        self.documents = []
+
+    def write(self, document: dict):
+        self.documents.append(document)
+
+
+_sink = StdoutSink()
+
+
+def set_sink(sink) -> object:
+    # Returns the previous sink
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+class RequestMetrics:
+    # Stage timings, counters and properties of one request.
+    # Stage timings are exclusive: a stage entered while another one is running (eg: the CSV parser pulling chunks
+    # from the network stage) pauses the outer stage, so the stages of a streaming pipeline add up to the total.
+    # Each thread of the request has its own stage stack: with concurrent threads the timings are the time spent
+    # by all of them in each stage and may add up to more than the total.
+    def __init__(self, properties: dict):
+        self.started = time.perf_counter()
+        self.properties = dict(properties)
+        self.timings = {}
+        self.counters = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    @property
+    def _stack(self) -> list:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def _add_time(self, name: str, seconds: float):
+        with self._lock:
+            self.timings[name] = self.timings.get(name, 0.0) + seconds
+
+    def _enter(self, name: str):
+        now = time.perf_counter()
+        stack = self._stack
+        if stack:
+            outer, since = stack[-1]
+            self._add_time(outer, now - since)
+        stack.append([name, now])
+
+    def _exit(self):
+        now = time.perf_counter()
+        stack = self._stack
+        name, since = stack.pop()
+        self._add_time(name, now - since)
+        if stack:
+            stack[-1][1] = now
+
+    @contextmanager
+    def stage(self, name: str):
+        self._enter(name)
+        try:
+            yield
+        finally:
+            self._exit()
+
+    def timed(self, iterable: Iterable, name: str) -> Iterator:
+        # Time spent producing each item of an iterator (eg: a generator stage of the streaming pipeline)
+        iterator = iter(iterable)
+        while True:
+            self._enter(name)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self._exit()
+            yield item
+
+    def add(self, name: str, value: float, unit: str = 'Count'):
+        with self._lock:
+            total, _ = self.counters.get(name, (0, unit))
+            self.counters[name] = (total + value, unit)
+
+    def set_property(self, name: str, value):
+        self.properties[name] = value
+
+    def document(self) -> dict:
+        metrics = {f'{name}Time': round(seconds * 1000, 3) for name, seconds in self.timings.items()}
+        metrics['TotalTime'] = round((time.perf_counter() - self.started) * 1000, 3)
+        definitions = [{'Name': name, 'Unit': 'Milliseconds'} for name in metrics]
+        for name, (value, unit) in self.counters.items():
+            metrics[name] = value
+            definitions.append({'Name': name, 'Unit': unit})
+        document = dict(self.properties, **metrics)
+        document.setdefault('Effect', 'None')
+        document['_aws'] = {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{'Namespace': METRICS_NAMESPACE, 'Dimensions': [['Effect']], 'Metrics': definitions}]
+        }
+        return document
+
+    def emit(self):
+        _sink.write(self.document())
+
+
+class NullMetrics(RequestMetrics):
+    # Requests that are not sampled: every call is a no-op and iterators are returned as is
+    def __init__(self):
+        super().__init__({})
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def timed(self, iterable: Iterable, name: str) -> Iterator:
+        return iterable
+
+    def add(self, name: str, value: float, unit: str = 'Count'):
+        pass
+
+    def set_property(self, name: str, value):
+        pass
+
+    def emit(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+_current = contextvars.ContextVar('ol_metrics', default=NULL_METRICS)
+
+
+def start_request(sample_rate: float = None, **properties) -> RequestMetrics:
+    rate = METRICS_SAMPLE_RATE if sample_rate is None else sample_rate
+    metrics = RequestMetrics(properties) if rate > 0 and random.random() < rate else NULL_METRICS
+    _current.set(metrics)
+    return metrics
+
+
+def current() -> RequestMetrics:
+    # Metrics of the request being processed (NULL_METRICS outside of a request)
+    return _current.get()
+
+
+def end_request():
+    metrics = _current.get()
+    _current.set(NULL_METRICS)
+    metrics.emit()
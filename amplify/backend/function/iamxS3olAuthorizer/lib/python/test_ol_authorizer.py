@@ -0,0 +1,131 @@
+import ol_authorizer
+import pytest
+from ol_authorizer import PolicyIndex
+
+ACCOUNT = '111122223333'
+ACCESS_POINT = f'arn:aws:s3-object-lambda:us-east-1:{ACCOUNT}:accesspoint/olap'
+USER = f'arn:aws:iam::{ACCOUNT}:user/alice'
+
+
+def policy(*statements, **item) -> dict:
+    return dict(item, policy_document={'Version': '2012-10-17', 'Statement': list(statements)})
+
+
+def statement(effect: str, resource, principal='*', condition=None, sid=None) -> dict:
+    result = {'Effect': effect, 'Resource': resource, 'Principal': principal, 'Sid': sid}
+    if condition is not None:
+        result['Condition'] = condition
+    return result
+
+
+def test_explicit_deny_wins():
+    index = PolicyIndex([
+        policy(statement('Allow', f'{ACCESS_POINT}/*'), id='1'),
+        policy(statement('Deny', f'{ACCESS_POINT}/private/*', sid='deny'), id='2'),
+        policy(statement('Allow', f'{ACCESS_POINT}/private/a.csv'), id='3'),
+    ])
+    effect, attrs, sources = index.decide(f'{ACCESS_POINT}/private/a.csv', USER, ACCOUNT)
+    assert (effect, attrs) == ('Deny', {'Evaluation': 'Explicit'})
+    assert sources == [{'PolicyId': '2', 'PolicyName': None, 'Sid': 'deny'}]
+    assert index.evaluate(f'{ACCESS_POINT}/public/a.csv', USER, ACCOUNT)[0] == 'Allow'
+
+
+def test_last_matching_allow_wins():
+    index = PolicyIndex([
+        policy(statement('Allow', f'{ACCESS_POINT}/data/a.csv', condition={'RemoveColumn': 'column_name=a'})),
+        policy(statement('Allow', f'{ACCESS_POINT}/*', condition={'RemoveColumn': 'column_name=b'})),
+        policy(statement('Allow', f'{ACCESS_POINT}/other/*', condition={'RemoveColumn': 'column_name=c'})),
+    ])
+    # The exact statement comes first in policy order, so the wildcard statement after it wins
+    assert index.evaluate(f'{ACCESS_POINT}/data/a.csv', USER, ACCOUNT) == ('Allow', {'RemoveColumn': 'column_name=b'})
+    assert index.evaluate(f'{ACCESS_POINT}/other/a.csv', USER, ACCOUNT) == ('Allow', {'RemoveColumn': 'column_name=c'})
+
+
+def test_wildcard_needs_a_character_after_its_prefix():
+    index = PolicyIndex([policy(statement('Allow', f'{ACCESS_POINT}/data/*'))])
+    assert index.evaluate(f'{ACCESS_POINT}/data/a.csv', USER, ACCOUNT)[0] == 'Allow'
+    assert index.evaluate(f'{ACCESS_POINT}/data/', USER, ACCOUNT) == ('Deny', {'Evaluation': 'Implicit'})
+    assert index.evaluate(f'{ACCESS_POINT}/dat', USER, ACCOUNT) == ('Deny', {'Evaluation': 'Implicit'})
+
+
+def test_resource_without_wildcard_matches_by_prefix():
+    index = PolicyIndex([policy(statement('Allow', [f'{ACCESS_POINT}/a.csv', f'{ACCESS_POINT}/data/']))])
+    assert index.evaluate(f'{ACCESS_POINT}/a.csv', USER, ACCOUNT)[0] == 'Allow'
+    assert index.evaluate(f'{ACCESS_POINT}/a.csv.bak', USER, ACCOUNT)[0] == 'Allow'
+    assert index.evaluate(f'{ACCESS_POINT}/data/', USER, ACCOUNT)[0] == 'Allow'
+    assert index.evaluate(f'{ACCESS_POINT}/data/b.csv', USER, ACCOUNT)[0] == 'Allow'
+    assert index.evaluate(f'{ACCESS_POINT}/a.cs', USER, ACCOUNT)[0] == 'Deny'
+    assert index.evaluate(f'{ACCESS_POINT}/b.csv', USER, ACCOUNT)[0] == 'Deny'
+
+
+def test_principals():
+    resource = f'{ACCESS_POINT}/a.csv'
+    for principal in ('*', ACCOUNT, f'arn:aws:iam::{ACCOUNT}:root', USER, [USER, 'other']):
+        index = PolicyIndex([policy(statement('Allow', resource, principal))])
+        assert index.evaluate(resource, USER, ACCOUNT)[0] == 'Allow', principal
+    index = PolicyIndex([policy(statement('Allow', resource, f'arn:aws:iam::{ACCOUNT}:user/bob'))])
+    assert index.evaluate(resource, USER, ACCOUNT) == ('Deny', {'Evaluation': 'Implicit'})
+    # Role identities (session issuer dict) only match the account and * principals
+    assert index.evaluate(resource, {'arn': USER}, ACCOUNT)[0] == 'Deny'
+    assert index.evaluate(resource, USER, '444455556666')[0] == 'Deny'
+
+
+def test_lookup_all_returns_each_statement_once_in_policy_order():
+    index = PolicyIndex([
+        policy(statement('Allow', f'{ACCESS_POINT}/data/a.csv', [USER, ACCOUNT], sid='exact')),
+        policy(statement('Allow', [f'{ACCESS_POINT}/*', f'{ACCESS_POINT}/data/*'], sid='wildcard')),
+        policy(statement('Deny', f'{ACCESS_POINT}/other/*', sid='other')),
+    ])
+    assert [entry[3]['Sid'] for entry in index.lookup_all(f'{ACCESS_POINT}/data/a.csv')] == ['exact', 'wildcard']
+    assert [entry[3]['Sid'] for entry in index.lookup_all(f'{ACCESS_POINT}/x')] == ['wildcard']
+
+
+def test_access_point_resource_matches_its_objects():
+    index = PolicyIndex([
+        policy(statement('Allow', ACCESS_POINT, sid='access point')),
+        policy(statement('Deny', f'{ACCESS_POINT}/private/a.csv', sid='deny')),
+    ])
+    assert index.evaluate(f'{ACCESS_POINT}/a.csv', USER, ACCOUNT)[0] == 'Allow'
+    assert index.decide(f'{ACCESS_POINT}/private/a.csv.bak', USER, ACCOUNT)[2][0]['Sid'] == 'deny'
+    assert [entry[3]['Sid'] for entry in index.lookup_all(f'{ACCESS_POINT}/private/a.csv')] == ['access point', 'deny']
+
+
+def test_sources_of_attachment_items():
+    # The attachment copies of a policy have their own id; the id of the policy is in policy_id
+    index = PolicyIndex([policy(statement('Allow', f'{ACCESS_POINT}/*', sid='s1'),
+                                id='attachment', policy_id='policy', policy_name='name')])
+    assert index.decide(f'{ACCESS_POINT}/a.csv', USER, ACCOUNT)[2] == [
+        {'PolicyId': 'policy', 'PolicyName': 'name', 'Sid': 's1'}]
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    # Results of the next load_policies calls (None: failed load)
+    results = []
+    monkeypatch.setattr(ol_authorizer, '_policy_cache', {})
+    monkeypatch.setattr(ol_authorizer, 'get_policy_generation', lambda: 1)
+    monkeypatch.setattr(ol_authorizer, 'POLICY_CACHE_TTL', 0)
+
+    def load_policies(access_point_arn):
+        policies = results.pop(0)
+        return (None, None) if policies is None else (policies, PolicyIndex(policies))
+    monkeypatch.setattr(ol_authorizer, 'load_policies', load_policies)
+    return results
+
+
+def test_failed_load_is_not_cached(loads):
+    allow = policy(statement('Allow', f'{ACCESS_POINT}/*'))
+    loads.extend([None, [allow]])
+    assert ol_authorizer.get_policy_index() is None
+    # Retried by the next request
+    assert ol_authorizer.get_policy_index().evaluate(f'{ACCESS_POINT}/a.csv', USER, ACCOUNT)[0] == 'Allow'
+
+
+def test_failed_reload_keeps_the_previous_snapshot(loads, monkeypatch):
+    allow = policy(statement('Allow', f'{ACCESS_POINT}/*'))
+    loads.extend([[allow], None, []])
+    assert ol_authorizer.get_cached_policies() == [allow]
+    # New generation: the reload fails, the loaded policies are still used
+    monkeypatch.setattr(ol_authorizer, 'get_policy_generation', lambda: 2)
+    assert ol_authorizer.get_cached_policies() == [allow]
+    assert ol_authorizer.get_cached_policies() == []
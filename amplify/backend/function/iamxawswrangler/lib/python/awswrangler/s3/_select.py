@@ -1,14 +1,17 @@
 """Amazon S3 Select Module (PRIVATE)."""
 
 import concurrent.futures
-import itertools
 import json
 import logging
 import pprint
-from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+from collections import deque
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import boto3
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv
+import pyarrow.json
 
 from awswrangler import _utils, exceptions
 from awswrangler.s3._describe import size_objects
@@ -20,7 +23,8 @@ _RANGE_CHUNK_SIZE: int = int(1024 * 1024)
 
 def _gen_scan_range(obj_size: int) -> Iterator[Tuple[int, int]]:
     for i in range(0, obj_size, _RANGE_CHUNK_SIZE):
-        yield (i, i + min(_RANGE_CHUNK_SIZE, obj_size - i))
+        # ScanRange End is inclusive: overlapping ranges would return the records starting on the boundary twice
+        yield (i, i + min(_RANGE_CHUNK_SIZE, obj_size - i) - 1)
 
 
 def _select_object_content(
@@ -51,9 +55,82 @@ def _select_object_content(
     return pd.concat(dfs, ignore_index=True)
 
 
+def _select_object_payload(
+    args: Dict[str, Any],
+    client_s3: boto3.Session,
+    scan_range: Optional[Tuple[int, int]] = None,
+) -> bytes:
+    if scan_range:
+        response = client_s3.select_object_content(**args, ScanRange={"Start": scan_range[0], "End": scan_range[1]})
+    else:
+        response = client_s3.select_object_content(**args)
+    # Records can be split across events, the whole response always ends on a record boundary
+    return b"".join(event["Records"]["Payload"] for event in response["Payload"] if "Records" in event)
+
+
+def _select_object_content_arrow(
+    args: Dict[str, Any],
+    client_s3: boto3.Session,
+    scan_range: Optional[Tuple[int, int]] = None,
+) -> pa.Table:
+    payload: bytes = _select_object_payload(args=args, client_s3=client_s3, scan_range=scan_range)
+    if not payload:
+        return pa.table({})
+    if "CSV" in args["OutputSerialization"]:
+        # S3 Select doesn't write a header, columns are named by position as in the S3 Select SQL (_1, _2, ...)
+        table: pa.Table = pyarrow.csv.read_csv(
+            pa.BufferReader(payload), read_options=pyarrow.csv.ReadOptions(autogenerate_column_names=True)
+        )
+        return table.rename_columns([f"_{i + 1}" for i in range(table.num_columns)])
+    return pyarrow.json.read_json(pa.BufferReader(payload))
+
+
+def _tables_to_pandas(tables: Iterable[pa.Table]) -> pd.DataFrame:
+    tables = [table for table in tables if table.num_columns]
+    if not tables:
+        return pd.DataFrame()
+    try:
+        # Columns missing or null in some scan ranges are promoted
+        return pa.concat_tables(tables, promote=True).to_pandas()
+    except pa.ArrowInvalid:
+        # Types inferred differently across scan ranges (e.g. int64 and double)
+        return pd.concat([table.to_pandas() for table in tables], ignore_index=True)
+
+
+def _ordered_results(
+    func: Callable[..., Any],
+    args: Dict[str, Any],
+    client_s3: boto3.client,
+    scan_ranges: Iterable[Tuple[int, int]],
+    use_threads: Union[bool, int],
+) -> Iterator[Any]:
+    if use_threads is False:
+        for scan_range in scan_ranges:
+            yield func(args, client_s3, scan_range)
+        return
+    cpus: int = _utils.ensure_cpu_count(use_threads=use_threads)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=cpus) as executor:
+        # Results are returned in scan range order, with at most `cpus` ranges in flight
+        futures: Deque[concurrent.futures.Future] = deque()  # type: ignore
+        try:
+            for scan_range in scan_ranges:
+                futures.append(executor.submit(func, args, client_s3, scan_range))
+                if len(futures) >= cpus:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
 def _paginate_stream(
-    args: Dict[str, Any], path: str, use_threads: Union[bool, int], boto3_session: Optional[boto3.Session]
-) -> pd.DataFrame:
+    args: Dict[str, Any],
+    path: str,
+    use_threads: Union[bool, int],
+    boto3_session: Optional[boto3.Session],
+    use_arrow: bool = False,
+) -> Iterator[Union[pd.DataFrame, pa.Table]]:
     obj_size: int = size_objects(  # type: ignore
         path=[path],
         use_threads=False,
@@ -62,30 +139,22 @@ def _paginate_stream(
     if obj_size is None:
         raise exceptions.InvalidArgumentValue(f"S3 object w/o defined size: {path}")
 
-    dfs: List[pd.Dataframe] = []
     client_s3: boto3.client = _utils.client(service_name="s3", session=boto3_session)
+    return _ordered_results(
+        func=_select_object_content_arrow if use_arrow else _select_object_content,
+        args=args,
+        client_s3=client_s3,
+        scan_ranges=_gen_scan_range(obj_size=obj_size),
+        use_threads=use_threads,
+    )
 
-    if use_threads is False:
-        dfs = list(
-            _select_object_content(
-                args=args,
-                client_s3=client_s3,
-                scan_range=scan_range,
-            )
-            for scan_range in _gen_scan_range(obj_size=obj_size)
-        )
-    else:
-        cpus: int = _utils.ensure_cpu_count(use_threads=use_threads)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=cpus) as executor:
-            dfs = list(
-                executor.map(
-                    _select_object_content,
-                    itertools.repeat(args),
-                    itertools.repeat(client_s3),
-                    _gen_scan_range(obj_size=obj_size),
-                )
-            )
-    return pd.concat(dfs, ignore_index=True)
+
+def _chunks_to_pandas(results: Iterator[Union[pd.DataFrame, pa.Table]], use_arrow: bool) -> Iterator[pd.DataFrame]:
+    for result in results:
+        if use_arrow:
+            result = result.to_pandas() if result.num_columns else pd.DataFrame()
+        if len(result.index):
+            yield result
 
 
 def select_query(
@@ -97,7 +166,10 @@ def select_query(
     use_threads: Union[bool, int] = False,
     boto3_session: Optional[boto3.Session] = None,
     s3_additional_kwargs: Optional[Dict[str, Any]] = None,
-) -> pd.DataFrame:
+    use_arrow: bool = False,
+    output_serialization: str = "JSON",
+    chunked: bool = False,
+) -> Union[pd.DataFrame, Iterator[pd.DataFrame]]:
     r"""Filter contents of an Amazon S3 object based on SQL statement.
 
     Note: Scan ranges are only supported for uncompressed CSV/JSON, CSV (without quoted delimiters)
@@ -128,11 +200,21 @@ def select_query(
         Forwarded to botocore requests.
         Valid values: "SSECustomerAlgorithm", "SSECustomerKey", "ExpectedBucketOwner".
         e.g. s3_additional_kwargs={'SSECustomerAlgorithm': 'md5'}
+    use_arrow : bool
+        True to decode the records of each request in bulk with the PyArrow CSV/JSON readers
+        and concatenate Arrow tables, instead of parsing every record with json.loads.
+        Column types are inferred by PyArrow.
+    output_serialization : str
+        Format of the records returned by S3 Select.
+        Valid values: "JSON" or "CSV". "CSV" requires use_arrow=True, columns are named by position (_1, _2, ...).
+    chunked : bool
+        If True, return an Iterator of DataFrames (one per scan range with results) instead of a single DataFrame.
+        Results are yielded in object order and only the ranges in flight are held in memory.
 
     Returns
     -------
-    pandas.DataFrame
-        Pandas DataFrame with results from query.
+    Union[pandas.DataFrame, Iterator[pandas.DataFrame]]
+        Pandas DataFrame with results from query or Iterator of DataFrames if chunked=True.
 
     Examples
     --------
@@ -163,6 +245,23 @@ def select_query(
     ...     use_threads=True,
     ... )
 
+    Streaming the rows of a large CSV object decoded with PyArrow
+
+    >>> import awswrangler as wr
+    >>> dfs = wr.s3.select_query(
+    ...     sql='SELECT * FROM s3object s where s.\"region\" = \'eu\'',
+    ...     path='s3://bucket/key.csv',
+    ...     input_serialization='CSV',
+    ...     input_serialization_params={
+    ...         'FileHeaderInfo': 'Use',
+    ...     },
+    ...     use_threads=True,
+    ...     use_arrow=True,
+    ...     chunked=True,
+    ... )
+    >>> for df in dfs:
+    >>>     print(df)  # Smaller Pandas DataFrame
+
     Reading a single column from Parquet object with pushdown filter
 
     >>> import awswrangler as wr
@@ -182,6 +281,10 @@ def select_query(
         raise exceptions.InvalidArgumentCombination(
             "'gzip' or 'bzip2' are only valid for input 'CSV' or 'JSON' objects."
         )
+    if output_serialization not in ["JSON", "CSV"]:
+        raise exceptions.InvalidArgumentValue("<output_serialization> argument must be 'JSON' or 'CSV'")
+    if output_serialization == "CSV" and not use_arrow:
+        raise exceptions.InvalidArgumentCombination("'CSV' output serialization requires use_arrow=True.")
     bucket, key = _utils.parse_path(path)
 
     args: Dict[str, Any] = {
@@ -195,7 +298,7 @@ def select_query(
             "CompressionType": compression.upper() if compression else "NONE",
         },
         "OutputSerialization": {
-            "JSON": {},
+            output_serialization: {},
         },
     }
     if s3_additional_kwargs:
@@ -212,6 +315,15 @@ def select_query(
         # and JSON objects (in LINES mode only)
         _logger.debug("Scan ranges are not supported given provided input.")
         client_s3: boto3.client = _utils.client(service_name="s3", session=boto3_session)
-        return _select_object_content(args=args, client_s3=client_s3)
+        func: Callable[..., Any] = _select_object_content_arrow if use_arrow else _select_object_content
+        results: Iterator[Union[pd.DataFrame, pa.Table]] = iter([func(args, client_s3)])
+    else:
+        results = _paginate_stream(
+            args=args, path=path, use_threads=use_threads, boto3_session=boto3_session, use_arrow=use_arrow
+        )
 
-    return _paginate_stream(args=args, path=path, use_threads=use_threads, boto3_session=boto3_session)
+    if chunked:
+        return _chunks_to_pandas(results=results, use_arrow=use_arrow)
+    if use_arrow:
+        return _tables_to_pandas(results)
+    return pd.concat(list(results), ignore_index=True)
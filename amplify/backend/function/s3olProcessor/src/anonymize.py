@@ -0,0 +1,154 @@
+import boto3
+import hashlib
+import hmac
+import logging
+import os
+import numpy as np
+import pandas as pd
+from typing import Callable, Dict, Optional
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Key of the keyed operators (hmac, bucket). ANONYMIZATION_KEY takes precedence over the Secrets Manager secret.
+ANONYMIZATION_KEY = os.getenv('ANONYMIZATION_KEY')
+ANONYMIZATION_KEY_SECRET_ID = os.getenv('ANONYMIZATION_KEY_SECRET_ID')
+MASK_VALUE = '***'
+# Characters kept by the partial mask so the masked value keeps its format (eg: ***-**-1234)
+PARTIAL_MASK_KEEP = np.array([ord(c) for c in ' -./@:'], dtype=np.uint32)
+DATE_GRANULARITY = {
+    'year': 'Y',
+    'quarter': 'Q',
+    'month': 'M',
+    'week': 'W',
+    'day': 'D',
+}
+_key_cache = {}
+
+
+class AnonymizationKeyError(Exception):
+    pass
+
+
+def get_anonymization_key() -> bytes:
+    # Loaded once per container
+    if 'key' not in _key_cache:
+        if ANONYMIZATION_KEY:
+            key = ANONYMIZATION_KEY.encode()
+        elif ANONYMIZATION_KEY_SECRET_ID:
+            secret = boto3.client('secretsmanager').get_secret_value(SecretId=ANONYMIZATION_KEY_SECRET_ID)
+            key = secret['SecretString'].encode() if 'SecretString' in secret else secret['SecretBinary']
+        else:
+            raise AnonymizationKeyError(
+                'Keyed anonymization requires ANONYMIZATION_KEY or ANONYMIZATION_KEY_SECRET_ID'
+            )
+        _key_cache['key'] = key
+    return _key_cache['key']
+
+
+def _missing(series: pd.Series) -> pd.Series:
+    # Null values and empty CSV fields are kept as missing values by every operator
+    return series.isna() | (series == '')
+
+
+def map_unique(series: pd.Series, function: Callable[[object], str]) -> pd.Series:
+    # Apply a per value function once per distinct value and broadcast the result back to the column
+    codes, uniques = pd.factorize(series.where(~_missing(series)))
+    results = np.array([function(value) for value in uniques] + [None], dtype=object)
+    return pd.Series(results[codes], index=series.index, dtype=object)
+
+
+def mask(series: pd.Series, params: dict) -> pd.Series:
+    return pd.Series(params.get('value', MASK_VALUE), index=series.index, dtype=object)
+
+
+def _hmac_state(key: bytes) -> hmac.HMAC:
+    # HMAC-SHA256 keyed once per container: the inner and outer digests of the key are computed here
+    if 'hmac_state' not in _key_cache:
+        _key_cache['hmac_state'] = hmac.new(key, digestmod=hashlib.sha256)
+    return _key_cache['hmac_state']
+
+
+def hmac_token(series: pd.Series, params: dict) -> pd.Series:
+    # Deterministic HMAC-SHA256 token: the same value gives the same token, so anonymized columns stay joinable.
+    # Every value copies the keyed HMAC state instead of keying a new one, which is about twice as fast as
+    # hmac.new per value.
+    state = _hmac_state(get_anonymization_key())
+
+    def token(value) -> str:
+        digest = state.copy()
+        digest.update(str(value).encode())
+        return digest.hexdigest()
+    return map_unique(series, token)
+
+
+def bucket(series: pd.Series, params: dict) -> pd.Series:
+    # Consistent keyed hash (SipHash, vectorized by pandas) of every value into one of N buckets
+    buckets = int(params['buckets'])
+    hash_key = hashlib.sha256(get_anonymization_key()).hexdigest()[:16]
+    missing = _missing(series)
+    values = series.astype(object).where(~missing, '').astype(str).to_numpy(dtype=object)
+    hashed = pd.util.hash_array(values, hash_key=hash_key, categorize=False)
+    result = pd.Series(pd.array((hashed % buckets).astype('int64'), dtype='Int64'), index=series.index)
+    result[missing.to_numpy()] = pd.NA
+    return result
+
+
+def partial(series: pd.Series, params: dict) -> pd.Series:
+    # Mask everything but the last N characters, keeping separators: 123-45-6789 -> ***-**-6789
+    # The values are handled as a 2D array of code points, so the whole column is masked with numpy operations.
+    # The result is a string column whatever the source type (eg: int or timestamp Parquet columns), empty included
+    keep_last = int(params['keep_last'])
+    series = series.astype(object)
+    missing = _missing(series)
+    values = series.where(~missing, '').astype(str).to_numpy(dtype=str)
+    if not len(values) or values.dtype.itemsize == 0:
+        return series
+    width = values.dtype.itemsize // 4
+    codes = values.view(np.uint32).reshape(len(values), width).copy()
+    lengths = np.char.str_len(values)
+    hidden = np.arange(width)[np.newaxis, :] < (lengths - keep_last)[:, np.newaxis]
+    hidden &= ~np.isin(codes, PARTIAL_MASK_KEEP)
+    codes[hidden] = ord('*')
+    masked = pd.Series(codes.view(f'<U{width}').ravel(), index=series.index, dtype=object)
+    return masked.where(~missing, series)
+
+
+def generalize_date(series: pd.Series, params: dict) -> pd.Series:
+    # Replace a date by the period that contains it: 2021-08-03 -> 2021-08 (month), 2021Q3 (quarter), 2021 (year)
+    missing = _missing(series)
+    dates = pd.to_datetime(series.where(~missing), errors='coerce', format=params.get('format'))
+    periods = dates.dt.to_period(DATE_GRANULARITY[params.get('granularity', 'month')]).astype(str)
+    return periods.where(dates.notna(), None).astype(object)
+
+
+ANONYMIZERS: Dict[str, Callable[[pd.Series, dict], pd.Series]] = {
+    'mask': mask,
+    'hmac': hmac_token,
+    'bucket': bucket,
+    'partial': partial,
+    'date': generalize_date,
+}
+KEYED_ANONYMIZERS = ('hmac', 'bucket')
+
+
+def validate_anonymizer(params: dict) -> Optional[str]:
+    # Returns an error message or None
+    method = params.get('method', 'mask')
+    if method not in ANONYMIZERS:
+        return f'method must be one of {list(ANONYMIZERS)}'
+    if method == 'bucket' and not (params.get('buckets', '').isdigit() and int(params['buckets']) > 0):
+        return 'buckets must be a positive integer'
+    if method == 'partial' and not params.get('keep_last', '').isdigit():
+        return 'keep_last must be a non negative integer'
+    if method == 'date' and params.get('granularity', 'month') not in DATE_GRANULARITY:
+        return f'granularity must be one of {list(DATE_GRANULARITY)}'
+    if method in KEYED_ANONYMIZERS:
+        try:
+            get_anonymization_key()
+        except Exception as e:
+            logger.exception(e)
+            return f'Unable to load the anonymization key for method {method}'
+    return None
+
+
+def anonymize(series: pd.Series, params: dict) -> pd.Series:
+    return ANONYMIZERS[params.get('method', 'mask')](series, params)
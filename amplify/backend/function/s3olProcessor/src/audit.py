@@ -0,0 +1,198 @@
+import boto3
+import json
+import logging
+import os
+import sys
+import time
+from typing import List, Optional, Union
+from conditions import condition_value
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Comma separated list of sinks: emf, file, firehose, s3
+AUDIT_SINKS = os.getenv('AUDIT_SINKS', 'emf')
+# Audit every request (Deny included), not only the statements with an AuditRequest condition
+AUDIT_ALL_REQUESTS = os.getenv('AUDIT_ALL_REQUESTS', 'false').lower() == 'true'
+# The buffered records are written when there are AUDIT_BATCH_SIZE of them, or at the end of the first invocation
+# after the oldest one is AUDIT_FLUSH_INTERVAL seconds old (0: at the end of every invocation)
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '60'))
+AUDIT_FILE = os.getenv('AUDIT_FILE', '/tmp/audit.jsonl')
+AUDIT_FIREHOSE_STREAM = os.getenv('AUDIT_FIREHOSE_STREAM')
+AUDIT_S3_PATH = os.getenv('AUDIT_S3_PATH')
+AUDIT_EMF_NAMESPACE = os.getenv('AUDIT_EMF_NAMESPACE', 'IAM-X/Audit')
+# Record fields published as metrics by the EMF sink
+AUDIT_METRICS = {'BytesIn': 'Bytes', 'BytesOut': 'Bytes', 'LatencyMs': 'Milliseconds'}
+FIREHOSE_BATCH_SIZE = 500
+
+
+def audit_record(event: dict, effect: str, attrs: Union[dict, list], sources: list) -> dict:
+    # Audit record of a request. The effect handlers complete it with the response fields.
+    identity = event.get('userIdentity', {})
+    return {
+        'Timestamp': int(time.time() * 1000),
+        'RequestId': event.get('xAmzRequestId'),
+        'PrincipalType': identity.get('type'),
+        'PrincipalId': identity.get('principalId'),
+        'PrincipalArn': identity.get('arn'),
+        'PrincipalAccount': identity.get('accountId'),
+        'AccessPointArn': event.get('configuration', {}).get('accessPointArn'),
+        'Url': event.get('userRequest', {}).get('url', '').split('?')[0],
+        'Effect': effect,
+        'Evaluation': condition_value(attrs, 'Evaluation'),
+        'Policies': sources,
+        'AuditMessage': condition_value(attrs, 'AuditRequest'),
+        'Transforms': [],
+        'PlanDigest': None,
+        'StatusCode': None,
+        'BytesIn': None,
+        'BytesOut': None,
+        'LatencyMs': None,
+    }
+
+
+def should_audit(effect: str, attrs: Union[dict, list]) -> bool:
+    return AUDIT_ALL_REQUESTS or (effect == 'Allow' and bool(condition_value(attrs, 'AuditRequest')))
+
+
+# Sinks. write() receives a batch of records and returns the number of records it couldn't deliver (None: all).
+class FileSink:
+    # JSON Lines file, for local runs and tests
+    def __init__(self, path: str = AUDIT_FILE):
+        self.path = path
+
+    def write(self, records: List[dict]):
+        with open(self.path, 'a') as fp:
+            fp.write(''.join(json.dumps(record, default=str) + '\n' for record in records))
+
+
+class EmfSink:
+    # CloudWatch Logs Embedded Metric Format: one log line per record on stdout. The record fields are searchable
+    # log properties and the byte counts and latency become CloudWatch metrics, without any API call.
+    def __init__(self, namespace: str = AUDIT_EMF_NAMESPACE, stream=None):
+        self.namespace = namespace
+        self.stream = stream
+
+    def _document(self, record: dict) -> str:
+        metrics = [
+            {'Name': name, 'Unit': unit} for name, unit in AUDIT_METRICS.items() if record.get(name) is not None
+        ]
+        document = {k: v for k, v in record.items() if v is not None or k not in AUDIT_METRICS}
+        document['_aws'] = {
+            'Timestamp': record['Timestamp'],
+            'CloudWatchMetrics': [{'Namespace': self.namespace, 'Dimensions': [['Effect']], 'Metrics': metrics}]
+        }
+        return json.dumps(document, default=str)
+
+    def write(self, records: List[dict]):
+        stream = self.stream or sys.stdout
+        stream.write(''.join(self._document(record) + '\n' for record in records))
+        stream.flush()
+
+
+class FirehoseSink:
+    def __init__(self, stream_name: str = AUDIT_FIREHOSE_STREAM):
+        self.stream_name = stream_name
+        self.client = boto3.client('firehose')
+
+    def write(self, records: List[dict]):
+        for i in range(0, len(records), FIREHOSE_BATCH_SIZE):
+            batch = [{'Data': (json.dumps(record, default=str) + '\n').encode()}
+                     for record in records[i:i + FIREHOSE_BATCH_SIZE]]
+            resp = self.client.put_record_batch(DeliveryStreamName=self.stream_name, Records=batch)
+            if resp.get('FailedPutCount'):
+                # Retry once the records rejected by Firehose (throttling)
+                failed = [item for item, result in zip(batch, resp['RequestResponses']) if 'ErrorCode' in result]
+                resp = self.client.put_record_batch(DeliveryStreamName=self.stream_name, Records=failed)
+                if resp.get('FailedPutCount'):
+                    logger.error(f'Unable to deliver {resp["FailedPutCount"]} audit records to {self.stream_name}')
+                    return resp['FailedPutCount']
+
+
+class S3ParquetSink:
+    # Parquet dataset partitioned by date, written with awswrangler (one file per batch, imported by the first one)
+    def __init__(self, path: str = AUDIT_S3_PATH):
+        self.path = path
+
+    def write(self, records: List[dict]):
+        import awswrangler as wr
+        import pandas as pd
+        df = pd.DataFrame(records)
+        for column in ('Policies', 'Transforms'):
+            df[column] = df[column].map(json.dumps)
+        df['Date'] = pd.to_datetime(df['Timestamp'], unit='ms').dt.strftime('%Y-%m-%d')
+        wr.s3.to_parquet(df=df, path=self.path, dataset=True, mode='append', partition_cols=['Date'])
+
+
+SINKS = {
+    'emf': EmfSink,
+    'file': FileSink,
+    'firehose': FirehoseSink,
+    's3': S3ParquetSink,
+}
+
+
+class AuditPipeline:
+    # Records are buffered across the warm invocations of the container and written in batches by flush_if_due()
+    # at the end of an invocation, after the response has been sent: the client doesn't wait for the sinks, and
+    # the sinks (and the modules they import) are not called by every request.
+    # The records buffered when Lambda shuts the environment down are lost (no atexit handlers run): at most
+    # AUDIT_FLUSH_INTERVAL seconds of records of an idle container.
+    def __init__(self, sinks: list, batch_size: int = AUDIT_BATCH_SIZE, flush_interval: float = AUDIT_FLUSH_INTERVAL):
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Records that a sink failed to deliver since the container started
+        self.dropped = 0
+        self._records = []
+        # time.monotonic() of the oldest buffered record
+        self._oldest = None
+
+    def submit(self, record: dict):
+        if not self.sinks:
+            return
+        if not self._records:
+            self._oldest = time.monotonic()
+        self._records.append(record)
+        if len(self._records) >= self.batch_size:
+            self.flush()
+
+    def flush_if_due(self) -> int:
+        # Write the buffered records once the oldest one is flush_interval old, returns the number of records a
+        # sink failed to deliver
+        if not self._records or time.monotonic() - self._oldest < self.flush_interval:
+            return 0
+        return self.flush()
+
+    def flush(self) -> int:
+        # Write the buffered records to every sink, returns the number of records a sink failed to deliver
+        records, self._records = self._records, []
+        if not records:
+            return 0
+        dropped = 0
+        for sink in self.sinks:
+            try:
+                undelivered = sink.write(records) or 0
+            except Exception as e:
+                logger.exception(e)
+                undelivered = len(records)
+            dropped = max(dropped, undelivered)
+        if dropped:
+            logger.error(f'{dropped} audit records were not delivered')
+        self.dropped += dropped
+        return dropped
+
+
+def create_pipeline(names: str = AUDIT_SINKS) -> AuditPipeline:
+    sinks = []
+    for name in filter(None, (name.strip() for name in names.split(','))):
+        if name not in SINKS:
+            logger.error(f'Unknown audit sink {name}. Must be one of {list(SINKS)}')
+            continue
+        try:
+            sinks.append(SINKS[name]())
+        except Exception as e:
+            logger.exception(e)
+    return AuditPipeline(sinks)
+
+
+pipeline = create_pipeline()
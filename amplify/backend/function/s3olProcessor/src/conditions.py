@@ -0,0 +1,30 @@
+from typing import Union
+
+# Condition keys of the policy statements, kept apart from plan.py so the handler can tell if a request needs a
+# transform without importing pandas and pyarrow.
+# Condition key -> column operation
+TRANSFORM_OPERATIONS = {
+    'RemoveColumn': 'drop',
+    'RemoveData': 'null',
+    'AnonymizeData': 'mask',
+    'HashData': 'hash',
+    'TruncateData': 'truncate',
+}
+# Row level condition: "column_name=region;operator=eq;value=${aws:PrincipalTag/region}"
+FILTER_KEY = 'FilterRows'
+TRANSFORM_KEYS = tuple(TRANSFORM_OPERATIONS) + (FILTER_KEY,)
+
+
+def has_transforms(attrs: Union[dict, list]) -> bool:
+    # False when the object can be returned unchanged (only non transform keys such as AuditRequest)
+    conditions = attrs if isinstance(attrs, list) else [attrs or {}]
+    return any(key in TRANSFORM_KEYS for condition in conditions for key in condition)
+
+
+def condition_value(attrs: Union[dict, list], key: str):
+    # Value of a condition key, in the dict or the list form of the Condition block (first condition that has it)
+    conditions = attrs if isinstance(attrs, list) else [attrs or {}]
+    for condition in conditions:
+        if key in condition:
+            return condition[key]
+    return None
@@ -0,0 +1,10 @@
+import os
+import sys
+
+# The authorizer layer (ol_metrics) is in /opt/python in Lambda
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'iamxS3olAuthorizer', 'lib',
+                                'python'))
+os.environ.setdefault('ENV', 'test')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+# Key of the hmac and bucket AnonymizeData methods (Secrets Manager is not used by the tests)
+os.environ.setdefault('ANONYMIZATION_KEY', 'test-key')
@@ -0,0 +1,126 @@
+import logging
+import operator
+import re
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from typing import Callable, List, Optional
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# FilterRows operator -> comparison
+FILTER_OPERATORS = {
+    'eq': (operator.eq, pc.equal),
+    'ne': (operator.ne, pc.not_equal),
+    'gt': (operator.gt, pc.greater),
+    'ge': (operator.ge, pc.greater_equal),
+    'lt': (operator.lt, pc.less),
+    'le': (operator.le, pc.less_equal),
+    'in': (None, None),
+    'not_in': (None, None),
+}
+SET_OPERATORS = ('in', 'not_in')
+# Requester variables (eg: ${aws:PrincipalTag/region}) are replaced by the values of the current requester
+VARIABLE_PATTERN = re.compile(r'\$\{(aws:[A-Za-z]+(?:/[^}]+)?)\}')
+
+
+def substitute_variables(rule: str, resolver: Optional[Callable[[str], Optional[str]]]) -> str:
+    # Variables that can't be resolved are left as is: the compiled filter doesn't match any row
+    if resolver is None or '${' not in rule:
+        return rule
+
+    def replace(match) -> str:
+        value = resolver(match[1])
+        # A value with ';' would add parameters to the rule
+        if value is None or ';' in value or '${' in value:
+            logger.warning(f'Unable to resolve the requester variable {match[0]}')
+            return match[0]
+        return value
+    return VARIABLE_PATTERN.sub(replace, rule)
+
+
+def _to_number(value: str) -> Optional[float]:
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class RowFilter:
+    # Vectorized row predicate compiled from a FilterRows condition: "column_name=region;operator=eq;value=eu".
+    # A filter is evaluated on a whole chunk and returns a boolean mask, rows with a null value never match.
+    # Filters on a missing column or with an unresolved requester variable don't match any row.
+    def __init__(self, column: str, operator_name: str, value: str):
+        self.column = column
+        self.operator = operator_name
+        self.values = [v.strip() for v in value.split(',')] if operator_name in SET_OPERATORS else [value]
+        self.unresolved = bool(VARIABLE_PATTERN.search(value))
+        self.number = None if operator_name in SET_OPERATORS else _to_number(value)
+        self.expression = f'{column} {operator_name} {self.values if operator_name in SET_OPERATORS else repr(value)}'
+
+    def __repr__(self) -> str:
+        return f'RowFilter({self.expression})'
+
+    def _compare(self, series: pd.Series) -> np.ndarray:
+        if pd.api.types.is_numeric_dtype(series.dtype) and not pd.api.types.is_bool_dtype(series.dtype):
+            # Numeric column (JSON, Parquet): compare numbers, values that aren't numbers never match
+            series = series.astype('float64')
+            values = [_to_number(v) for v in self.values]
+        elif self.number is not None and self.operator not in ('eq', 'ne'):
+            # String column (CSV) ordered against a number: compare the numeric values
+            series = pd.to_numeric(series, errors='coerce')
+            values = [self.number]
+        else:
+            series = series.where(series.isna(), series.astype(str))
+            values = self.values
+        if self.operator in SET_OPERATORS:
+            result = series.isin([v for v in values if v is not None]).to_numpy()
+            if self.operator == 'not_in':
+                result = ~result
+        elif values[0] is None:
+            result = np.zeros(len(series), dtype=bool)
+        else:
+            result = FILTER_OPERATORS[self.operator][0](series, values[0]).to_numpy()
+        return np.asarray(result, dtype=bool) & series.notna().to_numpy()
+
+    def __call__(self, df: pd.DataFrame) -> np.ndarray:
+        if self.unresolved or self.column not in df.columns:
+            return np.zeros(len(df), dtype=bool)
+        return self._compare(df[self.column])
+
+    def arrow(self, table: pa.Table) -> pa.Array:
+        # pyarrow compute version for Arrow tables (Parquet row groups). The value is cast to the column type,
+        # types that can't be compared natively fall back to the pandas comparison.
+        if self.unresolved or self.column not in table.column_names:
+            return pa.array(np.zeros(table.num_rows, dtype=bool))
+        column = table.column(self.column)
+        if self.number is not None and self.operator not in ('eq', 'ne') and \
+                (pa.types.is_string(column.type) or pa.types.is_large_string(column.type)):
+            return pa.array(self._compare(column.to_pandas()))
+        try:
+            values = pa.array(self.values, pa.string()).cast(column.type)
+            if self.operator in SET_OPERATORS:
+                result = pc.is_in(column, value_set=values)
+                if self.operator == 'not_in':
+                    result = pc.invert(result)
+                # Rows with a null value never match
+                return pc.and_(result, pc.is_valid(column))
+            return FILTER_OPERATORS[self.operator][1](column, values[0])
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, pa.ArrowTypeError):
+            return pa.array(self._compare(column.to_pandas()))
+
+
+def row_mask(filters: List[RowFilter], df: pd.DataFrame) -> Optional[np.ndarray]:
+    mask = None
+    for predicate in filters:
+        result = predicate(df)
+        mask = result if mask is None else mask & result
+    return mask
+
+
+def arrow_row_mask(filters: List[RowFilter], table: pa.Table) -> Optional[pa.Array]:
+    mask = None
+    for predicate in filters:
+        result = predicate.arrow(table)
+        mask = result if mask is None else pc.and_(mask, result)
+    return mask
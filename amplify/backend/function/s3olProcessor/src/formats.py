@@ -0,0 +1,336 @@
+import logging
+import zlib
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import StringIO
+from itertools import chain
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from ol_metrics import current as current_metrics
+from streaming import IterStream, STREAM_CHUNK_ROWS
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger('IAM-X_Authorizer')
+PEEK_SIZE = 8
+# Content types that don't tell anything about the object format
+GENERIC_CONTENT_TYPES = ('', 'application/octet-stream', 'binary/octet-stream', 'text/plain')
+
+
+class Codec(NamedTuple):
+    name: str
+    encodings: Tuple[str, ...]
+    suffixes: Tuple[str, ...]
+    magic: Tuple[bytes, ...]
+    decompress: Callable[[Iterable[bytes]], Iterator[bytes]]
+    compress: Callable[[Iterable[bytes]], Iterator[bytes]]
+
+
+class DataFormat(NamedTuple):
+    name: str
+    content_types: Tuple[str, ...]
+    suffixes: Tuple[str, ...]
+    magic: Tuple[bytes, ...]
+    # read(chunks, exclude) -> DataFrames; exclude are the columns that must not be loaded
+    read: Callable[[Iterable[bytes], List[str]], Iterator[pd.DataFrame]]
+    # write(frames) -> encoded bytes
+    write: Callable[[Iterable[pd.DataFrame]], Iterator[bytes]]
+
+
+CODECS = {}
+FORMATS = {}
+
+
+def register_codec(codec: Codec) -> Codec:
+    CODECS[codec.name] = codec
+    return codec
+
+
+def register_format(data_format: DataFormat) -> DataFormat:
+    FORMATS[data_format.name] = data_format
+    return data_format
+
+
+def peek(chunks: Iterable[bytes], size: int = PEEK_SIZE) -> (bytes, Iterator[bytes]):
+    # Read at least `size` bytes from the iterator and return them together with an iterator that replays them
+    chunks = iter(chunks)
+    head = []
+    length = 0
+    for chunk in chunks:
+        head.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    head = b''.join(head)
+    return head[:size], chain([head], chunks)
+
+
+# Codecs
+def _identity(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    return iter(chunks)
+
+
+def _gzip_decompress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = b''
+            if decompressor.eof:
+                # Concatenated gzip members: restart with the bytes after the end of the current member
+                chunk = decompressor.unused_data
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    data = decompressor.flush()
+    if data:
+        yield data
+
+
+def _gzip_compress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _zstd_decompress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        data = decompressor.decompress(chunk)
+        if data:
+            yield data
+
+
+def _zstd_compress(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    compressor = zstandard.ZstdCompressor().compressobj()
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+IDENTITY = register_codec(Codec('identity', (), (), (), _identity, _identity))
+register_codec(Codec('gzip', ('gzip', 'x-gzip'), ('.gz', '.gzip'), (b'\x1f\x8b',), _gzip_decompress, _gzip_compress))
+if zstandard is not None:
+    # zstd objects are only recognized when the zstandard package is in the function layer
+    register_codec(Codec('zstd', ('zstd',), ('.zst', '.zstd'), (b'\x28\xb5\x2f\xfd',),
+                         _zstd_decompress, _zstd_compress))
+
+
+# Formats
+def _read_csv(chunks: Iterable[bytes], exclude: List[str]) -> Iterator[pd.DataFrame]:
+    # Values are read as strings so every chunk is rendered the same way regardless of the rows it holds
+    # (type inference per chunk would turn an int column into floats only in the chunks that contain blanks).
+    # Excluded columns are still tokenized by the CSV parser, there is no way to skip them in a row format.
+    # A header without rows gives one empty frame (the output keeps the header), an empty object gives none.
+    try:
+        return pd.read_csv(
+            IterStream(chunks), header=0, dtype=str, keep_default_na=False, chunksize=STREAM_CHUNK_ROWS,
+            usecols=(lambda column: column not in exclude) if exclude else None
+        )
+    except pd.errors.EmptyDataError:
+        return iter(())
+
+
+def _write_csv(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    header = True
+    for df in frames:
+        fp = StringIO()
+        df.to_csv(path_or_buf=fp, index=False, header=header)  # index=False to remove extra enum column added by pandas
+        header = False
+        yield fp.getvalue().encode()
+
+
+def _read_json_lines(chunks: Iterable[bytes], exclude: List[str]) -> Iterator[pd.DataFrame]:
+    # JSON records are parsed whole: the excluded columns are dropped by the transform, which sees every column
+    return pd.read_json(
+        IterStream(chunks), lines=True, chunksize=STREAM_CHUNK_ROWS, dtype=False, convert_dates=False
+    )
+
+
+def _write_json_lines(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    for df in frames:
+        data = df.to_json(orient='records', lines=True)
+        if data and not data.endswith('\n'):
+            data += '\n'
+        yield data.encode()
+
+
+class BufferSink:
+    # Minimal writable file object for pyarrow writers. The written bytes are handed out with drain()
+    # so the output can be streamed while the writer is still open.
+    def __init__(self):
+        # The writes (often small pages) are appended to one buffer and copied out once by drain()
+        self._buffer = bytearray()
+        self._position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        size = memoryview(data).nbytes
+        self._buffer += data
+        self._position += size
+        return size
+
+    def tell(self) -> int:
+        return self._position
+
+    def writable(self) -> bool:
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = bytes(self._buffer)
+        del self._buffer[:]
+        return data
+
+
+def _read_parquet(chunks: Iterable[bytes], exclude: List[str]) -> Iterator[pd.DataFrame]:
+    # The Parquet footer is at the end of the file, so the decompressed object is held in memory: this path is
+    # only taken by compressed Parquet objects (plain ones are read by ranges, see parquet.redact_parquet).
+    # Only the projected columns are decoded: the pages of the excluded columns are never read.
+    parquet_file = pq.ParquetFile(pa.BufferReader(b''.join(chunks)))
+    columns = [name for name in parquet_file.schema_arrow.names if name not in exclude]
+    empty = True
+    for batch in parquet_file.iter_batches(batch_size=STREAM_CHUNK_ROWS, columns=columns):
+        empty = False
+        yield batch.to_pandas()
+    if empty:
+        # No rows: one empty frame so the output has the columns
+        yield parquet_file.schema_arrow.empty_table().select(columns).to_pandas()
+
+
+def _write_parquet(frames: Iterable[pd.DataFrame]) -> Iterator[bytes]:
+    # The schema is the one of the first frame with rows (the object columns of an empty frame have no type).
+    # Without any row, the file has the schema of the first frame and no row group.
+    sink = BufferSink()
+    writer = None
+    schema = None
+    first = None
+    for df in frames:
+        if writer is None and not len(df):
+            if first is None:
+                first = df
+            continue
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            writer = pq.ParquetWriter(sink, schema)
+        else:
+            table = table.cast(schema)
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        if first is None:
+            return
+        writer = pq.ParquetWriter(sink, pa.Table.from_pandas(first, preserve_index=False).schema)
+    writer.close()
+    yield sink.drain()
+
+
+CSV = register_format(DataFormat(
+    'csv', ('text/csv', 'application/csv'), ('.csv',), (), _read_csv, _write_csv
+))
+register_format(DataFormat(
+    'jsonl', ('application/x-ndjson', 'application/jsonl', 'application/json-lines', 'application/x-jsonlines'),
+    ('.jsonl', '.ndjson'), (b'{',), _read_json_lines, _write_json_lines
+))
+PARQUET = register_format(DataFormat(
+    'parquet', ('application/x-parquet', 'application/vnd.apache.parquet', 'application/parquet'),
+    ('.parquet', '.pq'), (b'PAR1',), _read_parquet, _write_parquet
+))
+
+
+def _match(registry: dict, attribute: str, value: str):
+    for item in registry.values():
+        if value in getattr(item, attribute):
+            return item
+    return None
+
+
+def _match_suffix(registry: dict, key: str):
+    for item in registry.values():
+        if any(key.endswith(suffix) for suffix in item.suffixes):
+            return item
+    return None
+
+
+def _match_magic(registry: dict, head: bytes):
+    for item in registry.values():
+        if any(head.lstrip().startswith(magic) for magic in item.magic):
+            return item
+    return None
+
+
+def detect_codec(content_encoding: Optional[str], key: str, head: bytes) -> Codec:
+    content_encoding = (content_encoding or '').lower().strip()
+    return ((content_encoding and _match(CODECS, 'encodings', content_encoding))
+            or _match_suffix(CODECS, key.lower())
+            or _match_magic(CODECS, head)
+            or IDENTITY)
+
+
+def detect_format(content_type: Optional[str], key: str, head: bytes, codec: Codec = IDENTITY) -> DataFormat:
+    content_type = (content_type or '').lower().split(';')[0].strip()
+    key = key.lower()
+    for suffix in codec.suffixes:
+        if key.endswith(suffix):
+            key = key[:-len(suffix)]
+            break
+    data_format = None
+    if content_type not in GENERIC_CONTENT_TYPES:
+        data_format = _match(FORMATS, 'content_types', content_type)
+    return data_format or _match_suffix(FORMATS, key) or _match_magic(FORMATS, head) or CSV
+
+
+def content_headers(codec: Codec, data_format: DataFormat, headers: dict) -> dict:
+    # ContentType and ContentEncoding of a transformed object, which has the format and the codec of the source:
+    # the headers of the source when they match what was detected, the detected ones otherwise
+    content_type = headers.get('Content-Type') or ''
+    if content_type.lower().split(';')[0].strip() not in data_format.content_types:
+        content_type = data_format.content_types[0]
+    response_headers = {'ContentType': content_type}
+    if codec is not IDENTITY:
+        content_encoding = headers.get('Content-Encoding') or ''
+        if content_encoding.lower().strip() not in codec.encodings:
+            content_encoding = codec.encodings[0]
+        response_headers['ContentEncoding'] = content_encoding
+    return response_headers
+
+
+def detect_object(chunks: Iterable[bytes], key: str, headers: dict) -> (Codec, DataFormat, Iterator[bytes]):
+    # Find the codec and format of the upstream body. The returned iterator yields the decompressed body.
+    head, chunks = peek(chunks)
+    codec = detect_codec(headers.get('Content-Encoding'), key, head)
+    chunks = current_metrics().timed(codec.decompress(chunks), 'Decompress')
+    head, chunks = peek(chunks)
+    data_format = detect_format(headers.get('Content-Type'), key, head, codec)
+    logger.debug(f'Object {key} detected as format={data_format.name}; codec={codec.name}')
+    return codec, data_format, chunks
+
+
+def transform_stream(codec: Codec, data_format: DataFormat, chunks: Iterable[bytes],
+                     transform: Callable[[pd.DataFrame], pd.DataFrame], exclude: List[str]) -> Iterator[bytes]:
+    # Transform each decoded DataFrame chunk and encode the result with the same format and codec
+    metrics = current_metrics()
+
+    def transformed() -> Iterator[pd.DataFrame]:
+        for df in metrics.timed(data_format.read(chunks, exclude), 'Parse'):
+            with metrics.stage('Transform'):
+                result = transform(df)
+            metrics.add('RowsIn', len(df))
+            metrics.add('RowsOut', len(result))
+            yield result
+    encoded = metrics.timed(data_format.write(transformed()), 'Serialize')
+    return metrics.timed(codec.compress(encoded), 'Compress')
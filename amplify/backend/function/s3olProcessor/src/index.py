@@ -1,34 +1,131 @@
 import boto3
 import logging
 import os
+import re
 import urllib3
-import pandas as pd
+import socket
 import sys
-import gc
-from io import StringIO
-from ol_authorizer import validate_request
+import time
+from botocore.config import Config
+from email.utils import parsedate_to_datetime
+from typing import Optional
+from urllib.parse import parse_qs, unquote
+from urllib3.connection import HTTPConnection
+from urllib3.util import Retry, Timeout
+from audit import audit_record, pipeline as audit_pipeline, should_audit
+from conditions import condition_value, has_transforms
+from ol_authorizer import authorize_request
+from ol_metrics import current as current_metrics, end_request, start_request
+from materialize import MATERIALIZE, handle_s3_event, is_s3_event, is_view_key, open_view
+from memory import release_memory
+from result_cache import create_cache
+from streaming import IterStream, parse_range, read_range
 
 _THIS_MODULE = sys.modules[__name__]
 logger = logging.getLogger('IAM-X_Authorizer')
 logger.addHandler(logging.StreamHandler())
 logger.setLevel(getattr(logging, os.getenv('LOG_LEVEL', 'INFO'),'INFO'))
-s3 = boto3.client('s3')
+# Clients and connection pools are created once per container and reused by warm invocations
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '2'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '20'))
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', '3'))
+# The transform modules (pandas, pyarrow, awswrangler) are imported by the first request that transforms an object.
+# Set to true to import them during the init phase instead (eg: with provisioned concurrency).
+PRELOAD_TRANSFORM_MODULES = os.getenv('PRELOAD_TRANSFORM_MODULES', 'false').lower() == 'true'
+s3 = boto3.client('s3', config=Config(
+    max_pool_connections=HTTP_POOL_SIZE,
+    connect_timeout=HTTP_CONNECT_TIMEOUT,
+    read_timeout=HTTP_READ_TIMEOUT,
+    retries={'max_attempts': HTTP_RETRIES, 'mode': 'standard'},
+    tcp_keepalive=True
+))
+http = urllib3.PoolManager(
+    maxsize=HTTP_POOL_SIZE,
+    timeout=Timeout(connect=HTTP_CONNECT_TIMEOUT, read=HTTP_READ_TIMEOUT),
+    retries=Retry(
+        total=HTTP_RETRIES,
+        backoff_factor=0.1,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET', 'HEAD']),
+        raise_on_status=False
+    ),
+    socket_options=HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+)
+# Transformed objects cache (RESULT_CACHE=true), None when disabled
+result_cache = create_cache(s3)
+S3_ERROR_CODE = re.compile(rb'<Code>([^<]+)</Code>')
+# Headers of the original object returned as is when the object is not transformed
+PASSTHROUGH_HEADERS = {
+    'Accept-Ranges': 'AcceptRanges',
+    'Cache-Control': 'CacheControl',
+    'Content-Disposition': 'ContentDisposition',
+    'Content-Encoding': 'ContentEncoding',
+    'Content-Language': 'ContentLanguage',
+    'Content-Range': 'ContentRange',
+    'Content-Type': 'ContentType',
+    'ETag': 'ETag',
+    'x-amz-version-id': 'VersionId',
+}
+PASSTHROUGH_INT_HEADERS = {
+    'Content-Length': 'ContentLength',
+    'x-amz-mp-parts-count': 'PartsCount',
+}
 
 
 def handler(event, context):
-    effect, attrs = validate_request(event)
-    effect_handler = getattr(
-        _THIS_MODULE,
-        f'handle_effect_{effect.lower()}',
-        handle_effect_noop
-    )
-    return effect_handler(event, attrs)
+    if is_s3_event(event):
+        # Object written to or removed from the bucket: update its materialized views (MATERIALIZE_ACCESS_POINT_ARNS)
+        return handle_s3_event(s3, http, event)
+    started = time.perf_counter()
+    # Stage timings of the request, emitted as an EMF document once the response is sent
+    metrics = start_request(RequestId=event.get('xAmzRequestId'))
+    try:
+        if is_view_key(unquote(object_key(event).lstrip('/'))):
+            # Materialized views are only served in place of their source object
+            effect, attrs, sources = 'Deny', {'Evaluation': 'Explicit'}, []
+        else:
+            effect, attrs, sources = authorize_request(event)
+        metrics.set_property('Effect', effect)
+        # Completed by the effect handler with the response fields
+        record = audit_record(event, effect, attrs, sources)
+        effect_handler = getattr(
+            _THIS_MODULE,
+            f'handle_effect_{effect.lower()}',
+            handle_effect_noop
+        )
+        result = effect_handler(event, attrs, record)
+        if record['BytesIn'] is not None:
+            metrics.add('BytesIn', record['BytesIn'], 'Bytes')
+        if record['BytesOut'] is not None:
+            metrics.add('BytesOut', record['BytesOut'], 'Bytes')
+        if should_audit(effect, attrs):
+            record['LatencyMs'] = round((time.perf_counter() - started) * 1000, 3)
+            audit_pipeline.submit(record)
+        return result
+    finally:
+        # The response has been sent: the audit records are written once the batch is old enough
+        with metrics.stage('Audit'):
+            dropped = audit_pipeline.flush_if_due()
+        if dropped:
+            metrics.add('AuditDropped', dropped)
+        # The response has been sent: memory is reclaimed (above the high-water mark only) before the next request
+        release_memory(metrics)
+        end_request()
+
 
+def write_response(event, **response_args):
+    with current_metrics().stage('WriteResponse'):
+        s3.write_get_object_response(
+            RequestRoute=event["getObjectContext"]["outputRoute"],
+            RequestToken=event["getObjectContext"]["outputToken"],
+            **response_args)
 
-def handle_effect_noop(event, attrs):
-    s3.write_get_object_response(
-        RequestRoute=event["getObjectContext"]["outputRoute"],
-        RequestToken=event["getObjectContext"]["outputToken"],
+
+def handle_effect_noop(event, attrs, record):
+    record.update(StatusCode=401, BytesOut=0)
+    write_response(
+        event,
         StatusCode=401,
         ErrorCode="AccessDenied",
         ErrorMessage='Implicit denied. Unable to process authorization request'
@@ -36,74 +133,276 @@ def handle_effect_noop(event, attrs):
     return {'statusCode': 202}
 
 
-def handle_effect_allow(event, attrs):
-    http = urllib3.PoolManager()
+def object_key(event) -> str:
+    url = event.get('userRequest', {}).get('url', '')
+    return urllib3.util.parse_url(url).path or ''
+
+
+def user_request_range(event) -> (Optional[str], Optional[str]):
+    # Range header and partNumber query parameter sent by the client to the Object Lambda access point
+    user_request = event.get('userRequest', {})
+    headers = {k.lower(): v for k, v in user_request.get('headers', {}).items()}
+    query = urllib3.util.parse_url(user_request.get('url', '')).query or ''
+    part_number = parse_qs(query).get('partNumber', [None])[0]
+    return headers.get('range'), part_number
+
+
+def upstream_error(response) -> dict:
+    # Forward the S3 error (eg: 416 InvalidRange for a range beyond the end of the object)
+    match = S3_ERROR_CODE.search(response.data)
+    return {
+        'StatusCode': response.status,
+        'ErrorCode': match[1].decode() if match else 'InternalError',
+        'ErrorMessage': f'Unable to read the original object: HTTP {response.status}'
+    }
+
+
+def import_transform_modules():
+    # Loads pandas, pyarrow and the transform code ahead of the first request (see PRELOAD_TRANSFORM_MODULES)
+    import formats  # noqa: F401
+    import parquet  # noqa: F401
+    import plan  # noqa: F401
+    import raw_csv  # noqa: F401
+    import requester  # noqa: F401
+    import s3select  # noqa: F401
+    import transform  # noqa: F401
+
+
+def handle_effect_allow(event, attrs, record):
     s3_url = event["getObjectContext"]["inputS3Url"]
     logger.debug(f'Authorizer effect: Allow, attributes: {attrs}')
+    if not has_transforms(attrs):
+        # Checked before loading the transform modules: deny and passthrough requests never import pandas
+        logger.debug(f'No condition found. Returning the object unchanged')
+        return passthrough(event, record)
+    metrics = current_metrics()
+    with metrics.stage('Import'):
+        from plan import TransformPlanError, compile_plan
+        from requester import Requester
+        from s3select import can_push_down, probe_object, select_object
+        from transform import transform_object
+    try:
+        with metrics.stage('PlanCompile'):
+            plan = compile_plan(attrs, Requester(event))
+    except TransformPlanError as e:
+        logger.exception(e)
+        record.update(StatusCode=500, BytesOut=0)
+        write_response(
+            event,
+            StatusCode=500,
+            ErrorCode='InvalidPolicyCondition',
+            ErrorMessage=str(e))
+        return {'statusCode': 200}
+    logger.debug(f'got transform plan {plan.digest}: {plan.describe()}')
+    record.update(Transforms=plan.describe(), PlanDigest=plan.digest)
+
+    if plan.is_noop:
+        logger.debug(f'No condition found. Returning the object unchanged')
+        return passthrough(event, record)
+
+    range_header, _ = user_request_range(event)
+    response = None
+    source = None
+    probe = None
+    if can_push_down(plan):
+        # Restrictions of large CSV/JSON objects can be done by S3 Select: decided from the first bytes of the
+        # object, the body is only opened when the query can't be used
+        with metrics.stage('Fetch'):
+            probe = probe_object(http, s3_url)
+    if probe is None:
+        response = open_object(event, record, s3_url)
+        if response is None:
+            return {'statusCode': 200}
+    if result_cache is not None or MATERIALIZE:
+        # The cached result or the view is looked up with the headers of the source response (version id, ETag,
+        # format): on a hit its body is never read
+        served = serve_transformed(event, record, response.headers if probe is None else probe.headers, plan,
+                                   range_header)
+        if served is not None:
+            if response is not None:
+                response.close()
+            return served
+    selected = None
+    if probe is not None:
+        with metrics.stage('Select'):
+            selected = select_object(s3, probe, event, plan)
+    if selected is not None:
+        metrics.set_property('Format', 'S3Select')
+        output, headers = selected
+        output = metrics.timed(output, 'Select')
+        source_headers = probe.headers
+    else:
+        if response is None:
+            response = open_object(event, record, s3_url)
+            if response is None:
+                return {'statusCode': 200}
+        output, source, headers = transform_object(http, s3_url, response, object_key(event), plan)
+        source_headers = response.headers
+    cache_key = None
+    if result_cache is not None:
+        # Keyed by the headers of the object that is transformed (it may have changed since the lookup)
+        cache_key = result_cache.key(source_headers, event['configuration']['supportingAccessPointArn'],
+                                     object_key(event), plan.digest)
+    if cache_key:
+        # Written to the cache while it is streamed, committed only if the whole output is produced
+        output = result_cache.store(cache_key, output, headers)
+    try:
+        return write_output(event, record, output, headers, range_header)
+    finally:
+        # Bytes read from S3 (not known for S3 Select)
+        if source is not None:
+            source.close()
+            record['BytesIn'] = source.bytes_read
+        elif response is not None:
+            record['BytesIn'] = response.tell()
+        if cache_key:
+            with metrics.stage('CacheUpload'):
+                result_cache.upload_pending()
+
+
+def open_object(event, record, s3_url: str):
     # Get object from S3
-    response = http.request('GET', s3_url)
-    # Load the original object into a Pandas DataFrame
-    # TODO: Check the original object type: csv, parquet, json. and use the correct loader
-    df = pd.read_csv(StringIO(response.data.decode('utf-8')), header=0)
-    fp = StringIO()
-    transform_remove_data = attrs.get('RemoveData')  # eg: "key=value"
-    transform_remove_column = attrs.get('RemoveColumn')  # eg: "key=value"
-    transform_anonymize_data = attrs.get('AnonymizeData')  # eg: "key=value"
-    logger.debug(
-        f'got transform objects; '
-        f'RemoveData={transform_remove_data!r};'
-        f'RemoveColumn={transform_remove_data!r};'
-        f'AnonymizeData={transform_remove_data!r};'
-    )
+    # The body is not preloaded so it can be parsed and transformed while it is being downloaded.
+    # None when S3 returned an error, which is forwarded to the client.
+    with current_metrics().stage('Fetch'):
+        response = http.request('GET', s3_url, preload_content=False, decode_content=False)
+    if response.status in (200, 206):
+        return response
+    record.update(StatusCode=response.status, BytesOut=0)
+    try:
+        write_response(event, **upstream_error(response))
+    finally:
+        response.release_conn()
+    return None
+
 
-    if transform_remove_data:
-        k, v = transform_remove_data.split('=', 1)
-        if k == 'column_name':
-            # Remove data from column name
-            df[v] = None
-    if transform_remove_column:
-        k, v = transform_remove_column.split('=', 1)
-        if k == 'column_name':
-            # Remove the column from the data
-            df.pop(v)
-    if transform_anonymize_data:
-        k, v = transform_anonymize_data.split('=', 1)
-        if k == 'column_name':
-            # Replace the column data with ***
-            df[v] = '***'
-    # Audit object
-    if msg := attrs.get('AuditRequest'):
-        # TODO: Implement a full logging schema with meta-data from the requester and the transformed data
-        logger.info(f'[AUDIT] Request to object {s3_url.split("?")[0]} logged. {msg}')
-
-    if (transform_anonymize_data
-            or transform_remove_data
-            or transform_remove_column):
-        df.to_csv(path_or_buf=fp, index=False)  # index=False to remove extra enum column added by pandas
-        fp.seek(0)
-        transformed_object = fp.read().encode()
+def serve_transformed(event, record, source_headers, plan, range_header: Optional[str]) -> Optional[dict]:
+    # Send the cached result or the materialized view of the source version, None if there is none
+    metrics = current_metrics()
+    access_point_arn = event['configuration']['supportingAccessPointArn']
+    if result_cache is not None:
+        cache_key = result_cache.key(source_headers, access_point_arn, object_key(event), plan.digest)
+        cached = result_cache.get(cache_key) if cache_key else None
+        metrics.set_property('Cache', f'hit-{cached[0]}' if cached else 'miss')
+        if cached:
+            # Pre-redacted bytes are streamed as is: the source body is never read or parsed
+            record['BytesIn'] = 0
+            return write_output(event, record, cached[2], cached[1], range_header)
+    if MATERIALIZE:
+        # Pre-redacted view written when the object was uploaded, used only if it is of the same source version
+        with metrics.stage('View'):
+            state, view = open_view(s3, access_point_arn, unquote(object_key(event).lstrip('/')), plan.digest,
+                                    source_headers, range_header)
+        metrics.set_property('View', state)
+        if view is not None:
+            record['BytesIn'] = 0
+            return write_view(event, record, view)
+    return None
+
+
+def write_output(event, record, output, headers: dict, range_header: Optional[str]) -> dict:
+    # Send the transformed (or cached) output, whole or the requested range of it. headers are its ContentType
+    # and ContentEncoding (the output has the format and the codec of the source).
+    transformed_object = None
+    requested_range = parse_range(range_header) if range_header else None
+    if requested_range:
+        # Only the requested bytes of the transformed output are kept, the rest is discarded while streaming
+        data, first, last, total = read_range(output, *requested_range)
+        if first > last:
+            response_args = {
+                'StatusCode': 416,
+                'ErrorCode': 'InvalidRange',
+                'ErrorMessage': 'The requested range is not satisfiable'
+            }
+        else:
+            response_args = {'StatusCode': 206, 'ContentRange': f'bytes {first}-{last}/{total}'}
+            transformed_object = data
     else:
-        logger.debug(f'No condition found. Returning the object unchanged')
-        transformed_object = response.data
-    # Cleaning memory (Do we really need this? Maybe for Pandas dataframe. Need to benchmark to validate)
-    del response
-    del df
-    del fp
-    gc.collect()
-    s3.write_get_object_response(
-        Body=transformed_object,
-        RequestRoute=event["getObjectContext"]["outputRoute"],
-        RequestToken=event["getObjectContext"]["outputToken"])
+        response_args = {}
+        transformed_object = IterStream(output)
+    if transformed_object is not None:
+        response_args.update(headers, Body=transformed_object, AcceptRanges='bytes')
+    try:
+        write_response(event, **response_args)
+    finally:
+        # Close the pipeline: its generators drop their frames and buffers and release the upstream connection
+        if isinstance(transformed_object, IterStream):
+            transformed_object.close()
+        elif hasattr(output, 'close'):
+            output.close()
+    # Bytes sent to the client
+    record['StatusCode'] = response_args.get('StatusCode', 200)
+    if isinstance(transformed_object, IterStream):
+        record['BytesOut'] = transformed_object.bytes_read
+    else:
+        record['BytesOut'] = len(transformed_object or b'')
+    return {'statusCode': 200}
+
+
+def write_view(event, record, view: dict) -> dict:
+    # The view is sent as is, like a passthrough: S3 already served the requested range of it
+    response_args = {
+        'Body': view['Body'],
+        'StatusCode': 206 if view.get('ContentRange') else 200,
+        'AcceptRanges': 'bytes',
+    }
+    for param in ('ContentRange', 'ContentLength', 'ContentType', 'ContentEncoding'):
+        if param in view:
+            response_args[param] = view[param]
+    record.update(StatusCode=response_args['StatusCode'], BytesOut=view.get('ContentLength'))
+    try:
+        write_response(event, **response_args)
+    finally:
+        view['Body'].close()
+    return {'statusCode': 200}
 
+
+def passthrough(event, record) -> dict:
+    # Return the original object without reading it in the function: the upstream response is handed to
+    # write_get_object_response as the request body, so the bytes are never decoded, parsed or copied
+    s3_url = event["getObjectContext"]["inputS3Url"]
+    range_header, part_number = user_request_range(event)
+    request_headers = {}
+    # Let S3 serve only the requested bytes
+    if range_header:
+        request_headers['Range'] = range_header
+    if part_number:
+        s3_url = f'{s3_url}&partNumber={part_number}'
+    response = http.request('GET', s3_url, headers=request_headers, preload_content=False, decode_content=False)
+    try:
+        if response.status not in (200, 206):
+            response_args = upstream_error(response)
+        else:
+            response_args = {'Body': response, 'StatusCode': response.status}
+            for header, param in PASSTHROUGH_HEADERS.items():
+                if header in response.headers:
+                    response_args[param] = response.headers[header]
+            for header, param in PASSTHROUGH_INT_HEADERS.items():
+                if header in response.headers:
+                    response_args[param] = int(response.headers[header])
+            if 'Last-Modified' in response.headers:
+                response_args['LastModified'] = parsedate_to_datetime(response.headers['Last-Modified'])
+        record.update(
+            StatusCode=response_args['StatusCode'],
+            BytesIn=response_args.get('ContentLength'),
+            BytesOut=response_args.get('ContentLength')
+        )
+        write_response(event, **response_args)
+    finally:
+        response.release_conn()
     return {'statusCode': 200}
 
 
-def handle_effect_deny(event, attrs):
+def handle_effect_deny(event, attrs, record):
     logger.debug(f'Authorizer effect: Deny, attributes: {attrs}')
-    s3.write_get_object_response(
-        RequestRoute=event["getObjectContext"]["outputRoute"],
-        RequestToken=event["getObjectContext"]["outputToken"],
+    record.update(StatusCode=403, BytesOut=0)
+    write_response(
+        event,
         StatusCode=403,
         ErrorCode="AccessDenied",
-        ErrorMessage=f"S3 Object Lambda Policy {attrs.get('Evaluation')} denied")
+        ErrorMessage=f"S3 Object Lambda Policy {condition_value(attrs, 'Evaluation')} denied")
     return {'statusCode': 200}
+
+
+if PRELOAD_TRANSFORM_MODULES:
+    import_transform_modules()
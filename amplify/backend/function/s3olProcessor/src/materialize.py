@@ -0,0 +1,158 @@
+import logging
+import os
+from typing import Dict, Optional, Tuple
+from urllib.parse import unquote_plus
+from botocore.exceptions import BotoCoreError, ClientError
+from conditions import has_transforms
+from ol_authorizer import POLICY_LOOKUP, get_policy_index
+from streaming import IterStream, version_id
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Object Lambda access points (comma separated ARNs) whose transforms are materialized when an object is written
+# to the bucket (S3 event notifications on the function). Empty disables the materialized views.
+MATERIALIZE_ACCESS_POINT_ARNS = [
+    arn.strip() for arn in os.getenv('MATERIALIZE_ACCESS_POINT_ARNS', '').split(',') if arn.strip()
+]
+MATERIALIZE = bool(MATERIALIZE_ACCESS_POINT_ARNS)
+# Shadow prefix of the views: <prefix><plan digest>/<object key>. Readers of the bucket must not have access to it,
+# and the Object Lambda requests for keys under it are denied.
+MATERIALIZE_PREFIX = os.getenv('MATERIALIZE_PREFIX', '_views/')
+# Validity of the presigned URL used to read the source object
+MATERIALIZE_URL_EXPIRES = int(os.getenv('MATERIALIZE_URL_EXPIRES', '900'))
+# Metadata of the views: version of the source they were generated from
+SOURCE_ETAG = 'source-etag'
+SOURCE_VERSION_ID = 'source-version-id'
+PLAN_DIGEST = 'plan-digest'
+
+
+def view_key(plan_digest: str, key: str) -> str:
+    return f'{MATERIALIZE_PREFIX}{plan_digest}/{key}'
+
+
+def is_view_key(key: str) -> bool:
+    # The views are authorized by the statements of their source key, never by their own key
+    return key.startswith(MATERIALIZE_PREFIX)
+
+
+def is_s3_event(event) -> bool:
+    records = event.get('Records')
+    return bool(records) and records[0].get('eventSource') == 'aws:s3'
+
+
+def view_plans(key: str) -> Dict[str, object]:
+    # digest -> plan of every transform that can apply to the key: the Allow statements matching it on the
+    # materialized access points, for any principal. Plans with requester variables differ per requester:
+    # they are left to the Object Lambda requests.
+    from plan import TransformPlanError, compile_plan
+    plans = {}
+    for ap_arn in MATERIALIZE_ACCESS_POINT_ARNS:
+        index = get_policy_index(ap_arn if POLICY_LOOKUP == 'attachment' else None)
+        if index is None:
+            # Raised so the S3 event is retried
+            raise RuntimeError(f'Unable to load the policies of {ap_arn}')
+        for _, effect, attrs, source in index.lookup_all(f'{ap_arn}/{key}'):
+            if effect != 'Allow' or not has_transforms(attrs):
+                continue
+            try:
+                plan = compile_plan(attrs)
+            except TransformPlanError as e:
+                logger.warning(f'Statement {source} not materialized: {e}')
+                continue
+            if plan.is_noop or any(getattr(f, 'unresolved', False) for f in plan.filters):
+                continue
+            plans[plan.digest] = plan
+    return plans
+
+
+def materialize_object(s3, http, bucket: str, key: str, version: Optional[str] = None) -> int:
+    # Write the view of every plan of the key, returns the number of views written
+    from transform import transform_object
+    plans = view_plans(key)
+    if not plans:
+        return 0
+    params = {'Bucket': bucket, 'Key': key}
+    if version:
+        params['VersionId'] = version
+    url = s3.generate_presigned_url('get_object', Params=params, ExpiresIn=MATERIALIZE_URL_EXPIRES)
+    for digest, plan in plans.items():
+        response = http.request('GET', url, preload_content=False, decode_content=False)
+        if response.status != 200:
+            response.release_conn()
+            raise RuntimeError(f'Unable to read s3://{bucket}/{key}: HTTP {response.status}')
+        # The version that was read, compared by the Object Lambda requests with the object they get
+        metadata = {SOURCE_ETAG: response.headers.get('ETag', ''), PLAN_DIGEST: digest}
+        if version_id(response.headers):
+            metadata[SOURCE_VERSION_ID] = version_id(response.headers)
+        output, source, headers = transform_object(http, url, response, key, plan)
+        # Sent with the view by the Object Lambda requests
+        extra_args = dict(headers, Metadata=metadata)
+        body = IterStream(output)
+        try:
+            s3.upload_fileobj(body, bucket, view_key(digest, key), ExtraArgs=extra_args)
+        finally:
+            body.close()
+            if source is not None:
+                source.close()
+        logger.debug(f'Materialized s3://{bucket}/{key} with the transform plan {digest}')
+    return len(plans)
+
+
+def delete_views(s3, bucket: str, key: str) -> int:
+    # Views of every plan digest, including the plans no longer in the policies
+    keys = []
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=MATERIALIZE_PREFIX, Delimiter='/'):
+        keys.extend({'Key': f'{prefix["Prefix"]}{key}'} for prefix in page.get('CommonPrefixes', ()))
+    for start in range(0, len(keys), 1000):
+        s3.delete_objects(Bucket=bucket, Delete={'Objects': keys[start:start + 1000], 'Quiet': True})
+    return len(keys)
+
+
+def handle_s3_event(s3, http, event) -> dict:
+    # Object written or removed: (re)build or delete its views. Errors are raised so the event is retried.
+    for record in event['Records']:
+        bucket = record['s3']['bucket']['name']
+        key = unquote_plus(record['s3']['object']['key'])
+        if is_view_key(key):
+            # Written by this function
+            continue
+        if record['eventName'].startswith('ObjectRemoved'):
+            deleted = delete_views(s3, bucket, key)
+            logger.info(f'Deleted {deleted} views of s3://{bucket}/{key}')
+        else:
+            written = materialize_object(s3, http, bucket, key, record['s3']['object'].get('versionId'))
+            logger.info(f'Materialized {written} views of s3://{bucket}/{key}')
+    return {'statusCode': 200}
+
+
+def is_current(metadata: dict, source_headers) -> bool:
+    # The view was generated from the version of the object returned to the Object Lambda request: the ETags must
+    # match, and the version ids too when both are known ('null' version ids are ignored)
+    if not metadata.get(SOURCE_ETAG) or metadata[SOURCE_ETAG] != source_headers.get('ETag'):
+        return False
+    source_version_id = version_id(source_headers)
+    view_version_id = metadata.get(SOURCE_VERSION_ID)
+    if view_version_id == 'null':
+        view_version_id = None
+    return not (source_version_id and view_version_id) or source_version_id == view_version_id
+
+
+def open_view(s3, access_point_arn: str, key: str, plan_digest: str, source_headers,
+              range_header: Optional[str] = None) -> Tuple[str, Optional[dict]]:
+    # ('hit', get_object response of the view) or ('miss' | 'stale', None) to transform the object inline
+    params = {'Bucket': access_point_arn, 'Key': view_key(plan_digest, key)}
+    if range_header:
+        params['Range'] = range_header
+    try:
+        view = s3.get_object(**params)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404', 'InvalidRange'):
+            logger.exception(e)
+        return 'miss', None
+    except BotoCoreError as e:
+        logger.exception(e)
+        return 'miss', None
+    if not is_current(view.get('Metadata', {}), source_headers):
+        view['Body'].close()
+        return 'stale', None
+    return 'hit', view
@@ -0,0 +1,67 @@
+import ctypes
+import ctypes.util
+import gc
+import logging
+import os
+import sys
+from typing import Optional
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Memory is only reclaimed (full gc, Arrow pool and malloc release) when the RSS at the end of a request is above
+# this many MB. Defaults to 70% of the function memory, 0 disables it.
+MEMORY_HIGH_WATER_MB = float(os.getenv(
+    'MEMORY_HIGH_WATER_MB', str(int(os.getenv('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', '0')) * 0.7)
+))
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+try:
+    # glibc: give the free heap pages back to the OS (Python and pandas free their buffers to malloc, not the OS)
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'))
+    _malloc_trim = _libc.malloc_trim
+except (OSError, AttributeError, TypeError):
+    _malloc_trim = None
+
+
+def current_rss() -> Optional[int]:
+    # Resident set size in bytes (Linux), None when it can't be read
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def _arrow_pool():
+    # Only reported when a transform already loaded pyarrow
+    pyarrow = sys.modules.get('pyarrow')
+    return pyarrow.default_memory_pool() if pyarrow is not None else None
+
+
+def reclaim():
+    # Full collection, then release the unused memory of the Arrow pool and of malloc
+    gc.collect()
+    pool = _arrow_pool()
+    if pool is not None and hasattr(pool, 'release_unused'):
+        pool.release_unused()
+    if _malloc_trim is not None:
+        _malloc_trim(0)
+
+
+def release_memory(metrics, high_water_mb: float = MEMORY_HIGH_WATER_MB) -> bool:
+    # Called after the response is sent. Reports the memory use of the request and reclaims memory only when the
+    # RSS is above the high-water mark: a forced gc on every request costs tens of ms on large heaps.
+    rss = current_rss()
+    pool = _arrow_pool()
+    if pool is not None:
+        metrics.add('ArrowAllocatedBytes', pool.bytes_allocated(), 'Bytes')
+        metrics.add('ArrowPeakBytes', pool.max_memory(), 'Bytes')
+    if rss is None:
+        return False
+    metrics.add('RssBytes', rss, 'Bytes')
+    if not high_water_mb or rss < high_water_mb * 1024 * 1024:
+        return False
+    with metrics.stage('MemoryReclaim'):
+        reclaim()
+    after = current_rss()
+    logger.debug(f'RSS {rss} above the high-water mark of {high_water_mb} MB. Reclaimed {rss - (after or rss)} bytes')
+    metrics.add('MemoryReclaimed', 1)
+    return True
@@ -0,0 +1,292 @@
+import logging
+import multiprocessing
+import os
+import sys
+import urllib3
+from collections import deque
+from multiprocessing import forkserver
+from multiprocessing.connection import wait
+from typing import Iterable, Iterator, Optional, Tuple
+from formats import CSV, IDENTITY, transform_stream
+from ol_metrics import current as current_metrics
+from plan import TransformPlan, check_columns
+from raw_csv import RAW_CSV, CsvRedactor, redact_csv
+from streaming import RangedHttpFile
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Uncompressed CSV objects of at least PARALLEL_CSV_MIN_MB are transformed by PARALLEL_CSV_WORKERS processes
+# (defaults to the vCPUs of the function, 1 disables it), each one fetching and transforming byte ranges of
+# PARALLEL_CSV_RANGE_MB
+PARALLEL_CSV_WORKERS = int(os.getenv('PARALLEL_CSV_WORKERS', str(os.cpu_count() or 1)))
+PARALLEL_CSV_MIN_MB = float(os.getenv('PARALLEL_CSV_MIN_MB', '64'))
+PARALLEL_CSV_RANGE_MB = float(os.getenv('PARALLEL_CSV_RANGE_MB', '16'))
+# Output of the ranges after the one being sent held in memory before only the worker of that range is read
+# (the other workers block on their pipe until it is sent)
+PARALLEL_CSV_BUFFER_MB = float(os.getenv('PARALLEL_CSV_BUFFER_MB', '64'))
+# Size of the requests reading the end of the last record of a range
+TAIL_READ_SIZE = 64 * 1024
+MB = 1024 * 1024
+QUOTE = b'"'
+NEWLINE = b'\n'
+
+
+def record_end(data, offset: int = 0, parity: int = 0) -> Optional[int]:
+    # Position after the first newline at or after offset that is not inside a quoted field, None if there is none.
+    # parity is the number of quotes before offset (mod 2). Escaped quotes ("") don't change it, so a newline
+    # ends a record when the number of quotes before it is even.
+    while True:
+        newline = data.find(NEWLINE, offset)
+        if newline < 0:
+            return None
+        parity ^= data.count(QUOTE, offset, newline) & 1
+        if not parity:
+            return newline + 1
+        offset = newline + 1
+
+
+def use_parallel_csv(codec, data_format, headers: dict, workers: int = PARALLEL_CSV_WORKERS) -> bool:
+    # The byte ranges of a compressed object can't be decoded independently
+    size = int(headers.get('Content-Length') or 0)
+    return (workers > 1 and data_format is CSV and codec is IDENTITY
+            and size >= PARALLEL_CSV_MIN_MB * MB and size > PARALLEL_CSV_RANGE_MB * MB)
+
+
+def read_header(chunks: Iterable[bytes]) -> bytes:
+    # First record of the object (the header row)
+    data = b''
+    for chunk in chunks:
+        data += chunk
+        end = record_end(data)
+        if end is not None:
+            return data[:end]
+    return data
+
+
+def start_forkserver():
+    # The forkserver preloads this module (and pandas) once, so the workers start in a few ms. It doesn't get the
+    # sys.path of the function before the preload (the function and layer directories): they are given in PYTHONPATH.
+    pythonpath = os.environ.get('PYTHONPATH')
+    os.environ['PYTHONPATH'] = os.pathsep.join(path for path in sys.path if path)
+    try:
+        multiprocessing.set_forkserver_preload([__name__])
+        forkserver.ensure_running()
+    finally:
+        if pythonpath is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = pythonpath
+
+
+class ParallelCsvTransform:
+    # Transform of an uncompressed CSV object by worker processes (Lambda has no /dev/shm for the multiprocessing
+    # pools and queues, the workers use pipes). The workers are forked by a forkserver started once per container
+    # with the transform modules preloaded, never by the handler process: its threads (eg: the audit pipeline) may
+    # hold locks at the time of the fork. The object is split in byte ranges, given in order
+    # to the idle workers. A range owns the records starting in it: the workers fetch their range with a Range
+    # request and send its number of quotes, the parent returns the quote parity at the start of the range (from
+    # the counts of the previous ranges) and the worker transforms its records. The outputs are yielded in order,
+    # at most one range per worker is in flight and at most buffer_size bytes of output are buffered.
+    def __init__(self, http, url: str, size: int, header: bytes, plan: TransformPlan,
+                 workers: int = PARALLEL_CSV_WORKERS, range_size: int = int(PARALLEL_CSV_RANGE_MB * MB),
+                 buffer_size: int = int(PARALLEL_CSV_BUFFER_MB * MB)):
+        self.http = http
+        self.url = url
+        self.size = size
+        self.header = header
+        self.plan = plan
+        # The workers don't report metrics: the columns of the plan are checked here, on the header
+        redactor = CsvRedactor(plan)
+        redactor.rewrite(header)
+        check_columns(plan, redactor.names or ())
+        self.ranges = [(first, min(first + range_size, size)) for first in range(0, size, range_size)]
+        self.workers = max(min(workers, len(self.ranges)), 1)
+        self.buffer_size = buffer_size
+        self.bytes_read = 0
+        self._processes = []
+        self._connections = []
+        self._next_range = 0
+        # Quote parity at the start of each range, known up to the first range whose count is missing
+        self._parities = [0]
+        self._counts = {}
+        self._waiting = {}
+        self._outputs = {}
+        self._done = set()
+        # Range being sent, range of each worker and bytes of the outputs not sent yet
+        self._current = 0
+        self._assigned = {}
+        self._buffered = 0
+        self._buffered_max = 0
+
+    def _start(self):
+        context = multiprocessing.get_context('forkserver')
+        start_forkserver()
+        for _ in range(self.workers):
+            conn, child_conn = context.Pipe()
+            process = context.Process(
+                target=_worker,
+                args=(child_conn, self.http.connection_pool_kw, self.url, self.size, self.header, self.plan),
+                daemon=True
+            )
+            process.start()
+            child_conn.close()
+            self._processes.append(process)
+            self._connections.append(conn)
+            self._assign(conn)
+
+    def _assign(self, conn):
+        if self._next_range < len(self.ranges):
+            first, last = self.ranges[self._next_range]
+            self._outputs[self._next_range] = deque()
+            self._assigned[conn] = self._next_range
+            conn.send(('range', self._next_range, first, last))
+            self._next_range += 1
+
+    def _receive(self):
+        metrics = current_metrics()
+        connections = self._connections
+        if self._buffered > self.buffer_size:
+            # Only the worker of the range being sent is read, the others block on their pipe
+            connections = [conn for conn in connections if self._assigned.get(conn) == self._current] or connections
+        for conn in wait(connections):
+            try:
+                message = conn.recv()
+            except EOFError:
+                raise RuntimeError('A parallel CSV worker exited unexpectedly')
+            kind, index = message[:2]
+            if kind == 'chunk':
+                self._outputs[index].append(message[2])
+                if index != self._current:
+                    self._buffered += len(message[2])
+                    self._buffered_max = max(self._buffered_max, self._buffered)
+            elif kind == 'count':
+                self._counts[index] = message[2]
+                self._waiting[index] = conn
+                while len(self._parities) - 1 in self._counts:
+                    last = len(self._parities) - 1
+                    self._parities.append(self._parities[last] ^ (self._counts.pop(last) & 1))
+                for waiting in [i for i in self._waiting if i < len(self._parities)]:
+                    self._waiting.pop(waiting).send(('parity', self._parities[waiting]))
+            elif kind == 'done':
+                _, _, bytes_read, rows_in, rows_out = message
+                self.bytes_read += bytes_read
+                metrics.add('RowsIn', rows_in)
+                metrics.add('RowsOut', rows_out)
+                self._done.add(index)
+                self._assign(conn)
+            else:
+                raise RuntimeError(f'Parallel CSV transform failed: {message[2]}')
+
+    def chunks(self) -> Iterator[bytes]:
+        metrics = current_metrics()
+        metrics.set_property('ParallelWorkers', self.workers)
+        try:
+            self._start()
+            while self._current < len(self.ranges):
+                output = self._outputs.get(self._current)
+                if output:
+                    yield output.popleft()
+                elif self._current in self._done:
+                    del self._outputs[self._current]
+                    self._current += 1
+                    # Buffered while the previous ranges were sent
+                    self._buffered -= sum(len(chunk) for chunk in self._outputs.get(self._current, ()))
+                else:
+                    # Time spent waiting for the workers
+                    with metrics.stage('ParallelTransform'):
+                        self._receive()
+        finally:
+            metrics.add('ParallelBufferedBytesMax', self._buffered_max, 'Bytes')
+            self.close()
+
+    def close(self):
+        for conn in self._connections:
+            try:
+                conn.send(None)
+            except (OSError, ValueError):
+                pass
+            conn.close()
+        for process in self._processes:
+            process.join(timeout=1)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self._connections = []
+        self._processes = []
+
+
+def _worker(conn, http_kw: dict, url: str, size: int, header: bytes, plan: TransformPlan):
+    # Runs in a worker process: ('range', index, first, last) -> ('count', index, quotes), ('parity', parity) ->
+    # ('chunk', index, bytes)... ('done', index, bytes_read, rows_in, rows_out) until None is received
+    source = RangedHttpFile(urllib3.PoolManager(**http_kw), url, size)
+    try:
+        while True:
+            task = conn.recv()
+            if task is None:
+                return
+            _, index, first, last = task
+            # The byte before the range tells if the range starts with a record
+            begin = max(first - 1, 0)
+            source.seek(begin)
+            data = source.read(last - begin)
+            conn.send(('count', index, data.count(QUOTE, first - begin)))
+            message = conn.recv()
+            if message is None:
+                return
+            source.bytes_read = 0
+            rows_in, rows_out = _transform_range(conn, source, index, data, first - begin, message[1], header, plan)
+            conn.send(('done', index, last - first + source.bytes_read, rows_in, rows_out))
+    except (EOFError, BrokenPipeError):
+        pass
+    except Exception as e:
+        logger.exception(e)
+        conn.send(('error', None, f'{type(e).__name__}: {e}'))
+    finally:
+        conn.close()
+
+
+def _transform_range(conn, source: RangedHttpFile, index: int, data: bytes, offset: int, parity: int,
+                     header: bytes, plan: TransformPlan) -> Tuple[int, int]:
+    # The records of the range start at its first record boundary and end at the first boundary after the range
+    if index == 0:
+        start = 0
+    elif data[offset - 1:offset] == NEWLINE and not parity:
+        start = offset
+    else:
+        start = record_end(data, offset, parity)
+    if start is None or start >= len(data):
+        return 0, 0
+    parity = data.count(QUOTE, start) & 1
+    if data.endswith(NEWLINE) and not parity:
+        records = data[start:]
+    else:
+        # The last record continues after the range
+        records = bytearray(data[start:])
+        while source.tell() < source.size():
+            scanned = len(records)
+            records += source.read(TAIL_READ_SIZE)
+            end = record_end(records, scanned, parity)
+            if end is not None:
+                del records[end:]
+                break
+            parity ^= records.count(QUOTE, scanned) & 1
+    rows = [0, 0]
+
+    def apply(df):
+        result = plan.apply(df)
+        rows[0] += len(df)
+        rows[1] += len(result)
+        return result
+    # Same pipeline as a whole object. The ranges after the first one get the header, whose output is dropped.
+    data = [records] if index == 0 else [header, records]
+    if RAW_CSV:
+        chunks = redact_csv(data, plan, rows)
+    else:
+        chunks = transform_stream(IDENTITY, CSV, data, apply, plan.excluded_columns)
+    skip_header = index != 0
+    for chunk in chunks:
+        if skip_header:
+            chunk = chunk[record_end(chunk) or len(chunk):]
+            skip_header = False
+        if chunk:
+            conn.send(('chunk', index, chunk))
+    return rows[0], rows[1]
@@ -0,0 +1,63 @@
+import logging
+import pyarrow.parquet as pq
+from formats import BufferSink
+from plan import TransformPlan, check_columns
+from typing import Iterator
+
+logger = logging.getLogger('IAM-X_Authorizer')
+DICTIONARY_ENCODINGS = ('PLAIN_DICTIONARY', 'RLE_DICTIONARY')
+
+
+def writer_options(metadata) -> dict:
+    # Keep the physical layout of the source file: dictionary encoded columns, compression codec and format version
+    use_dictionary = []
+    compression = {}
+    if metadata.num_row_groups:
+        row_group = metadata.row_group(0)
+        for j in range(row_group.num_columns):
+            column = row_group.column(j)
+            if any(encoding in DICTIONARY_ENCODINGS for encoding in column.encodings):
+                use_dictionary.append(column.path_in_schema)
+            codec = column.compression.upper()
+            compression[column.path_in_schema] = 'NONE' if codec == 'UNCOMPRESSED' else codec
+    return {
+        'use_dictionary': use_dictionary,
+        'compression': compression or 'snappy',
+        'version': metadata.format_version
+    }
+
+
+def redact_parquet(source, plan: TransformPlan) -> Iterator[bytes]:
+    # Rewrite a Parquet file one row group at a time. The output keeps the row group boundaries of the source,
+    # so memory is bounded by the largest row group. Dropped columns are not part of the projection (unless a row
+    # filter needs them) and their column chunks are never fetched or decoded.
+    # Imported here: loading awswrangler pulls its whole dependency tree
+    from awswrangler.s3._read_parquet import _pyarrow_parquet_file_wrapper, _row_group_chunk_generator
+    pq_file = _pyarrow_parquet_file_wrapper(source=source)
+    if pq_file is None:
+        return
+    metadata = pq_file.metadata
+    check_columns(plan, pq_file.schema_arrow.names)
+    columns = [name for name in pq_file.schema_arrow.names if name not in plan.excluded_columns]
+    schema = plan.apply_arrow(pq_file.schema_arrow.empty_table().select(columns)).schema
+    options = writer_options(metadata)
+    options['use_dictionary'] = [name for name in options['use_dictionary'] if name.split('.')[0] in schema.names]
+    if isinstance(options['compression'], dict):
+        options['compression'] = {
+            k: v for k, v in options['compression'].items() if k.split('.')[0] in schema.names
+        }
+    logger.debug(f'Redacting {metadata.num_row_groups} row groups; columns={columns}; options={options}')
+    sink = BufferSink()
+    writer = pq.ParquetWriter(sink, schema, **options)
+    try:
+        row_groups = _row_group_chunk_generator(
+            pq_file=pq_file, columns=columns, use_threads_flag=True, num_row_groups=metadata.num_row_groups
+        )
+        for table in row_groups:
+            table = plan.apply_arrow(table)
+            if table.num_rows:
+                writer.write_table(table, row_group_size=table.num_rows)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
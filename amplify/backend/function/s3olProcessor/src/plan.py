@@ -0,0 +1,239 @@
+import hashlib
+import json
+import logging
+import pandas as pd
+import pyarrow as pa
+from functools import lru_cache
+from anonymize import MASK_VALUE, anonymize, map_unique, validate_anonymizer
+from conditions import FILTER_KEY, TRANSFORM_KEYS, TRANSFORM_OPERATIONS
+from filters import FILTER_OPERATORS, RowFilter, arrow_row_mask, row_mask, substitute_variables
+from ol_metrics import current as current_metrics
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple, Union
+
+logger = logging.getLogger('IAM-X_Authorizer')
+PLAN_CACHE_SIZE = 256
+# Parameters of a FilterRows condition besides column_name
+FILTER_PARAMETERS = ('operator', 'value')
+# Order of the operations applied to the same column: later operations see the result of the previous ones
+# (eg: truncate then hash) and drop/null supersede everything else
+OPERATION_ORDER = ('truncate', 'hash', 'mask', 'null', 'drop')
+# Parameters accepted by each operation besides column_name
+OPERATION_PARAMETERS = {
+    'drop': (),
+    'null': (),
+    'mask': ('value', 'method', 'keep_last', 'buckets', 'granularity', 'format'),
+    'hash': (),
+    'truncate': ('length',),
+}
+
+
+class TransformPlanError(ValueError):
+    pass
+
+
+class Step(NamedTuple):
+    operation: str
+    column: str
+    params: Tuple[Tuple[str, str], ...]
+
+
+def parse_rule(key: str, rule: str) -> (List[str], Dict[str, str]):
+    # "column_name=a,b;length=4" -> (['a', 'b'], {'length': '4'})
+    params = {}
+    for item in rule.split(';'):
+        if '=' not in item:
+            raise TransformPlanError(f'Invalid {key} condition {rule!r}. Expected key=value')
+        k, v = item.split('=', 1)
+        params[k.strip()] = v.strip()
+    columns = [column.strip() for column in params.pop('column_name', '').split(',') if column.strip()]
+    if not columns:
+        raise TransformPlanError(f'Invalid {key} condition {rule!r}. Missing column_name')
+    return columns, params
+
+
+def parse_filter(rule: str) -> RowFilter:
+    columns, params = parse_rule(FILTER_KEY, rule)
+    unknown = set(params) - set(FILTER_PARAMETERS)
+    if unknown:
+        raise TransformPlanError(f'Invalid {FILTER_KEY} condition. Unknown parameters {sorted(unknown)}')
+    if len(columns) != 1:
+        raise TransformPlanError(f'Invalid {FILTER_KEY} condition. Only one column_name is allowed')
+    operator = params.get('operator', 'eq')
+    if operator not in FILTER_OPERATORS:
+        raise TransformPlanError(f'Invalid {FILTER_KEY} condition. operator must be one of {list(FILTER_OPERATORS)}')
+    if 'value' not in params:
+        raise TransformPlanError(f'Invalid {FILTER_KEY} condition. Missing value')
+    return RowFilter(columns[0], operator, params['value'])
+
+
+def _validate_params(key: str, operation: str, params: Dict[str, str]):
+    unknown = set(params) - set(OPERATION_PARAMETERS[operation])
+    if unknown:
+        raise TransformPlanError(f'Invalid {key} condition. Unknown parameters {sorted(unknown)}')
+    if operation == 'truncate':
+        if not params.get('length', '').isdigit():
+            raise TransformPlanError(f'Invalid {key} condition. length must be a non negative integer')
+    if operation == 'mask':
+        error = validate_anonymizer(params)
+        if error:
+            raise TransformPlanError(f'Invalid {key} condition. {error}')
+
+
+# Column operations. Every operation takes and returns a whole column (pandas Series).
+def _null(series: pd.Series, params: dict) -> pd.Series:
+    return pd.Series([None] * len(series), index=series.index, dtype=object)
+
+
+def _hash(series: pd.Series, params: dict) -> pd.Series:
+    return map_unique(series, lambda value: hashlib.sha256(str(value).encode()).hexdigest())
+
+
+def _truncate(series: pd.Series, params: dict) -> pd.Series:
+    # String column whatever the source type, missing values are kept
+    truncated = series.astype(str).str.slice(0, int(params['length'])).astype(object)
+    return truncated.where(series.notna(), None)
+
+
+COLUMN_OPERATIONS: Dict[str, Callable[[pd.Series, dict], pd.Series]] = {
+    'null': _null,
+    'mask': anonymize,
+    'hash': _hash,
+    'truncate': _truncate,
+}
+
+
+class TransformPlan:
+    # Ordered, validated list of operations compiled from the Condition block of a statement.
+    # Executing the plan is a single pass over the columns of a chunk: every output column is computed once
+    # with all its operations and the result frame is built in one go.
+    def __init__(self, steps: List[Step], filters: List[Callable] = (), conditions: Optional[str] = None):
+        # Canonical conditions the plan was compiled from
+        self.conditions = conditions
+        self.steps = tuple(sorted(steps, key=lambda step: (OPERATION_ORDER.index(step.operation), step.column)))
+        self.filters = tuple(filters)
+        self.dropped_columns = [step.column for step in self.steps if step.operation == 'drop']
+        # Columns that are never loaded: dropped columns that no row filter needs
+        self.excluded_columns = [
+            column for column in self.dropped_columns if column not in {f.column for f in self.filters}
+        ]
+        self._column_steps = {}
+        for step in self.steps:
+            if step.operation != 'drop':
+                self._column_steps.setdefault(step.column, []).append((step.operation, dict(step.params)))
+        self.digest = hashlib.sha256(json.dumps(self.describe(), sort_keys=True).encode()).hexdigest()
+
+    def __reduce__(self):
+        # Pickled as its conditions (the row filters hold functions): recompiled by the worker processes
+        if self.conditions is None:
+            raise TypeError('Only compiled transform plans can be pickled')
+        return _compile, (self.conditions,)
+
+    @property
+    def is_noop(self) -> bool:
+        return not self.steps and not self.filters
+
+    def column_steps(self, column: str) -> list:
+        # (operation, params) applied to a column that is not dropped, in order
+        return self._column_steps.get(column, [])
+
+    def unmatched_columns(self, columns: Iterable[str]) -> List[str]:
+        # Columns of the steps that are not in columns: their step is a no-op
+        present = set(columns)
+        return sorted({step.column for step in self.steps if step.column not in present})
+
+    def describe(self) -> list:
+        return [[step.operation, step.column, list(step.params)] for step in self.steps] + \
+               [['filter', getattr(predicate, 'expression', repr(predicate))] for predicate in self.filters]
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        # Row filters are evaluated on the original values, before any column is transformed
+        mask = row_mask(self.filters, df)
+        if mask is not None:
+            df = df[mask]
+        dropped = set(self.dropped_columns)
+        columns = {}
+        for column in df.columns:
+            if column in dropped:
+                continue
+            series = df[column]
+            for operation, params in self._column_steps.get(column, ()):
+                series = COLUMN_OPERATIONS[operation](series, params)
+            columns[column] = series
+        return pd.DataFrame(columns, index=df.index, columns=list(columns))
+
+    def apply_arrow(self, table: pa.Table) -> pa.Table:
+        # Arrow version used by the Parquet row group path. Excluded columns are expected to be left out
+        # of the projection already, the dropped columns needed by the row filters are removed here.
+        mask = arrow_row_mask(self.filters, table)
+        if mask is not None:
+            table = table.filter(mask)
+        if any(column in table.column_names for column in self.dropped_columns):
+            table = table.select([column for column in table.column_names if column not in self.dropped_columns])
+        for column, steps in self._column_steps.items():
+            if column not in table.column_names:
+                continue
+            i = table.schema.get_field_index(column)
+            operation, params = steps[-1]
+            if operation == 'null':
+                # Keep the column type, the values become null
+                field = table.field(i).with_nullable(True)
+                table = table.set_column(i, field, pa.nulls(table.num_rows, type=field.type))
+            elif operation == 'mask' and params.get('method', 'mask') == 'mask':
+                table = table.set_column(i, pa.field(column, pa.string()),
+                                         pa.array([params.get('value', MASK_VALUE)] * table.num_rows, pa.string()))
+            else:
+                # Integers with nulls stay integers (not floats formatted as 1.0 by the string operations)
+                series = table.column(i).to_pandas(integer_object_nulls=True)
+                for operation, params in steps:
+                    series = COLUMN_OPERATIONS[operation](series, params)
+                # Explicit type: the schema is computed on an empty table where the type can't be inferred
+                arrow_type = pa.int64() if params.get('method') == 'bucket' else pa.string()
+                table = table.set_column(i, pa.field(column, arrow_type),
+                                         pa.array(series, arrow_type, from_pandas=True))
+        return table
+
+
+def check_columns(plan: TransformPlan, columns: Iterable[str]) -> List[str]:
+    # A step on a column the object doesn't have (eg: a misspelled or renamed column) leaves the data it was meant
+    # to protect untouched: logged and counted so the policy can be fixed
+    unmatched = plan.unmatched_columns(columns)
+    if unmatched:
+        logger.warning(f'Columns {unmatched} of the transform plan {plan.digest} not found in the object')
+        current_metrics().add('UnmatchedColumns', len(unmatched))
+    return unmatched
+
+
+def _canonical_conditions(attrs: Union[dict, list], variables: Optional[Callable[[str], Optional[str]]]) -> str:
+    # Only the transform keys are part of the plan (AuditRequest and friends are not).
+    # Requester variables of the row filters are resolved here so the plan is cached per resolved values.
+    conditions = attrs if isinstance(attrs, list) else [attrs]
+    return json.dumps(
+        [{k: substitute_variables(v, variables) if k == FILTER_KEY else v
+          for k, v in condition.items() if k in TRANSFORM_KEYS} for condition in conditions],
+        sort_keys=True
+    )
+
+
+@lru_cache(maxsize=PLAN_CACHE_SIZE)
+def _compile(conditions: str) -> TransformPlan:
+    steps = []
+    filters = []
+    for condition in json.loads(conditions):
+        for key, rule in condition.items():
+            if key == FILTER_KEY:
+                filters.append(parse_filter(rule))
+                continue
+            operation = TRANSFORM_OPERATIONS[key]
+            columns, params = parse_rule(key, rule)
+            _validate_params(key, operation, params)
+            for column in columns:
+                steps.append(Step(operation, column, tuple(sorted(params.items()))))
+    plan = TransformPlan(steps, filters, conditions)
+    logger.debug(f'Compiled transform plan {plan.digest}: {plan.describe()}')
+    return plan
+
+
+def compile_plan(attrs: Union[dict, list], variables: Optional[Callable[[str], Optional[str]]] = None) -> TransformPlan:
+    # Plans are cached by the content of their conditions: warm invocations that get the same statement from the
+    # authorizer policy cache reuse the compiled plan. variables resolves the requester variables (eg: aws:userid)
+    return _compile(_canonical_conditions(attrs or {}, variables))
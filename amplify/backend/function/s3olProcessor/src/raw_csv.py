@@ -0,0 +1,287 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Iterable, Iterator, List, Optional, Tuple
+from anonymize import MASK_VALUE
+from filters import row_mask
+from ol_metrics import current as current_metrics
+from plan import COLUMN_OPERATIONS, TransformPlan, check_columns
+
+# CSV objects are transformed on their bytes: only the fields of the transformed columns are rewritten, every
+# other byte (quoting, number formats, line endings) is copied as is. 'false' uses the pandas round trip.
+RAW_CSV = os.getenv('RAW_CSV', 'true').lower() == 'true'
+# Records are tokenized in batches of at least RAW_CSV_BATCH_SIZE bytes
+RAW_CSV_BATCH_SIZE = int(os.getenv('RAW_CSV_BATCH_SIZE', str(1024 * 1024)))
+QUOTE = ord('"')
+COMMA = ord(',')
+NEWLINE = ord('\n')
+CR = ord('\r')
+# Characters of the values written in quotes (like the QUOTE_MINIMAL quoting of pandas to_csv)
+QUOTED_CHARACTERS = ('"', ',', '\n', '\r')
+# Action on the fields of a column
+KEEP = 0
+DROP = 1
+REPLACE = 2
+
+
+def _decode(field: bytes) -> str:
+    # Value of a field as read by the CSV parser: enclosing quotes removed and escaped quotes unescaped
+    if len(field) > 1 and field[:1] == b'"' and field[-1:] == b'"':
+        field = field[1:-1].replace(b'""', b'"')
+    return field.decode('utf-8', 'surrogateescape')
+
+
+def _encode(value) -> bytes:
+    # Field of a transformed value, written like pandas to_csv: missing values are empty, quoted when needed
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return b''
+    value = str(value)
+    if any(character in value for character in QUOTED_CHARACTERS):
+        value = '"' + value.replace('"', '""') + '"'
+    return value.encode('utf-8', 'surrogateescape')
+
+
+def _gather(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> bytes:
+    # Concatenation of the segments buffer[start:start + length]
+    offsets = np.cumsum(lengths) - lengths
+    positions = np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+    return buffer[positions].tobytes()
+
+
+def _decode_fields(data: bytes, buffer: np.ndarray, starts: np.ndarray, ends: np.ndarray,
+                   fields: np.ndarray) -> List[str]:
+    # Values of the fields (-1 for a missing field). Without quoted fields there is no newline in the values:
+    # they are decoded at once, joined by newlines.
+    present = fields >= 0
+    field_starts = np.where(present, starts[fields], 0)
+    lengths = np.where(present, ends[fields] - field_starts, 0)
+    if np.any(buffer[field_starts[lengths > 0]] == QUOTE):
+        return ['' if i < 0 else _decode(data[starts[i]:ends[i]]) for i in fields.tolist()]
+    segment_starts = np.stack([field_starts, np.full(len(fields), len(buffer), np.int64)], 1).ravel()
+    segment_lengths = np.stack([lengths, np.ones(len(fields), np.int64)], 1).ravel()
+    joined = _gather(np.append(buffer, np.uint8(NEWLINE)), segment_starts, segment_lengths)
+    return joined.decode('utf-8', 'surrogateescape').split('\n')[:len(fields)]
+
+
+def _encode_values(series: pd.Series) -> Tuple[bytes, np.ndarray, np.ndarray]:
+    # Fields of the transformed values: joined bytes, start and length of each field. The values are encoded at
+    # once (joined by newlines) unless one of them needs quotes.
+    values = series.astype(object).where(series.notna(), '').astype(str).tolist()
+    text = '\n'.join(values)
+    if text.count('\n') != len(values) - 1 or '"' in text or ',' in text or '\r' in text:
+        encoded = [_encode(value) for value in values]
+        lengths = np.fromiter(map(len, encoded), np.int64, len(encoded))
+        return b''.join(encoded), np.cumsum(lengths) - lengths, lengths
+    joined = text.encode('utf-8', 'surrogateescape')
+    newlines = np.flatnonzero(np.frombuffer(joined, np.uint8) == NEWLINE)
+    starts = np.concatenate(([0], newlines + 1))
+    return joined, starts, np.append(newlines, len(joined)) - starts
+
+
+def _constant(steps: list) -> Optional[bytes]:
+    # Output of the operations that don't depend on the value (null, mask with the mask method), None otherwise.
+    # The steps are in OPERATION_ORDER: null and mask come after truncate and hash.
+    operation, params = steps[-1]
+    if operation == 'null':
+        return b''
+    if operation == 'mask' and params.get('method', 'mask') == 'mask':
+        return _encode(params.get('value', MASK_VALUE))
+    return None
+
+
+def _column_names(names: List[str]) -> List[str]:
+    # Names given by pandas read_csv: no byte order mark and duplicates renamed a, a.1, a.2
+    if names:
+        names[0] = names[0].lstrip('\ufeff')
+    seen = {}
+    result = []
+    for name in names:
+        if name in seen:
+            seen[name] += 1
+            name = f'{name}.{seen[name]}'
+        else:
+            seen[name] = 0
+        result.append(name)
+    return result
+
+
+def last_record_end(data: bytes) -> int:
+    # Position after the last newline that is not inside a quoted field, 0 if there is none
+    newline = data.rfind(b'\n')
+    quotes = data.count(b'"', 0, newline) if newline >= 0 else 0
+    while newline >= 0 and quotes & 1:
+        previous = data.rfind(b'\n', 0, newline)
+        quotes -= data.count(b'"', max(previous, 0), newline)
+        newline = previous
+    return newline + 1
+
+
+class CsvRedactor:
+    # Transform plan applied to the records of a CSV object without parsing the untouched values. The delimiters
+    # outside of the quoted fields are located with vectorized operations (a quote toggles the quoted state,
+    # escaped quotes toggle it twice), the output is gathered from the kept byte segments of every field and the
+    # rewritten values. Only the fields of the filtered and transformed columns are decoded.
+    # The first record is the header. Blank lines are copied as is.
+    def __init__(self, plan: TransformPlan):
+        self.plan = plan
+        self.names = None
+
+    def _read_header(self, names: List[str]):
+        self.names = _column_names(names)
+        positions = {}
+        for position, name in enumerate(self.names):
+            positions.setdefault(name, position)
+        # One more action for the fields past the header
+        self.actions = np.full(len(self.names) + 1, KEEP, np.int8)
+        self.constants = {}
+        self.value_columns = {}
+        for column in self.plan.dropped_columns:
+            if column in positions:
+                self.actions[positions[column]] = DROP
+        for name, position in positions.items():
+            steps = self.plan.column_steps(name)
+            if not steps or self.actions[position] == DROP:
+                continue
+            self.actions[position] = REPLACE
+            constant = _constant(steps)
+            if constant is None:
+                self.value_columns[position] = steps
+            else:
+                self.constants[position] = constant
+        self.filter_columns = [(positions[f.column], f.column) for f in self.plan.filters if f.column in positions]
+
+    def rewrite(self, data: bytes) -> Tuple[bytes, int, int]:
+        # Output of whole records (the last one may miss its newline at the end of the object): bytes, rows in, out
+        size = len(data)
+        if not size:
+            return b'', 0, 0
+        buffer = np.frombuffer(data, np.uint8)
+        quoted = np.bitwise_xor.accumulate(buffer == QUOTE)
+        delimiters = np.flatnonzero(((buffer == COMMA) | (buffer == NEWLINE)) & ~quoted)
+        ends = buffer[delimiters] == NEWLINE
+        if not len(delimiters) or delimiters[-1] != size - 1 or not ends[-1]:
+            # Last record without a newline
+            delimiters = np.append(delimiters, size)
+            ends = np.append(ends, True)
+        count = len(delimiters)
+        starts = np.empty(count, np.int64)
+        starts[0] = 0
+        starts[1:] = delimiters[:-1] + 1
+        # The last field of a record ends before the \r of a CRLF
+        content_ends = delimiters.astype(np.int64)
+        content_ends[ends & (delimiters > starts) & (buffer[delimiters - 1] == CR)] -= 1
+        record_starts = np.concatenate(([True], ends[:-1]))
+        first = np.flatnonzero(record_starts)
+        row = np.cumsum(record_starts) - 1
+        column = np.arange(count) - first[row]
+        rows = len(first)
+        blank = (np.diff(np.append(first, count)) == 1) & (content_ends[first] == starts[first])
+        header = np.zeros(rows, bool)
+        if self.names is None:
+            header[0] = True
+            header_end = first[1] if rows > 1 else count
+            self._read_header([_decode(data[starts[i]:content_ends[i]]) for i in range(header_end)])
+        width = len(self.names)
+        records = ~blank & ~header
+        keep = records.copy()
+        if self.plan.filters or self.value_columns:
+            # Field of each (row, column), -1 for the fields missing from short records
+            index = np.full((rows, width), -1, np.int64)
+            in_header = column < width
+            index[row[in_header], column[in_header]] = np.flatnonzero(in_header)
+
+            def values(fields: np.ndarray) -> List[str]:
+                return _decode_fields(data, buffer, starts, content_ends, fields)
+        if self.plan.filters:
+            # Evaluated on the original values, like TransformPlan.apply (no match on the columns not in the header)
+            frame = pd.DataFrame({name: values(index[:, position]) for position, name in self.filter_columns},
+                                 index=range(rows))
+            mask = row_mask(self.plan.filters, frame)
+            keep &= np.asarray(mask, dtype=bool)
+        action = self.actions[np.minimum(column, width)]
+        action[blank[row]] = KEEP
+        action[header[row] & (action == REPLACE)] = KEEP
+        content_starts = starts.copy()
+        content_lengths = content_ends - starts
+        # Bytes appended to the buffer: the separator then the rewritten values
+        extra = [b',']
+        extra_size = 1
+        for position, constant in self.constants.items():
+            fields = (action == REPLACE) & (column == position)
+            content_starts[fields] = size + extra_size
+            content_lengths[fields] = len(constant)
+            extra.append(constant)
+            extra_size += len(constant)
+        for position, steps in self.value_columns.items():
+            fields = index[:, position][keep]
+            fields = fields[fields >= 0]
+            if not len(fields):
+                continue
+            series = pd.Series(values(fields), dtype=object)
+            for operation, params in steps:
+                series = COLUMN_OPERATIONS[operation](series, params)
+            encoded, value_starts, lengths = _encode_values(series)
+            content_starts[fields] = size + extra_size + value_starts
+            content_lengths[fields] = lengths
+            extra.append(encoded)
+            extra_size += len(encoded)
+        kept = action != DROP
+        content_lengths[~kept] = 0
+        # A kept field is preceded by a separator unless it's the first kept field of its record
+        kept_before = np.cumsum(kept) - kept
+        separator_lengths = (kept & (kept_before > kept_before[first][row])).astype(np.int64)
+        terminator_lengths = np.where(ends, np.minimum(delimiters + 1, size) - content_ends, 0)
+        removed = ~(keep | blank | header)[row]
+        separator_lengths[removed] = 0
+        content_lengths[removed] = 0
+        terminator_lengths[removed] = 0
+        # Gather the segments (separator, content, terminator) of every field in order
+        segment_starts = np.stack([np.full(count, size, np.int64), content_starts, content_ends], 1).ravel()
+        segment_lengths = np.stack([separator_lengths, content_lengths, terminator_lengths], 1).ravel()
+        combined = np.concatenate([buffer, np.frombuffer(b''.join(extra), np.uint8)])
+        return _gather(combined, segment_starts, segment_lengths), int(records.sum()), int(keep.sum())
+
+
+def redact_csv(chunks: Iterable[bytes], plan: TransformPlan, rows: Optional[list] = None) -> Iterator[bytes]:
+    # Transformed CSV object. The row counts are added to rows ([in, out]) when given, to the metrics otherwise
+    # (with the columns of the plan missing from the header).
+    metrics = current_metrics()
+    redactor = CsvRedactor(plan)
+
+    def rewrite(data: bytes) -> bytes:
+        header = redactor.names is None
+        with metrics.stage('Transform'):
+            output, rows_in, rows_out = redactor.rewrite(data)
+        if rows is None:
+            if header and redactor.names is not None:
+                check_columns(plan, redactor.names)
+            metrics.add('RowsIn', rows_in)
+            metrics.add('RowsOut', rows_out)
+        else:
+            rows[0] += rows_in
+            rows[1] += rows_out
+        return output
+    parts = []
+    size = 0
+    batch_size = RAW_CSV_BATCH_SIZE
+    for chunk in chunks:
+        parts.append(chunk)
+        size += len(chunk)
+        if size < batch_size:
+            continue
+        data = b''.join(parts)
+        end = last_record_end(data)
+        if end:
+            output = rewrite(data[:end])
+            data = data[end:]
+            batch_size = RAW_CSV_BATCH_SIZE
+            if output:
+                yield output
+        else:
+            # A record longer than the batch
+            batch_size = 2 * size
+        parts = [data]
+        size = len(data)
+    output = rewrite(b''.join(parts))
+    if output:
+        yield output
@@ -0,0 +1,81 @@
+import boto3
+import logging
+import os
+import time
+from botocore.exceptions import ClientError
+from typing import Dict, Optional
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Seconds the IAM tags of a principal are cached by the container
+PRINCIPAL_TAG_CACHE_TTL = float(os.getenv('PRINCIPAL_TAG_CACHE_TTL', '300'))
+# Created on first use: only the requests with a ${aws:PrincipalTag/...} variable call IAM
+iam = None
+# principal ARN -> (loaded at, tags)
+_tag_cache = {}
+
+
+def _principal_name(arn: str) -> (Optional[str], Optional[str]):
+    # arn:aws:iam::123456789012:user/path/name -> ('user', 'name')
+    # arn:aws:sts::123456789012:assumed-role/name/session -> ('role', 'name')
+    resource = arn.split(':', 5)[-1] if arn.count(':') >= 5 else ''
+    parts = resource.split('/')
+    if parts[0] == 'user' and len(parts) > 1:
+        return 'user', parts[-1]
+    if parts[0] == 'assumed-role' and len(parts) > 2:
+        return 'role', parts[1]
+    if parts[0] == 'role' and len(parts) > 1:
+        return 'role', parts[-1]
+    return None, None
+
+
+def get_principal_tags(arn: str) -> Dict[str, str]:
+    cached = _tag_cache.get(arn)
+    if cached and time.time() - cached[0] < PRINCIPAL_TAG_CACHE_TTL:
+        return cached[1]
+    global iam
+    if iam is None:
+        iam = boto3.client('iam')
+    kind, name = _principal_name(arn)
+    tags = {}
+    try:
+        if kind == 'user':
+            paginator = iam.get_paginator('list_user_tags')
+            pages = paginator.paginate(UserName=name)
+        elif kind == 'role':
+            paginator = iam.get_paginator('list_role_tags')
+            pages = paginator.paginate(RoleName=name)
+        else:
+            pages = []
+        for page in pages:
+            tags.update({tag['Key']: tag['Value'] for tag in page.get('Tags', [])})
+    except ClientError as e:
+        logger.exception(e)
+        # Not cached: the next request tries again
+        return {}
+    _tag_cache[arn] = (time.time(), tags)
+    return tags
+
+
+class Requester:
+    # Resolves the policy variables of the requester of an Object Lambda event:
+    #   ${aws:userid}, ${aws:username}, ${aws:PrincipalArn}, ${aws:PrincipalAccount}, ${aws:PrincipalType}
+    #   ${aws:PrincipalTag/<key>} (IAM tags of the user or role, looked up only when a policy uses them)
+    def __init__(self, event: dict):
+        self.identity = event.get('userIdentity', {})
+
+    def __call__(self, name: str) -> Optional[str]:
+        arn = self.identity.get('arn', '')
+        if name == 'aws:userid':
+            return self.identity.get('principalId')
+        if name == 'aws:PrincipalArn':
+            return arn or None
+        if name == 'aws:PrincipalAccount':
+            return self.identity.get('accountId')
+        if name == 'aws:PrincipalType':
+            return self.identity.get('type')
+        if name == 'aws:username':
+            kind, user = _principal_name(arn)
+            return user if kind == 'user' else None
+        if name.startswith('aws:PrincipalTag/') and arn:
+            return get_principal_tags(arn).get(name.split('/', 1)[1])
+        return None
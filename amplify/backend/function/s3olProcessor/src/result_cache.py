@@ -0,0 +1,190 @@
+import hashlib
+import json
+import logging
+import os
+import uuid
+from collections import OrderedDict
+from itertools import chain
+from typing import Iterable, Iterator, Optional, Tuple
+from botocore.exceptions import BotoCoreError, ClientError
+from streaming import READ_CHUNK_SIZE, version_id
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Cache of the transformed objects, keyed by access point, object key, source version, transform plan digest and
+# output format
+RESULT_CACHE = os.getenv('RESULT_CACHE', 'false').lower() == 'true'
+RESULT_CACHE_DIR = os.getenv('RESULT_CACHE_DIR', '/tmp/result-cache')
+# Size of the /tmp tier (least recently used entries are evicted) and of the largest cached result
+RESULT_CACHE_SIZE_MB = float(os.getenv('RESULT_CACHE_SIZE_MB', '256'))
+RESULT_CACHE_MAX_ENTRY_MB = float(os.getenv('RESULT_CACHE_MAX_ENTRY_MB', '64'))
+# Optional shared tier (s3://bucket/prefix/) used by every container. Expire it with a lifecycle rule.
+RESULT_CACHE_S3_PATH = os.getenv('RESULT_CACHE_S3_PATH')
+# Part of every key: change it to invalidate the whole cache (eg: after rotating the anonymization key)
+RESULT_CACHE_VERSION = os.getenv('RESULT_CACHE_VERSION', '1')
+MB = 1024 * 1024
+
+
+def _split_headers(chunks: Iterable[bytes]) -> Tuple[dict, Iterator[bytes]]:
+    # Entries start with a JSON line of the content headers of the result (ContentType, ContentEncoding)
+    chunks = iter(chunks)
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if b'\n' in head:
+            break
+    line, _, rest = head.partition(b'\n')
+    return json.loads(line), chain([rest] if rest else [], chunks)
+
+
+def output_format(object_key: str, headers: dict) -> str:
+    # The transformed object has the format and codec of the source, detected from these headers and the key suffix
+    name = object_key.rsplit('/', 1)[-1].lower()
+    suffix = name.split('.', 1)[1] if '.' in name else ''
+    return f'{headers.get("Content-Type", "")}|{headers.get("Content-Encoding", "")}|{suffix}'
+
+
+class ResultCache:
+    # Two tiers: an LRU directory in /tmp (per container) and an optional S3 prefix (shared).
+    # Results are written to the cache while they are streamed to the client: an entry is only committed once the
+    # whole output has been produced, an interrupted or too large output is discarded.
+    def __init__(self, directory: str = RESULT_CACHE_DIR, size_mb: float = RESULT_CACHE_SIZE_MB,
+                 max_entry_mb: float = RESULT_CACHE_MAX_ENTRY_MB, s3_path: Optional[str] = RESULT_CACHE_S3_PATH,
+                 client=None):
+        self.directory = directory
+        self.max_size = int(size_mb * MB)
+        self.max_entry_size = int(min(max_entry_mb, size_mb) * MB)
+        self.client = client
+        self.bucket, self.prefix = None, ''
+        if s3_path:
+            self.bucket, _, self.prefix = s3_path.replace('s3://', '', 1).partition('/')
+            self.prefix = self.prefix.rstrip('/') + '/' if self.prefix else ''
+        self.size = 0
+        # key -> entry size, least recently used first
+        self._entries = OrderedDict()
+        # Committed entries to copy to the S3 tier once the response has been sent
+        self._pending_uploads = []
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Entries left in /tmp by the previous invocations of a reused execution environment
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.part'):
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self._entries[name] = size
+            self.size += size
+        self._evict(0)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def _evict(self, needed: int):
+        while self._entries and self.size + needed > self.max_size:
+            key, size = self._entries.popitem(last=False)
+            self.size -= size
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def key(self, headers: dict, access_point_arn: str, object_key: str, plan_digest: str) -> Optional[str]:
+        # None when the source can't be identified (no version id nor ETag): the result is not cached.
+        # The version id and the ETag are only unique per object: the access point and the key are part of the key.
+        version = version_id(headers) or headers.get('ETag')
+        if not version:
+            return None
+        parts = (RESULT_CACHE_VERSION, access_point_arn, object_key, version, plan_digest,
+                 output_format(object_key, headers))
+        return hashlib.sha256('\0'.join(parts).encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, dict, Iterator[bytes]]]:
+        # (tier, content headers, chunks) of a cached result or None
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            headers, chunks = _split_headers(self._read_file(self._path(key)))
+            return 'tmp', headers, chunks
+        if self.bucket:
+            try:
+                resp = self.client.get_object(Bucket=self.bucket, Key=self.prefix + key)
+                headers, chunks = _split_headers(resp['Body'].iter_chunks(READ_CHUNK_SIZE))
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                    logger.exception(e)
+                return None
+            except BotoCoreError as e:
+                logger.exception(e)
+                return None
+            # Kept in /tmp for the next requests of this container
+            return 's3', headers, self.store(key, chunks, headers, upload=False)
+        return None
+
+    @staticmethod
+    def _read_file(path: str) -> Iterator[bytes]:
+        with open(path, 'rb') as fp:
+            while True:
+                data = fp.read(READ_CHUNK_SIZE)
+                if not data:
+                    return
+                yield data
+
+    def store(self, key: str, chunks: Iterable[bytes], headers: dict, upload: bool = True) -> Iterator[bytes]:
+        # Yield the chunks unchanged and write them to a cache entry, after the content headers of the result
+        part = self._path(f'{key}.{uuid.uuid4().hex}.part')
+        fp = open(part, 'wb')
+        complete = False
+        try:
+            size = fp.write(json.dumps(headers).encode() + b'\n')
+            for chunk in chunks:
+                if fp is not None:
+                    size += len(chunk)
+                    if size > self.max_entry_size:
+                        # Too large to be cached: keep streaming without writing
+                        fp.close()
+                        os.remove(part)
+                        fp = None
+                    else:
+                        fp.write(chunk)
+                yield chunk
+            complete = True
+        finally:
+            if fp is not None:
+                fp.close()
+                if complete:
+                    self._commit(key, part, size, upload)
+                else:
+                    os.remove(part)
+
+    def _commit(self, key: str, part: str, size: int, upload: bool):
+        self._evict(size)
+        os.replace(part, self._path(key))
+        self._entries[key] = size
+        self.size += size
+        if upload and self.bucket:
+            self._pending_uploads.append(key)
+
+    def upload_pending(self):
+        # Copy the new entries to the S3 tier (called after the response, so the client doesn't wait for it)
+        while self._pending_uploads:
+            key = self._pending_uploads.pop()
+            if key not in self._entries:
+                continue
+            try:
+                with open(self._path(key), 'rb') as fp:
+                    self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=fp)
+            except (BotoCoreError, ClientError, OSError) as e:
+                logger.exception(e)
+
+
+def create_cache(client) -> Optional[ResultCache]:
+    if not RESULT_CACHE:
+        return None
+    try:
+        return ResultCache(client=client)
+    except OSError as e:
+        logger.exception(e)
+        return None
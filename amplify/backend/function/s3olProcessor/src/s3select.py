@@ -0,0 +1,214 @@
+import csv
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import StringIO
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+from urllib.parse import unquote
+from botocore.exceptions import BotoCoreError, ClientError
+from filters import SET_OPERATORS, RowFilter, _to_number
+from formats import CSV, FORMATS, IDENTITY, content_headers, detect_codec, detect_format
+from plan import TransformPlan, check_columns
+
+logger = logging.getLogger('IAM-X_Authorizer')
+# Push RemoveColumn/FilterRows plans down to S3 Select for large uncompressed CSV/JSON Lines objects
+S3_SELECT_PUSHDOWN = os.getenv('S3_SELECT_PUSHDOWN', 'false').lower() == 'true'
+S3_SELECT_MIN_SIZE = int(os.getenv('S3_SELECT_MIN_SIZE', str(64 * 1024 * 1024)))
+# Scan ranges of the JSON Lines objects queried in parallel (also the number of range results held in memory).
+# CSV objects are queried whole: a quoted field can contain a newline, and S3 Select only accepts quoted record
+# delimiters (AllowQuotedRecordDelimiter) without scan ranges.
+S3_SELECT_CONCURRENCY = int(os.getenv('S3_SELECT_CONCURRENCY', '8'))
+PROBE_SIZE = 64 * 1024
+# Operators with the same semantics in S3 Select SQL and in the processor (ordering of the CSV strings differs)
+PUSHDOWN_OPERATORS = ('eq', 'ne', 'in', 'not_in')
+JSONL = FORMATS['jsonl']
+
+
+class SelectQuery(NamedTuple):
+    # select_object_content arguments without ScanRange
+    args: dict
+    size: int
+    # Written before the records (CSV header, S3 Select doesn't output it)
+    header: bytes
+    # ContentType of the output (same format as the object, uncompressed)
+    headers: dict
+    # Query the object by scan ranges (JSON Lines) or whole (CSV)
+    scan_ranges: bool
+
+
+def _identifier(name: str) -> str:
+    return 's."' + name.replace('"', '""') + '"'
+
+
+def _literal(value: str) -> str:
+    return "'" + value.replace("'", "''") + "'"
+
+
+def _predicate(row_filter: RowFilter) -> str:
+    column = _identifier(row_filter.column)
+    if row_filter.operator in SET_OPERATORS:
+        predicate = f'{column} IN ({", ".join(_literal(value) for value in row_filter.values)})'
+        return f'NOT ({predicate})' if row_filter.operator == 'not_in' else predicate
+    return f'{column} {"=" if row_filter.operator == "eq" else "<>"} {_literal(row_filter.values[0])}'
+
+
+def build_sql(plan: TransformPlan, columns: Optional[List[str]]) -> str:
+    projection = ', '.join(_identifier(column) for column in columns) if columns is not None else '*'
+    sql = f'SELECT {projection} FROM s3object s'
+    if plan.filters:
+        sql += ' WHERE ' + ' AND '.join(_predicate(row_filter) for row_filter in plan.filters)
+    return sql
+
+
+def can_push_down(plan: TransformPlan) -> bool:
+    # Only restrictions can be pushed down: the other column operations need the processor
+    return S3_SELECT_PUSHDOWN and not plan.is_noop \
+        and all(step.operation == 'drop' for step in plan.steps) \
+        and all(f.operator in PUSHDOWN_OPERATORS and not f.unresolved for f in plan.filters)
+
+
+def _csv_header(head: bytes) -> Optional[List[str]]:
+    if b'\n' not in head:
+        return None
+    line = head.split(b'\n', 1)[0].decode('utf-8-sig', errors='replace').rstrip('\r')
+    return next(csv.reader([line]), None)
+
+
+def _csv_line(values: List[str]) -> bytes:
+    fp = StringIO()
+    csv.writer(fp, lineterminator='\n').writerow(values)
+    return fp.getvalue().encode()
+
+
+def probe_object(http, s3_url: str):
+    # Response with the first PROBE_SIZE bytes of the object (preloaded), None on error. Its headers are the ones
+    # of the object, so the request can also be served from the result cache or a view without opening the body.
+    probe = http.request('GET', s3_url, headers={'Range': f'bytes=0-{PROBE_SIZE - 1}'})
+    return probe if probe.status in (200, 206) else None
+
+
+def prepare_select(probe, event: dict, plan: TransformPlan) -> Optional[SelectQuery]:
+    # Decide from the first bytes of the object (probe_object) if the plan can run as an S3 Select query.
+    # Returns None when the object must be transformed by the processor.
+    if not can_push_down(plan):
+        return None
+    supporting_ap = event.get('configuration', {}).get('supportingAccessPointArn')
+    url = event.get('userRequest', {}).get('url', '')
+    key = unquote(url.split('?', 1)[0].split('/', 3)[-1]) if url.count('/') >= 3 else ''
+    if not supporting_ap or not key:
+        return None
+    content_range = probe.headers.get('Content-Range', '')
+    size = int(content_range.rsplit('/', 1)[-1]) if '/' in content_range else len(probe.data)
+    if size < S3_SELECT_MIN_SIZE:
+        return None
+    # Scan ranges need an uncompressed object
+    codec = detect_codec(probe.headers.get('Content-Encoding'), key, probe.data)
+    if codec is not IDENTITY:
+        return None
+    data_format = detect_format(probe.headers.get('Content-Type'), key, probe.data, codec)
+    if data_format is CSV:
+        header = _csv_header(probe.data)
+        if not header or any(f.column not in header for f in plan.filters):
+            return None
+        columns = [column for column in header if column not in plan.dropped_columns]
+        if not columns:
+            return None
+        check_columns(plan, header)
+        input_serialization = {'CSV': {'FileHeaderInfo': 'USE', 'AllowQuotedRecordDelimiter': True}}
+        output_serialization = {'CSV': {'QuoteFields': 'ASNEEDED', 'RecordDelimiter': '\n'}}
+        header = _csv_line(columns)
+        scan_ranges = False
+    elif data_format is JSONL and not plan.dropped_columns \
+            and all(_to_number(value) is None for f in plan.filters for value in f.values):
+        # JSON values are typed: only string comparisons behave the same as the processor filters.
+        # Records have no fixed set of keys, so dropping columns can't be expressed as a projection.
+        columns = None
+        input_serialization = {'JSON': {'Type': 'LINES'}}
+        output_serialization = {'JSON': {'RecordDelimiter': '\n'}}
+        header = b''
+        scan_ranges = True
+    else:
+        return None
+    # awswrangler (and its whole dependency tree) is only imported by the requests that are pushed down
+    from awswrangler._utils import parse_path
+    # The supporting access point ARN is accepted as bucket name (s3://arn:...:accesspoint/name/key)
+    bucket, key = parse_path(f's3://{supporting_ap}/{key}')
+    args = {
+        'Bucket': bucket,
+        'Key': key,
+        'Expression': build_sql(plan, columns),
+        'ExpressionType': 'SQL',
+        'RequestProgress': {'Enabled': False},
+        'InputSerialization': dict(input_serialization, CompressionType='NONE'),
+        'OutputSerialization': output_serialization,
+    }
+    logger.debug(f'S3 Select pushdown of {size} bytes: {args["Expression"]}')
+    return SelectQuery(args, size, header, content_headers(codec, data_format, probe.headers), scan_ranges)
+
+
+def _range_results(s3, query: SelectQuery, executor: ThreadPoolExecutor) -> Iterator[bytes]:
+    # Scan ranges are queried in parallel and their records are yielded in the order of the object.
+    # At most S3_SELECT_CONCURRENCY range results are in flight.
+    from awswrangler.s3._select import _gen_scan_range, _select_object_payload
+    pending = deque()
+    try:
+        for scan_range in _gen_scan_range(query.size):
+            pending.append(executor.submit(_select_object_payload, query.args, s3, scan_range))
+            if len(pending) >= S3_SELECT_CONCURRENCY:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def _object_results(s3, query: SelectQuery) -> Iterator[bytes]:
+    # One query over the whole object: the records are yielded as they are received
+    payload = s3.select_object_content(**query.args)['Payload']
+    try:
+        for event in payload:
+            if 'Records' in event:
+                yield event['Records']['Payload']
+    finally:
+        payload.close()
+
+
+def _select_stream(s3, query: SelectQuery) -> Iterator[bytes]:
+    if query.scan_ranges:
+        results = _range_results(s3, query, ThreadPoolExecutor(max_workers=S3_SELECT_CONCURRENCY))
+    else:
+        results = _object_results(s3, query)
+    try:
+        # The first chunk is always yielded, even without records, so the query can be started before streaming
+        yield query.header + next(results, b'')
+        for data in results:
+            if data:
+                yield data
+    finally:
+        results.close()
+
+
+def _started(first: bytes, stream: Iterator[bytes]) -> Iterator[bytes]:
+    try:
+        yield first
+        yield from stream
+    finally:
+        stream.close()
+
+
+def select_object(s3, probe, event: dict, plan: TransformPlan) -> Optional[Tuple[Iterator[bytes], dict]]:
+    # (output, content headers) of the S3 Select query or None when the plan can't be pushed down. probe is the
+    # probe_object response. The first records are queried before returning so an error (eg: S3 Select not
+    # available, missing permission) falls back to the processor.
+    try:
+        query = prepare_select(probe, event, plan)
+        if query is None:
+            return None
+        stream = _select_stream(s3, query)
+        return _started(next(stream), stream), query.headers
+    except (BotoCoreError, ClientError) as e:
+        logger.exception(e)
+        return None
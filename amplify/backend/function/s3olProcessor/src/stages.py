@@ -0,0 +1,109 @@
+import contextvars
+import os
+import queue
+import threading
+import time
+from typing import Callable, Iterable, Iterator, Optional
+from ol_metrics import current as current_metrics
+
+# Chunks buffered between two concurrent stages of the transform pipeline (upstream reader, transform and
+# response body). It caps the memory of the chunks in flight. 0 runs the whole pipeline in the handler thread.
+PIPELINE_QUEUE_SIZE = int(os.getenv('PIPELINE_QUEUE_SIZE', '4'))
+# Interval at which a blocked producer checks if the consumer is gone
+STOP_POLL_INTERVAL = 0.05
+# Time given to the producer of a stage to stop once its consumer is gone. A producer still running after it
+# (eg: blocked in a read that can't be interrupted) is left to finish in the background.
+PIPELINE_STOP_TIMEOUT = float(os.getenv('PIPELINE_STOP_TIMEOUT', '1'))
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def concurrent_stage(iterable: Iterable, name: str, size: int = PIPELINE_QUEUE_SIZE,
+                     abort: Optional[Callable[[], None]] = None) -> Iterator:
+    # Iterate over iterable in a thread, at most size items ahead of the consumer. The network reads, zlib and
+    # parts of the pandas parser release the GIL, so the stages on both sides of the queue overlap.
+    # abort interrupts the producer when the consumer stops early (eg: closes the upstream response it reads).
+    if size <= 0:
+        return iter(iterable)
+    return _stage(iterable, name, size, abort)
+
+
+def _stage(iterable: Iterable, name: str, size: int, abort: Optional[Callable[[], None]]) -> Iterator:
+    # Metrics: maximum queue depth, time the producer waited for room in the queue (the consumer is the
+    # bottleneck) and time the consumer waited for an item (the producer is the bottleneck)
+    metrics = current_metrics()
+    items = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    stalls = {'Producer': 0.0, 'Consumer': 0.0}
+
+    def put(item) -> bool:
+        started = time.perf_counter()
+        try:
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=STOP_POLL_INTERVAL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+        finally:
+            stalls['Producer'] += time.perf_counter() - started
+
+    def produce():
+        iterator = iter(iterable)
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+            put(_DONE)
+        except BaseException as e:
+            put(_Failure(e))
+        finally:
+            # The generators of the stage are closed by the thread that runs them
+            close = getattr(iterator, 'close', None)
+            if close:
+                close()
+
+    # The stage thread records its timings in the metrics of the request
+    thread = threading.Thread(target=contextvars.copy_context().run, args=(produce,), name=f'{name}Stage', daemon=True)
+    thread.start()
+    max_depth = 0
+    finished = False
+    try:
+        while True:
+            depth = items.qsize()
+            max_depth = max(max_depth, depth)
+            if depth:
+                item = items.get()
+            else:
+                started = time.perf_counter()
+                item = items.get()
+                stalls['Consumer'] += time.perf_counter() - started
+            if item is _DONE:
+                finished = True
+                return
+            if isinstance(item, _Failure):
+                finished = True
+                raise item.error
+            yield item
+    finally:
+        stop.set()
+        if not finished and abort is not None:
+            # The producer may be blocked in a read until its timeout
+            abort()
+        deadline = time.perf_counter() + PIPELINE_STOP_TIMEOUT
+        while thread.is_alive() and time.perf_counter() < deadline:
+            # Unblock the producer and drop the chunks it produced
+            try:
+                while True:
+                    items.get_nowait()
+            except queue.Empty:
+                pass
+            thread.join(STOP_POLL_INTERVAL)
+        metrics.add(f'{name}QueueDepthMax', max_depth)
+        for side, seconds in stalls.items():
+            metrics.add(f'{name}{side}StallTime', round(seconds * 1000, 3), 'Milliseconds')
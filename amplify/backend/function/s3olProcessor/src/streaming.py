@@ -0,0 +1,183 @@
+import io
+import re
+import os
+import socket
+from typing import Iterable, Iterator, Optional, Tuple
+from ol_metrics import current as current_metrics
+
+STREAM_CHUNK_ROWS = int(os.getenv('STREAM_CHUNK_ROWS', '50000'))
+READ_CHUNK_SIZE = int(os.getenv('READ_CHUNK_SIZE', str(1024 * 1024)))
+
+
+class IterStream(io.RawIOBase):
+    # File-like object backed by an iterator of bytes chunks.
+    # botocore reads the request Body through read()/readinto(), so wrapping a generator with this class lets
+    # write_get_object_response send the transformed object while it is still being produced.
+    def __init__(self, chunks: Iterable[bytes]):
+        self._chunks = iter(chunks)
+        # Current chunk and read offset: the reads are copied out of a memoryview, the chunk is never sliced
+        self._chunk = memoryview(b'')
+        self._offset = 0
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while self._offset >= len(self._chunk):
+            try:
+                self._chunk = memoryview(next(self._chunks)).cast('B')
+            except StopIteration:
+                return 0
+            self._offset = 0
+        size = min(len(b), len(self._chunk) - self._offset)
+        b[:size] = self._chunk[self._offset:self._offset + size]
+        self._offset += size
+        self.bytes_read += size
+        return size
+
+    def close(self):
+        # Drop the current chunk and run the generator's finally block to release the upstream connection
+        self._chunk = memoryview(b'')
+        close = getattr(self._chunks, 'close', None)
+        if close:
+            close()
+        super().close()
+
+
+def version_id(headers) -> Optional[str]:
+    # Version id of the object of an S3 response. S3 returns 'null' for every object of a bucket whose versioning
+    # is suspended or was enabled after the object was written: it doesn't identify the object.
+    value = headers.get('x-amz-version-id')
+    return None if not value or value == 'null' else value
+
+
+def iter_body(response, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    # Yield the body of a urllib3 response opened with preload_content=False and release the connection when done
+    try:
+        for chunk in response.stream(chunk_size, decode_content=False):
+            if chunk:
+                yield chunk
+    finally:
+        response.release_conn()
+
+
+def abort_response(response):
+    # Interrupt a read of the response blocked in another thread: shutting the socket down wakes the reader up
+    # (closing it doesn't), then the connection is closed instead of going back to the pool
+    sock = getattr(response.connection, 'sock', None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+class RangedHttpFile(io.RawIOBase):
+    # Seekable read-only file over an HTTP URL (eg: the presigned inputS3Url).
+    # Every read is served with a Range request, so readers that need random access (Parquet footer and column
+    # chunks) only download the byte ranges they actually use.
+    def __init__(self, http, url: str, size: int):
+        self._http = http
+        self._url = url
+        self._size = size
+        self._position = 0
+        self.requests = 0
+        self.bytes_read = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def size(self) -> int:
+        return self._size
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        elif whence == io.SEEK_END:
+            self._position = self._size + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        return self._position
+
+    def readinto(self, b) -> int:
+        size = min(len(b), self._size - self._position)
+        if size <= 0:
+            return 0
+        end = self._position + size - 1
+        with current_metrics().stage('Fetch'):
+            response = self._http.request('GET', self._url, headers={'Range': f'bytes={self._position}-{end}'},
+                                          preload_content=False)
+            try:
+                self.requests += 1
+                if response.status not in (200, 206):
+                    raise IOError(f'Unable to read bytes {self._position}-{end}: HTTP {response.status}')
+                if response.status == 200:
+                    # Server ignored the Range header
+                    data = response.read()[self._position:end + 1]
+                    read = len(data)
+                    b[:read] = data
+                else:
+                    # The range is received directly in the buffer of the reader (eg: a pyarrow column chunk)
+                    view = memoryview(b).cast('B')
+                    read = 0
+                    while read < size:
+                        count = response.readinto(view[read:size])
+                        if not count:
+                            break
+                        read += count
+            finally:
+                response.release_conn()
+        self._position += read
+        self.bytes_read += read
+        return read
+
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def parse_range(value: str) -> Optional[Tuple[Optional[int], Optional[int]]]:
+    # Single byte range: "bytes=first-last", "bytes=first-" or "bytes=-suffix_length".
+    # Returns (first, last), (first, None) or (None, suffix_length). Unsupported ranges return None
+    # and the whole object is served, as S3 does for multiple ranges.
+    match = RANGE_PATTERN.match(value.strip())
+    if not match or not (match[1] or match[2]):
+        return None
+    first = int(match[1]) if match[1] else None
+    last = int(match[2]) if match[2] else None
+    if first is not None and last is not None and last < first:
+        return None
+    return first, last
+
+
+def read_range(chunks: Iterable[bytes], first: Optional[int], last: Optional[int]) -> (bytes, int, int, int):
+    # Keep only the requested range of a stream whose length is not known in advance.
+    # The whole stream is consumed to report its total length, but only the requested bytes are held in memory.
+    # Returns (data, first, last, total); first > last when the range is not satisfiable.
+    total = 0
+    data = bytearray()
+    if first is None:
+        # Suffix range: keep a rolling window with the last bytes
+        for chunk in chunks:
+            total += len(chunk)
+            data += chunk
+            if len(data) > last:
+                del data[:len(data) - last]
+        return bytes(data), total - len(data), total - 1, total
+    for chunk in chunks:
+        offset = total
+        total += len(chunk)
+        begin = max(first - offset, 0)
+        end = len(chunk) if last is None else min(last + 1 - offset, len(chunk))
+        if begin < end:
+            data += chunk[begin:end]
+    return bytes(data), first, first + len(data) - 1, total
@@ -0,0 +1,49 @@
+import hashlib
+import hmac
+import pandas as pd
+import pytest
+from anonymize import anonymize, get_anonymization_key
+
+VALUES = pd.Series(['123-45-6789', '', None, 'ab', '123-45-6789'])
+
+
+def test_partial_keeps_the_separators_and_the_last_characters():
+    result = anonymize(VALUES, {'method': 'partial', 'keep_last': '4'})
+    assert result[[0, 1, 3]].tolist() == ['***-**-6789', '', 'ab']
+    assert pd.isna(result[2])
+
+
+def test_hmac_tokens_are_deterministic_and_keyed():
+    result = anonymize(VALUES, {'method': 'hmac'})
+    expected = hmac.new(get_anonymization_key(), b'123-45-6789', hashlib.sha256).hexdigest()
+    assert result[0] == result[4] == expected
+    assert result[3] != expected
+    assert pd.isna(result[1]) and pd.isna(result[2])
+
+
+@pytest.mark.parametrize('buckets', ['1', '4'])
+def test_bucket(buckets):
+    result = anonymize(VALUES, {'method': 'bucket', 'buckets': buckets})
+    assert result[0] == result[4]
+    assert all(0 <= value < int(buckets) for value in result[[0, 3, 4]])
+    assert pd.isna(result[1]) and pd.isna(result[2])
+
+
+def test_date_generalization():
+    dates = pd.Series(['2021-08-03', '', None, 'not a date'])
+    result = anonymize(dates, {'method': 'date', 'granularity': 'quarter'})
+    assert result[0] == '2021Q3'
+    assert result[1:].isna().all()
+
+
+def test_mask():
+    assert anonymize(VALUES, {}).tolist() == ['***'] * 5
+    assert anonymize(VALUES, {'value': 'x'}).tolist() == ['x'] * 5
+
+
+@pytest.mark.parametrize('series', [
+    pd.Series([], dtype='int64'), pd.Series([], dtype='datetime64[ns]'), pd.Series([1, 22], dtype='int64')
+])
+@pytest.mark.parametrize('params', [{'method': 'partial', 'keep_last': '1'}, {'method': 'hmac'}, {}])
+def test_non_string_columns_give_object_columns(series, params):
+    assert anonymize(series, params).dtype == object
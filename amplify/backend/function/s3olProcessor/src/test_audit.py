@@ -0,0 +1,47 @@
+import audit
+from audit import AuditPipeline
+
+
+class ListSink:
+    def __init__(self):
+        self.batches = []
+
+    def write(self, records):
+        self.batches.append(list(records))
+
+
+class FailingSink:
+    def write(self, records):
+        raise RuntimeError('unavailable')
+
+
+def test_records_are_batched_across_invocations(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(audit.time, 'monotonic', lambda: now[0])
+    sink = ListSink()
+    pipeline = AuditPipeline([sink], batch_size=3, flush_interval=60)
+    for i in range(2):
+        pipeline.submit({'n': i})
+        assert pipeline.flush_if_due() == 0
+    assert sink.batches == []
+    # Full batch
+    pipeline.submit({'n': 2})
+    assert sink.batches == [[{'n': 0}, {'n': 1}, {'n': 2}]]
+    # The age is counted from the oldest buffered record
+    now[0] += 100
+    pipeline.submit({'n': 3})
+    now[0] += 59
+    pipeline.submit({'n': 4})
+    assert pipeline.flush_if_due() == 0
+    now[0] += 1
+    assert pipeline.flush_if_due() == 0
+    assert sink.batches[1:] == [[{'n': 3}, {'n': 4}]]
+
+
+def test_undelivered_records_are_counted():
+    pipeline = AuditPipeline([ListSink(), FailingSink()], flush_interval=0)
+    pipeline.submit({'n': 0})
+    pipeline.submit({'n': 1})
+    assert pipeline.flush_if_due() == 2
+    assert pipeline.flush_if_due() == 0
+    assert pipeline.dropped == 2
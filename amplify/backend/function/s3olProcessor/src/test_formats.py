@@ -0,0 +1,47 @@
+import formats
+import io
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+from formats import CODECS, CSV, IDENTITY, PARQUET, transform_stream
+from plan import compile_plan
+
+GZIP = CODECS['gzip']
+
+
+def parquet_file(table: pa.Table) -> bytes:
+    sink = io.BytesIO()
+    pq.write_table(table, sink)
+    return sink.getvalue()
+
+
+def transform(codec, data_format, data: bytes, attrs: dict) -> bytes:
+    # The output is compressed with the codec of the source (the input chunks are the decompressed source)
+    plan = compile_plan(attrs)
+    output = transform_stream(codec, data_format, [data], plan.apply, plan.excluded_columns)
+    return b''.join(codec.decompress(output))
+
+
+@pytest.mark.parametrize('data, expected', [(b'a,b\n', b'a\n'), (b'a,b', b'a\n'), (b'', b'')])
+def test_csv_without_rows(data, expected):
+    assert transform(GZIP, CSV, data, {'RemoveColumn': 'column_name=b'}) == expected
+
+
+@pytest.mark.parametrize('attrs, columns', [
+    ({'RemoveColumn': 'column_name=b'}, ['a']),
+    ({'FilterRows': 'column_name=a;value=x'}, ['a', 'b']),
+])
+def test_parquet_without_rows(attrs, columns):
+    data = parquet_file(pa.table({'a': pa.array([], pa.int64()), 'b': pa.array([], pa.string())}))
+    table = pq.read_table(io.BytesIO(transform(GZIP, PARQUET, data, attrs)))
+    assert table.num_rows == 0
+    assert table.column_names == columns
+    assert table.schema.field('a').type == pa.int64()
+
+
+def test_parquet_first_frames_filtered_out(monkeypatch):
+    # The schema is taken from the first frame with rows
+    monkeypatch.setattr(formats, 'STREAM_CHUNK_ROWS', 2)
+    data = parquet_file(pa.table({'a': pa.array(range(5), pa.int64()), 'b': pa.array(list('vwxyz'))}))
+    output = transform(IDENTITY, PARQUET, data, {'FilterRows': 'column_name=a;operator=gt;value=2'})
+    assert pq.read_table(io.BytesIO(output)).to_pydict() == {'a': [3, 4], 'b': ['y', 'z']}
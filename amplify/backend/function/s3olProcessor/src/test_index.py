@@ -0,0 +1,135 @@
+import index
+import pytest
+import s3select
+
+DATA = b'a,b\n1,2\n3,4\n'
+HEADERS = {'Content-Type': 'text/csv', 'Content-Length': str(len(DATA)), 'ETag': '"etag"'}
+
+
+def event(url: str) -> dict:
+    return {
+        'xAmzRequestId': 'request',
+        'getObjectContext': {'inputS3Url': 'https://bucket.s3.amazonaws.com/key', 'outputRoute': 'route',
+                             'outputToken': 'token'},
+        'configuration': {'accessPointArn': 'arn:aws:s3-object-lambda:us-east-1:111122223333:accesspoint/olap',
+                          'supportingAccessPointArn': 'arn:aws:s3:us-east-1:111122223333:accesspoint/ap'},
+        'userRequest': {'url': url, 'headers': {}},
+        'userIdentity': {'type': 'IAMUser', 'accountId': '111122223333'},
+    }
+
+
+class Response:
+    # urllib3 response of the source object
+    def __init__(self, data: bytes, headers: dict, status: int = 200):
+        self.data = data
+        self.headers = headers
+        self.status = status
+        self.connection = None
+        self._position = 0
+
+    def stream(self, chunk_size, decode_content=False):
+        while self._position < len(self.data):
+            chunk = self.data[self._position:self._position + chunk_size]
+            self._position += len(chunk)
+            yield chunk
+
+    def tell(self) -> int:
+        return self._position
+
+    def release_conn(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Http:
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url, headers=None, **kwargs):
+        self.requests.append(dict(headers or {}))
+        if headers and 'Range' in headers:
+            size = min(s3select.PROBE_SIZE, len(DATA))
+            return Response(DATA[:size], dict(HEADERS, **{'Content-Range': f'bytes 0-{size - 1}/{len(DATA)}'}), 206)
+        return Response(DATA, HEADERS)
+
+
+@pytest.fixture
+def responses(monkeypatch):
+    sent = []
+
+    def write_response(event, **args):
+        if 'Body' in args:
+            args['Body'] = args['Body'].read()
+        sent.append(args)
+    monkeypatch.setattr(index, 'write_response', write_response)
+    monkeypatch.setattr(index, 'authorize_request', lambda event: ('Allow', {}, []))
+    monkeypatch.setattr(index, 'passthrough', lambda event, record: sent.append({'StatusCode': 200}))
+    return sent
+
+
+@pytest.fixture
+def http(monkeypatch):
+    http = Http()
+    monkeypatch.setattr(index, 'http', http)
+    monkeypatch.setattr(index, 'authorize_request', lambda event: ('Allow', {'RemoveColumn': 'column_name=b'}, []))
+    monkeypatch.setattr(s3select, 'S3_SELECT_PUSHDOWN', True)
+    return http
+
+
+@pytest.mark.parametrize('path', ['_views/digest/secret/a.csv', '_views%2Fdigest%2Fa.csv', '/_views/digest/a.csv'])
+def test_views_are_not_served_by_their_key(responses, path):
+    index.handler(event(f'https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/{path}'), None)
+    assert responses == [{'StatusCode': 403, 'ErrorCode': 'AccessDenied',
+                          'ErrorMessage': 'S3 Object Lambda Policy Explicit denied'}]
+
+
+def test_other_keys_are_authorized(responses):
+    index.handler(event('https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/data/_views/a.csv'), None)
+    assert responses == [{'StatusCode': 200}]
+
+
+def test_pushed_down_requests_dont_open_the_object(responses, http, monkeypatch):
+    monkeypatch.setattr(s3select, 'select_object',
+                        lambda s3, probe, event, plan: (iter([b'a\n1\n3\n']), {'ContentType': 'text/csv'}))
+    index.handler(event('https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/a.csv'), None)
+    assert http.requests == [{'Range': f'bytes=0-{s3select.PROBE_SIZE - 1}'}]
+    assert responses[0]['Body'] == b'a\n1\n3\n'
+
+
+def test_object_is_opened_when_the_query_cant_be_used(responses, http, monkeypatch):
+    # Object smaller than S3_SELECT_MIN_SIZE
+    index.handler(event('https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/a.csv'), None)
+    assert http.requests == [{'Range': f'bytes=0-{s3select.PROBE_SIZE - 1}'}, {}]
+    assert responses[0]['Body'] == b'a\n1\n3\n'
+
+
+class Cache:
+    # Result cache holding the output of every key that was stored
+    def __init__(self):
+        self.entries = {}
+
+    def key(self, headers, access_point_arn, object_key, plan_digest):
+        return f'{headers["ETag"]}{object_key}{plan_digest}'
+
+    def get(self, key):
+        return ('tmp', {'ContentType': 'text/csv'}, iter([self.entries[key]])) if key in self.entries else None
+
+    def store(self, key, chunks, headers):
+        data = b''.join(chunks)
+        self.entries[key] = data
+        return iter([data])
+
+    def upload_pending(self):
+        pass
+
+
+def test_result_cache_uses_the_headers_of_the_object_response(responses, http, monkeypatch):
+    # One GET per request: the cache is looked up with the headers of the response that is transformed on a miss
+    monkeypatch.setattr(s3select, 'S3_SELECT_PUSHDOWN', False)
+    monkeypatch.setattr(index, 'result_cache', Cache())
+    for _ in range(2):
+        index.handler(event('https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/a.csv'), None)
+    assert http.requests == [{}, {}]
+    assert [response['Body'] for response in responses] == [b'a\n1\n3\n'] * 2
@@ -0,0 +1,84 @@
+import pytest
+from parallel_csv import QUOTE, _transform_range, read_header, record_end
+from plan import compile_plan
+from raw_csv import redact_csv
+
+ROWS = [
+    'id,"na\nme",notes',
+    '1,alice,"a ""quoted"" value"',
+    '2,"bob\nsmith","x,\ny"',
+    '3,"""",""',
+    '4,"ends with a quote""","\n"',
+    '5,carol,',
+]
+
+
+class Pipe:
+    # Worker end of the pipe: keeps the chunks sent to the parent
+    def __init__(self):
+        self.chunks = []
+
+    def send(self, message):
+        kind, _, chunk = message
+        assert kind == 'chunk'
+        self.chunks.append(chunk)
+
+
+class Source:
+    # RangedHttpFile of the object, positioned at the end of the range of the worker
+    def __init__(self, data: bytes, position: int):
+        self.data = data
+        self.position = position
+
+    def tell(self) -> int:
+        return self.position
+
+    def size(self) -> int:
+        return len(self.data)
+
+    def read(self, size: int) -> bytes:
+        chunk = self.data[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+
+def transform_ranges(data: bytes, plan, range_size: int) -> bytes:
+    # Protocol of ParallelCsvTransform without the processes: the parity of a range is the parity of the quote
+    # counts of the ranges before it
+    header = read_header([data])
+    output = []
+    parity = 0
+    for index, first in enumerate(range(0, len(data), range_size)):
+        last = min(first + range_size, len(data))
+        begin = max(first - 1, 0)
+        pipe = Pipe()
+        _transform_range(pipe, Source(data, last), index, data[begin:last], first - begin, parity, header, plan)
+        output.extend(pipe.chunks)
+        parity ^= data.count(QUOTE, first, last) & 1
+    return b''.join(output)
+
+
+def test_record_end():
+    assert record_end(b'a,b\nc') == 4
+    assert record_end(b'"a\nb",c\nd') == 8
+    assert record_end(b'"a""\nb"\n') == 8
+    assert record_end(b'a\nb', 2) is None
+    # The same bytes end a record at a different newline depending on the quotes before offset
+    assert record_end(b'a\nb"\nc"\nd', 2) == 8
+    assert record_end(b'a\nb"\nc"\nd', 2, 1) == 5
+
+
+@pytest.mark.parametrize('terminator', ['\n', '\r\n'])
+@pytest.mark.parametrize('trailing', [True, False])
+@pytest.mark.parametrize('attrs', [
+    {'RemoveColumn': 'column_name=notes'},
+    {'HashData': 'column_name=id'},
+    {'FilterRows': 'column_name=id;operator=ne;value=2', 'RemoveData': 'column_name=na\nme'},
+])
+def test_ranges_split_inside_quoted_fields(terminator, trailing, attrs):
+    data = (terminator.join(ROWS * 20) + (terminator if trailing else '')).encode()
+    plan = compile_plan(attrs)
+    serial = b''.join(redact_csv([data], plan))
+    # Every range boundary position falls in a quoted field, an escaped quote or a line ending for some size
+    for range_size in (1, 2, 3, 5, 7, 11, 64, 997, len(data)):
+        assert transform_ranges(data, plan, range_size) == serial, range_size
@@ -0,0 +1,70 @@
+import pandas as pd
+import pytest
+from plan import TransformPlanError, check_columns, compile_plan
+
+
+@pytest.mark.parametrize('attrs, error', [
+    ({'RemoveColumn': 'name'}, 'Expected key=value'),
+    ({'RemoveColumn': 'length=4'}, 'Missing column_name'),
+    ({'RemoveColumn': 'column_name= , '}, 'Missing column_name'),
+    ({'RemoveColumn': 'column_name=a;length=4'}, 'Unknown parameters'),
+    ({'TruncateData': 'column_name=a'}, 'length must be a non negative integer'),
+    ({'TruncateData': 'column_name=a;length=-1'}, 'length must be a non negative integer'),
+    ({'AnonymizeData': 'column_name=a;method=rot13'}, 'method must be one of'),
+    ({'AnonymizeData': 'column_name=a;method=bucket;buckets=0'}, 'buckets must be a positive integer'),
+    ({'AnonymizeData': 'column_name=a;method=partial'}, 'keep_last must be a non negative integer'),
+    ({'AnonymizeData': 'column_name=a;method=date;granularity=hour'}, 'granularity must be one of'),
+    ({'FilterRows': 'column_name=a;operator=like;value=x'}, 'operator must be one of'),
+    ({'FilterRows': 'column_name=a;operator=eq'}, 'Missing value'),
+    ({'FilterRows': 'column_name=a,b;value=x'}, 'Only one column_name is allowed'),
+    ({'FilterRows': 'column_name=a;value=x;length=2'}, 'Unknown parameters'),
+    ([{'RemoveColumn': 'column_name=a'}, {'HashData': 'a'}], 'Expected key=value'),
+])
+def test_invalid_conditions(attrs, error):
+    with pytest.raises(TransformPlanError, match=error):
+        compile_plan(attrs)
+
+
+def test_steps_are_ordered_per_column():
+    plan = compile_plan({'HashData': 'column_name=b,a', 'TruncateData': 'column_name=a;length=2',
+                         'RemoveColumn': 'column_name=c', 'RemoveData': 'column_name=d'})
+    assert [(step.operation, step.column) for step in plan.steps] == [
+        ('truncate', 'a'), ('hash', 'a'), ('hash', 'b'), ('null', 'd'), ('drop', 'c')]
+    assert plan.column_steps('a') == [('truncate', {'length': '2'}), ('hash', {})]
+    assert plan.column_steps('c') == []
+    assert plan.dropped_columns == plan.excluded_columns == ['c']
+
+
+def test_list_conditions_combine_transform_keys():
+    plan = compile_plan([{'HashData': 'column_name=a', 'TruncateData': 'column_name=a;length=2'},
+                         {'RemoveColumn': 'column_name=b', 'AnonymizeData': 'column_name=c'}])
+    assert [step.operation for step in plan.steps] == ['truncate', 'hash', 'mask', 'drop']
+
+
+def test_plans_are_cached_by_their_transform_keys():
+    plan = compile_plan({'RemoveColumn': 'column_name=a', 'AuditRequest': 'true'})
+    assert compile_plan({'RemoveColumn': 'column_name=a'}) is plan
+    assert compile_plan([{'RemoveColumn': 'column_name=a'}]) is plan
+    assert compile_plan({'RemoveColumn': 'column_name=b'}).digest != plan.digest
+    assert compile_plan({}).is_noop
+
+
+def test_dropped_column_needed_by_a_filter_is_loaded():
+    plan = compile_plan({'RemoveColumn': 'column_name=region,name', 'FilterRows': 'column_name=region;value=eu'})
+    assert plan.excluded_columns == ['name']
+    df = pd.DataFrame({'id': ['1', '2'], 'region': ['eu', 'us'], 'name': ['x', 'y']})
+    assert plan.apply(df).to_dict('list') == {'id': ['1']}
+
+
+def test_requester_variables_are_resolved_before_caching():
+    attrs = {'FilterRows': 'column_name=owner;value=${aws:username}'}
+    alice = compile_plan(attrs, {'aws:username': 'alice'}.get)
+    assert compile_plan(attrs, {'aws:username': 'bob'}.get).digest != alice.digest
+    df = pd.DataFrame({'owner': ['alice', 'bob']})
+    assert alice.apply(df).to_dict('list') == {'owner': ['alice']}
+
+
+def test_unmatched_columns_are_reported():
+    plan = compile_plan({'RemoveColumn': 'column_name=ssn,SSN ', 'HashData': 'column_name=name'})
+    assert plan.unmatched_columns(['ssn', 'name']) == ['SSN']
+    assert check_columns(plan, ['id']) == ['SSN', 'name', 'ssn']
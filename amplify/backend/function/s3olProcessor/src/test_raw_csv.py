@@ -0,0 +1,96 @@
+import io
+import pandas as pd
+import pytest
+import raw_csv
+from formats import CSV, IDENTITY, transform_stream
+from plan import compile_plan
+from raw_csv import redact_csv
+
+PLANS = [
+    {'RemoveColumn': 'column_name=name'},
+    {'RemoveColumn': 'column_name=id,dob,amount, usd'},
+    {'RemoveData': 'column_name=name,dob'},
+    {'AnonymizeData': 'column_name=ssn;method=partial;keep_last=4'},
+    {'AnonymizeData': 'column_name=name;method=hmac'},
+    {'AnonymizeData': 'column_name=dob;method=date;granularity=quarter'},
+    {'HashData': 'column_name=name', 'TruncateData': 'column_name=ssn;length=3'},
+    {'FilterRows': 'column_name=region;value=eu', 'RemoveColumn': 'column_name=region'},
+    {'FilterRows': 'column_name=id;operator=gt;value=3', 'AnonymizeData': 'column_name=name;value=x,y'},
+    {'FilterRows': 'column_name=missing;value=eu'},
+]
+ROWS = [
+    'id,name,region,ssn,"amount, usd",dob',
+    '1,alice,eu,123-45-6789,10,2021-02-11',
+    '2,"smith, ""bob""",us,223-45-6789,,2021-05-12',
+    '3,"multi\nline",eu,323-45-6789,007,2021-08-13',
+    '4,,us,423-45-6789,"1,5",2021-09-14',
+    '5,"",eu,,-3,',
+]
+
+
+def pandas_output(data: bytes, plan) -> bytes:
+    return b''.join(transform_stream(IDENTITY, CSV, [data], plan.apply, plan.excluded_columns))
+
+
+def raw_output(data: bytes, plan, chunk_size: int = 0) -> bytes:
+    chunks = [data[i:i + chunk_size] for i in range(0, len(data), chunk_size)] if chunk_size else [data]
+    return b''.join(redact_csv(chunks, plan))
+
+
+def frame(data: bytes) -> pd.DataFrame:
+    return pd.read_csv(io.BytesIO(data), dtype=str, keep_default_na=False)
+
+
+@pytest.mark.parametrize('attrs', PLANS)
+@pytest.mark.parametrize('terminator', ['\n', '\r\n'])
+@pytest.mark.parametrize('trailing', [True, False])
+@pytest.mark.parametrize('chunk_size', [0, 7])
+def test_same_records_as_pandas(monkeypatch, attrs, terminator, trailing, chunk_size):
+    # Small batches: records are split across chunks and batches
+    monkeypatch.setattr(raw_csv, 'RAW_CSV_BATCH_SIZE', 16)
+    data = (terminator.join(ROWS) + (terminator if trailing else '')).encode()
+    plan = compile_plan(attrs)
+    assert frame(raw_output(data, plan, chunk_size)).equals(frame(pandas_output(data, plan)))
+
+
+def test_untouched_bytes_are_copied():
+    data = b'a,b,c\r\n007,"x,""y""",1.50\r\n\r\n008,z,2.0'
+    assert raw_output(data, compile_plan({'RemoveData': 'column_name=b'})) == b'a,b,c\r\n007,,1.50\r\n\r\n008,,2.0'
+    assert raw_output(data, compile_plan({'RemoveColumn': 'column_name=c'})) == b'a,b\r\n007,"x,""y"""\r\n\r\n008,z'
+
+
+@pytest.mark.parametrize('attrs', [{'RemoveColumn': 'column_name=a'}, {'HashData': 'column_name=a'}])
+def test_byte_order_mark(attrs):
+    data = b'\xef\xbb\xbfa,b,c\n1,2,3\n'
+    plan = compile_plan(attrs)
+    assert frame(raw_output(data, plan)).equals(frame(pandas_output(data, plan)))
+
+
+def test_duplicate_headers():
+    # Matched by their pandas names (a, a.1), the kept header fields are copied as is
+    data = b'a,a,b\n1,2,3\n'
+    plan = compile_plan({'RemoveData': 'column_name=a.1'})
+    assert raw_output(data, plan) == b'a,a,b\n1,,3\n'
+    assert frame(raw_output(data, plan)).values.tolist() == frame(pandas_output(data, plan)).values.tolist()
+    assert raw_output(data, compile_plan({'RemoveColumn': 'column_name=a'})) == b'a,b\n2,3\n'
+
+
+@pytest.mark.parametrize('attrs', [{'RemoveData': 'column_name=b'}, {'RemoveColumn': 'column_name=c'},
+                                   {'FilterRows': 'column_name=c;value=6'}])
+def test_short_rows(attrs):
+    data = b'a,b,c\n1,2\n4,5,6\n'
+    plan = compile_plan(attrs)
+    assert frame(raw_output(data, plan)).equals(frame(pandas_output(data, plan)))
+
+
+def test_fields_past_the_header_are_kept():
+    # pandas turns the extra field into an index and shifts the values: the raw path keeps them in place
+    data = b'a,b,c\n1,2,3,4\n'
+    assert raw_output(data, compile_plan({'RemoveColumn': 'column_name=a'})) == b'b,c\n2,3,4\n'
+
+
+def test_header_only_and_empty_objects():
+    plan = compile_plan({'RemoveColumn': 'column_name=b'})
+    assert raw_output(b'a,b\n', plan) == b'a\n'
+    assert raw_output(b'a,b', plan) == b'a'
+    assert raw_output(b'', plan) == b''
@@ -0,0 +1,59 @@
+import pytest
+import s3select
+from plan import compile_plan
+from s3select import prepare_select, select_object
+
+pytest.importorskip('awswrangler')
+URL = 'https://olap-111122223333.s3-object-lambda.us-east-1.amazonaws.com/'
+EVENT = {'configuration': {'supportingAccessPointArn': 'arn:aws:s3:us-east-1:111122223333:accesspoint/ap'}}
+
+
+class Probe:
+    def __init__(self, data: bytes, content_type: str):
+        self.data = data
+        self.status = 206
+        self.headers = {'Content-Type': content_type, 'Content-Range': f'bytes 0-{len(data) - 1}/{1 << 30}'}
+
+
+class Payload(list):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class S3:
+    def __init__(self, *records: bytes):
+        self.calls = []
+        self.payload = Payload([{'Records': {'Payload': record}} for record in records] + [{'End': {}}])
+
+    def select_object_content(self, **kwargs):
+        self.calls.append(kwargs)
+        return {'Payload': self.payload}
+
+
+def event(key: str) -> dict:
+    return dict(EVENT, userRequest={'url': URL + key})
+
+
+@pytest.fixture(autouse=True)
+def pushdown(monkeypatch):
+    monkeypatch.setattr(s3select, 'S3_SELECT_PUSHDOWN', True)
+
+
+def test_csv_is_queried_whole():
+    # A quoted field can contain a newline: the records can't be split by scan ranges
+    plan = compile_plan({'RemoveColumn': 'column_name=b'})
+    s3 = S3(b'1\n"x\n', b'y"\n')
+    output, headers = select_object(s3, Probe(b'a,b\n1,2\n"x\ny",3\n', 'text/csv'), event('a.csv'), plan)
+    assert b''.join(output) == b'a\n1\n"x\ny"\n'
+    assert headers == {'ContentType': 'text/csv'}
+    assert len(s3.calls) == 1 and 'ScanRange' not in s3.calls[0]
+    assert s3.calls[0]['InputSerialization']['CSV']['AllowQuotedRecordDelimiter'] is True
+    assert s3.payload.closed
+
+
+def test_json_lines_are_queried_by_scan_ranges():
+    plan = compile_plan({'FilterRows': 'column_name=a;value=x'})
+    query = prepare_select(Probe(b'{"a": "x"}\n', 'application/x-ndjson'), event('a.jsonl'), plan)
+    assert query.scan_ranges and 'JSON' in query.args['InputSerialization']
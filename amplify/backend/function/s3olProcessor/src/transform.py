@@ -0,0 +1,57 @@
+import pandas as pd
+from typing import Callable, Iterator, Optional, Tuple, Union
+from formats import CSV, IDENTITY, PARQUET, content_headers, detect_object, transform_stream
+from ol_metrics import current as current_metrics
+from parallel_csv import ParallelCsvTransform, read_header, use_parallel_csv
+from parquet import redact_parquet
+from plan import TransformPlan, check_columns
+from raw_csv import RAW_CSV, redact_csv
+from stages import concurrent_stage
+from streaming import RangedHttpFile, abort_response, iter_body
+
+
+def _checked_apply(plan: TransformPlan, data_format) -> Callable[[pd.DataFrame], pd.DataFrame]:
+    # plan.apply that checks the columns of the first chunk. The CSV parser doesn't load the excluded columns:
+    # only the other columns of the plan can be checked.
+    checked = []
+
+    def apply(df: pd.DataFrame) -> pd.DataFrame:
+        if not checked:
+            checked.append(True)
+            excluded = plan.excluded_columns if data_format is CSV else []
+            check_columns(plan, list(df.columns) + excluded)
+        return plan.apply(df)
+    return apply
+
+
+def transform_object(http, s3_url: str, response, key: str, plan: TransformPlan
+                     ) -> Tuple[Iterator[bytes], Optional[Union[RangedHttpFile, ParallelCsvTransform]], dict]:
+    # Transformed output of the object whose GET response (not preloaded) is given.
+    # Used by the Object Lambda requests and by the materialized views. The second value is the ranged source of
+    # the Parquet objects or the workers of the large CSV objects (None otherwise): close it once the output has
+    # been consumed. The third one is the ContentType and ContentEncoding of the output. The upstream reads, the
+    # transform and the response body (the consumer of the output) run in concurrent stages connected by bounded
+    # queues.
+    metrics = current_metrics()
+    chunks = metrics.timed(iter_body(response), 'Fetch')
+    codec, data_format, chunks = detect_object(chunks, key, response.headers)
+    metrics.set_property('Format', data_format.name)
+    metrics.set_property('Codec', codec.name)
+    headers = content_headers(codec, data_format, response.headers)
+    if data_format is PARQUET and codec is IDENTITY:
+        # Parquet needs random access: redact it row group by row group using ranged reads
+        response.close()
+        source = RangedHttpFile(http, s3_url, int(response.headers['Content-Length']))
+        return concurrent_stage(metrics.timed(redact_parquet(source, plan), 'Parquet'), 'Transform'), source, headers
+    if use_parallel_csv(codec, data_format, response.headers):
+        # Large CSV: byte ranges fetched and transformed by worker processes, only the header is read here
+        source = ParallelCsvTransform(http, s3_url, int(response.headers['Content-Length']), read_header(chunks), plan)
+        response.close()
+        return source.chunks(), source, headers
+    chunks = concurrent_stage(chunks, 'Read', abort=lambda: abort_response(response))
+    if data_format is CSV and RAW_CSV:
+        # Rewritten on the bytes, without the pandas round trip
+        output = metrics.timed(codec.compress(redact_csv(chunks, plan)), 'Compress')
+    else:
+        output = transform_stream(codec, data_format, chunks, _checked_apply(plan, data_format), plan.excluded_columns)
+    return concurrent_stage(output, 'Transform'), None, headers
@@ -0,0 +1,134 @@
+import hashlib
+import threading
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+# Size of the reads of the fake write_get_object_response (same order as the botocore upload chunks)
+UPLOAD_READ_SIZE = 1024 * 1024
+LAST_MODIFIED = formatdate(0, usegmt=True)
+
+
+class StoredObject:
+    def __init__(self, data: bytes, content_type: str, content_encoding: Optional[str] = None):
+        self.data = data
+        self.headers = {
+            'Content-Type': content_type,
+            'ETag': f'"{hashlib.md5(data).hexdigest()}"',
+            'Last-Modified': LAST_MODIFIED,
+            'Accept-Ranges': 'bytes',
+        }
+        if content_encoding:
+            self.headers['Content-Encoding'] = content_encoding
+
+
+def _byte_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    # "bytes=first-last", "bytes=first-" and "bytes=-suffix"
+    first, _, last = value.replace('bytes=', '', 1).partition('-')
+    if not first:
+        return max(size - int(last), 0), size - 1
+    return int(first), min(int(last), size - 1) if last else size - 1
+
+
+class ObjectServer:
+    # Local HTTP server standing in for the presigned inputS3Url of the events (GET with Range support)
+    def __init__(self):
+        self.objects: Dict[str, StoredObject] = {}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stored = server.objects.get(urlparse(self.path).path.lstrip('/'))
+                if stored is None:
+                    return self._send(404, b'<Error><Code>NoSuchKey</Code></Error>', {})
+                headers = dict(stored.headers)
+                if 'Range' not in self.headers:
+                    return self._send(200, stored.data, headers)
+                first, last = _byte_range(self.headers['Range'], len(stored.data))
+                if first > last:
+                    return self._send(416, b'<Error><Code>InvalidRange</Code></Error>', {})
+                headers['Content-Range'] = f'bytes {first}-{last}/{len(stored.data)}'
+                self._send(206, stored.data[first:last + 1], headers)
+
+            def _send(self, status: int, body: bytes, headers: dict):
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name='object-server', daemon=True)
+
+    def __enter__(self) -> 'ObjectServer':
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def put(self, key: str, stored: StoredObject):
+        self.objects[key] = stored
+
+    def url(self, key: str) -> str:
+        # Same shape as the presigned URL of the real events
+        host, port = self.httpd.server_address
+        return f'http://{host}:{port}/{key}?X-Amz-Signature=benchmark'
+
+
+class FakeS3Client:
+    # write_get_object_response reads the whole body like the real upload, so the lazy pipeline is fully run
+    def __init__(self):
+        self.responses = []
+
+    def write_get_object_response(self, RequestRoute: str, RequestToken: str, Body=None, **kwargs):
+        size = 0
+        if isinstance(Body, (bytes, bytearray)):
+            size = len(Body)
+        elif Body is not None:
+            while True:
+                data = Body.read(UPLOAD_READ_SIZE)
+                if not data:
+                    break
+                size += len(data)
+        self.responses.append({'StatusCode': kwargs.get('StatusCode', 200), 'BodySize': size})
+        return {}
+
+    def last(self) -> dict:
+        return self.responses[-1]
+
+
+class FakeTable:
+    # In-memory DynamoDB table with the operations used by ol_authorizer (paginated Scan, Query, GetItem)
+    def __init__(self, name: str, items: list, page_size: int = 100, generation: int = 1):
+        self.name = name
+        self.items = items
+        self.page_size = page_size
+        self.generation = generation
+
+    def _page(self, items: list, **kwargs) -> dict:
+        start = kwargs.get('ExclusiveStartKey', {}).get('offset', 0)
+        resp = {'Items': items[start:start + self.page_size]}
+        if start + self.page_size < len(items):
+            resp['LastEvaluatedKey'] = {'offset': start + self.page_size}
+        return resp
+
+    def scan(self, **kwargs) -> dict:
+        return self._page(self.items, **kwargs)
+
+    def query(self, KeyConditionExpression, **kwargs) -> dict:
+        # Only the equality condition of the attachment lookup: Key('access_point_arn').eq(target)
+        _, target = KeyConditionExpression.get_expression()['values']
+        return self._page([item for item in self.items if item.get('access_point_arn') == target], **kwargs)
+
+    def get_item(self, Key: dict, **kwargs) -> dict:
+        return {'Item': {'generation': self.generation}}
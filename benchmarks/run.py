@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# Benchmark of the s3olProcessor handler (authorizer included) with local stand-ins for AWS:
+#   - inputS3Url is served by a local HTTP server (fakes.ObjectServer)
+#   - the DynamoDB policy table and write_get_object_response are in-memory fakes
+# Every case runs in a fresh interpreter so the cold start, the caches and the peak RSS belong to that case only.
+#
+#   python benchmarks/run.py --output results.json
+#   python benchmarks/run.py --sizes 1,64 --transforms remove,hmac --formats csv,parquet --iterations 50
+#   python benchmarks/run.py --compare baseline.json --output results.json
+#   python benchmarks/run.py --memory gc --output gc.json && python benchmarks/run.py --compare gc.json
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+FUNCTIONS_DIR = os.path.join(os.path.dirname(BENCHMARKS_DIR), 'amplify', 'backend', 'function')
+PROCESSOR_SRC = os.path.join(FUNCTIONS_DIR, 's3olProcessor', 'src')
+# Layers of the processor, in the order of the function configuration (Lambda puts them before the runtime packages)
+LAYERS = [
+    os.path.join(FUNCTIONS_DIR, 'iamxS3olAuthorizer', 'lib', 'python'),
+    os.path.join(FUNCTIONS_DIR, 'iamxawswrangler', 'lib', 'python'),
+]
+# Environment of the handler. The audit pipeline is disabled: its sinks are measured separately.
+HANDLER_ENVIRONMENT = {
+    'ENV': 'benchmark',
+    'AWS_DEFAULT_REGION': 'us-east-2',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'LOG_LEVEL': 'WARNING',
+    'AUDIT_SINKS': '',
+    'ANONYMIZATION_KEY': 'benchmark-key',
+    'METRICS_SAMPLE_RATE': '1',
+}
+MB = 1024 * 1024
+# Generated objects are cached between runs (same parameters, same bytes)
+DATA_DIR = os.path.join(tempfile.gettempdir(), 's3ol-benchmarks')
+# Reported when they are loaded by a case (the deny and passthrough paths should not need them)
+HEAVY_MODULES = ('awswrangler', 'numpy', 'pandas', 'pyarrow')
+# Memory reclaim after every invocation: high-water (memory.release_memory, above MEMORY_HIGH_WATER_MB only) or
+# gc (a forced gc.collect() at the end of every invocation, as the handler did before the high-water mark)
+MEMORY_MODES = ('high-water', 'gc')
+# One factor at a time around the base case. The other parameters keep their base value.
+BASE_CASE = {'size_mb': 8, 'columns': 10, 'policies': 10, 'transform': 'remove', 'format': 'csv'}
+DEFAULT_SWEEP = {
+    'size_mb': [1, 8, 64],
+    'columns': [5, 10, 50],
+    'policies': [1, 10, 1000],
+    'transform': ['passthrough', 'deny', 'remove', 'mask', 'hmac', 'filter', 'mixed'],
+    'format': ['csv', 'csv.gz', 'jsonl', 'parquet'],
+}
+
+
+def percentile(values: list, p: float) -> float:
+    # Nearest rank: with fewer than 100 iterations p99 is the slowest one
+    ordered = sorted(values)
+    return ordered[max(int(-(-len(ordered) * p // 100)) - 1, 0)]
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (MB if sys.platform == 'darwin' else 1024), 1)
+
+
+def run_case(case: dict, iterations: int, warmup: int, layers: list, memory: str = 'high-water') -> dict:
+    # Runs in the case interpreter: imports the handler, then invokes it warmup + iterations times
+    os.environ.update(HANDLER_ENVIRONMENT)
+    if memory == 'gc':
+        # The high-water mark is disabled: the only reclaim is the forced collection
+        os.environ['MEMORY_HIGH_WATER_MB'] = '0'
+    # Every case starts with an empty result cache (when enabled with --result-cache)
+    os.environ['RESULT_CACHE_DIR'] = tempfile.mkdtemp(prefix='s3ol-result-cache-')
+    sys.path[:0] = [BENCHMARKS_DIR, PROCESSOR_SRC] + layers
+    import workloads
+    from fakes import FakeS3Client, FakeTable, ObjectServer
+
+    key, stored = workloads.load_object(object_path(case), case['format'])
+    policies = workloads.make_policies(case['policies'], case['transform'])
+    baseline_rss = peak_rss_mb()
+
+    started = time.perf_counter()
+    import index
+    import ol_authorizer
+    import ol_metrics
+    import_ms = (time.perf_counter() - started) * 1000
+
+    s3 = index.s3 = FakeS3Client()
+    ol_authorizer.table = FakeTable(ol_authorizer.table.name, policies)
+    sink = ol_metrics.MemorySink()
+    ol_metrics.set_sink(sink)
+
+    latencies = []
+    with ObjectServer() as server:
+        server.put(key, stored)
+        for i in range(warmup + iterations):
+            event = workloads.make_event(server.url(key), key)
+            started = time.perf_counter()
+            index.handler(event, None)
+            if memory == 'gc':
+                gc.collect()
+            latencies.append((time.perf_counter() - started) * 1000)
+    measured = latencies[warmup:]
+    documents = sink.documents[warmup:]
+    stages = sorted({name for document in documents for name in document if name.endswith('Time')})
+    mean_ms = sum(measured) / len(measured)
+    return {
+        'case': case,
+        'loaded_modules': [name for name in HEAVY_MODULES if name in sys.modules],
+        'object_bytes': len(stored.data),
+        'output_bytes': s3.last()['BodySize'],
+        'status_code': s3.last()['StatusCode'],
+        'iterations': len(measured),
+        'import_ms': round(import_ms, 3),
+        'first_invocation_ms': round(latencies[0], 3),
+        'latency_ms': {
+            'p50': round(percentile(measured, 50), 3),
+            'p99': round(percentile(measured, 99), 3),
+            'mean': round(mean_ms, 3),
+            'min': round(min(measured), 3),
+            'max': round(max(measured), 3),
+        },
+        'throughput_mb_s': round(len(stored.data) / MB / (mean_ms / 1000), 3),
+        'requests_per_s': round(1000 / mean_ms, 3),
+        'baseline_rss_mb': baseline_rss,
+        'peak_rss_mb': peak_rss_mb(),
+        # Mean exclusive time of each stage reported by ol_metrics
+        'stages_ms': {
+            name: round(sum(document.get(name, 0) for document in documents) / len(documents), 3) for name in stages
+        },
+    }
+
+
+def object_path(case: dict) -> str:
+    return os.path.join(DATA_DIR, f'{case["size_mb"]}mb-{case["columns"]}c.{case["format"]}')
+
+
+def prepare_object(case: dict):
+    # Objects are generated by the parent process so the generation doesn't count in the peak RSS of the case
+    import workloads
+    path = object_path(case)
+    if not os.path.exists(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        _, stored = workloads.make_object(case['format'], int(case['size_mb'] * MB), case['columns'])
+        with open(path + '.tmp', 'wb') as fp:
+            fp.write(stored.data)
+        os.replace(path + '.tmp', path)
+
+
+def _import_times(code: str, layers: list) -> list:
+    # (module, self us, cumulative us) in the order python -X importtime reports them (a module after its imports)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([PROCESSOR_SRC] + layers), **HANDLER_ENVIRONMENT)
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    modules = []
+    errors = []
+    for line in result.stderr.splitlines():
+        if line.startswith('import time:'):
+            if 'imported package' not in line:
+                self_us, cumulative_us, name = line[len('import time:'):].split('|')
+                modules.append((name.strip(), int(self_us), int(cumulative_us)))
+        else:
+            errors.append(line)
+    if result.returncode != 0:
+        # A failed import (eg: layer packages built for another Python version) would give a partial profile
+        raise RuntimeError('\n'.join(errors[-10:]) or f'Exit code {result.returncode}')
+    return modules
+
+
+def _by_package(modules: list, top: int) -> dict:
+    packages = {}
+    for name, self_us, _ in modules:
+        root = name.split('.')[0]
+        packages[root] = packages.get(root, 0) + self_us
+    ordered = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return {name: round(us / 1000, 3) for name, us in ordered}
+
+
+def import_profile(layers: list, top: int = 15) -> dict:
+    # Import time of the handler module (init phase of every cold start, clients included) and of the transform
+    # modules loaded by the first request that transforms an object, grouped by top level package
+    try:
+        modules = _import_times('import index; index.import_transform_modules()', layers)
+    except RuntimeError as e:
+        print(f'Unable to profile the imports:\n{e}', file=sys.stderr)
+        return {'error': str(e).splitlines()[-1]}
+    names = [name for name, _, _ in modules]
+    if 'index' not in names:
+        return {'error': 'Unable to import the handler'}
+    split = names.index('index') + 1
+    handler, transforms = modules[:split], modules[split:]
+    return {
+        'handler_ms': round(modules[split - 1][2] / 1000, 3),
+        'handler_packages_ms': _by_package(handler, top),
+        'transform_modules_ms': round(sum(self_us for _, self_us, _ in transforms) / 1000, 3),
+        'transform_packages_ms': _by_package(transforms, top),
+    }
+
+
+def sweep_cases(sweep: dict) -> list:
+    cases = []
+    for parameter, values in sweep.items():
+        for value in values:
+            case = dict(BASE_CASE, **{parameter: value})
+            if case not in cases:
+                cases.append(case)
+    return cases
+
+
+def spawn_case(case: dict, args) -> dict:
+    command = [
+        sys.executable, os.path.abspath(__file__), '--case', json.dumps(case),
+        '--iterations', str(args.iterations), '--warmup', str(args.warmup), '--layers', args.layers,
+        '--memory', args.memory
+    ]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if result.returncode != 0:
+        return {'case': case, 'error': result.stderr.strip().splitlines()[-1:]}
+    # The handler logs and the EMF documents are not written to stdout: the last line is the result
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BENCHMARKS_DIR, stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'commit': commit or None,
+    }
+
+
+def compare(baseline: dict, current: dict, max_regression: float) -> list:
+    # Cases of the current run whose p50 latency grew by more than max_regression percent
+    previous = {json.dumps(r['case'], sort_keys=True): r for r in baseline['results'] if 'error' not in r}
+    regressions = []
+    for result in current['results']:
+        before = previous.get(json.dumps(result['case'], sort_keys=True))
+        if before is None or 'error' in result:
+            continue
+        change = (result['latency_ms']['p50'] / before['latency_ms']['p50'] - 1) * 100
+        print(f'{json.dumps(result["case"])}: p50 {before["latency_ms"]["p50"]} -> {result["latency_ms"]["p50"]} ms '
+              f'({change:+.1f}%)', file=sys.stderr)
+        if change > max_regression:
+            regressions.append(result['case'])
+    return regressions
+
+
+def parse_list(value: str, cast) -> list:
+    return [cast(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of the s3olProcessor handler with local AWS stand-ins')
+    parser.add_argument('--sizes', help='Object sizes in MB (eg: 1,8,64)')
+    parser.add_argument('--columns', help='Column counts (eg: 5,10,50)')
+    parser.add_argument('--policies', help='Policy counts (eg: 1,10,1000)')
+    parser.add_argument('--transforms', help=f'Transform types: {",".join(DEFAULT_SWEEP["transform"])}')
+    parser.add_argument('--formats', help=f'Object formats: {",".join(DEFAULT_SWEEP["format"])}')
+    parser.add_argument('--grid', action='store_true', help='Run every combination instead of one factor at a time')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--layers', default=os.pathsep.join(LAYERS),
+                        help='Layer directories added to sys.path after the function code')
+    parser.add_argument('--result-cache', action='store_true',
+                        help='Enable the /tmp tier of the result cache (only the first invocation is a miss)')
+    parser.add_argument('--memory', choices=MEMORY_MODES, default='high-water',
+                        help='Memory reclaim after every invocation (gc: forced gc.collect(), the previous behavior)')
+    parser.add_argument('--output', help='JSON result file (default: stdout)')
+    parser.add_argument('--import-profile', action='store_true',
+                        help='Add the python -X importtime profile of the handler to the result')
+    parser.add_argument('--compare', help='Previous JSON result to compare the p50 latencies with')
+    parser.add_argument('--max-regression', type=float, default=10.0,
+                        help='p50 increase (percent) reported as a regression by --compare')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.result_cache:
+        os.environ['RESULT_CACHE'] = 'true'
+    if args.case:
+        result = run_case(json.loads(args.case), args.iterations, args.warmup, args.layers.split(os.pathsep),
+                          args.memory)
+        sys.stdout.write(json.dumps(result) + '\n')
+        return
+
+    sweep = {
+        'size_mb': parse_list(args.sizes, float) if args.sizes else None,
+        'columns': parse_list(args.columns, int) if args.columns else None,
+        'policies': parse_list(args.policies, int) if args.policies else None,
+        'transform': parse_list(args.transforms, str) if args.transforms else None,
+        'format': parse_list(args.formats, str) if args.formats else None,
+    }
+    if args.grid:
+        values = [sweep[name] or [BASE_CASE[name]] for name in BASE_CASE]
+        cases = [dict(zip(BASE_CASE, combination)) for combination in itertools.product(*values)]
+    else:
+        # Without any list every parameter uses the default sweep
+        selected = {name: values for name, values in sweep.items() if values}
+        cases = sweep_cases(selected or DEFAULT_SWEEP)
+
+    results = []
+    for case in cases:
+        print(f'Running {json.dumps(case)}', file=sys.stderr)
+        prepare_object(case)
+        results.append(spawn_case(case, args))
+    report = {
+        'environment': environment(),
+        'parameters': {
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'result_cache': args.result_cache,
+            'memory': args.memory,
+            'base_case': BASE_CASE
+        },
+        'results': results,
+    }
+    if args.import_profile:
+        report['import_profile'] = import_profile(args.layers.split(os.pathsep))
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(output + '\n')
+    else:
+        print(output)
+    if args.compare:
+        with open(args.compare) as fp:
+            regressions = compare(json.load(fp), report, args.max_regression)
+        if regressions:
+            print(f'{len(regressions)} cases regressed by more than {args.max_regression}%', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
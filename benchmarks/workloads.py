@@ -0,0 +1,131 @@
+import gzip
+import io
+import uuid
+from fakes import StoredObject
+
+ACCOUNT_ID = '111111111111'
+REGION = 'us-east-2'
+ACCESS_POINT = 's3-ol-benchmark'
+ACCESS_POINT_ARN = f'arn:aws:s3-object-lambda:{REGION}:{ACCOUNT_ID}:accesspoint/{ACCESS_POINT}'
+SUPPORTING_ACCESS_POINT_ARN = f'arn:aws:s3:{REGION}:{ACCOUNT_ID}:accesspoint/ap-benchmark'
+USER_ARN = f'arn:aws:iam::{ACCOUNT_ID}:user/benchmark'
+REGIONS = ['eu', 'us', 'ap', 'sa']
+# Condition block of the matching statement for each transform type.
+# c0 is a low cardinality region code, c1 an email-like string, c2 an integer and the other columns are strings.
+TRANSFORMS = {
+    'passthrough': None,
+    'deny': None,
+    'remove': {'RemoveColumn': 'column_name=c1'},
+    'null': {'RemoveData': 'column_name=c1'},
+    'mask': {'AnonymizeData': 'column_name=c1'},
+    'hash': {'HashData': 'column_name=c1'},
+    'hmac': {'AnonymizeData': 'column_name=c1;method=hmac'},
+    'partial': {'AnonymizeData': 'column_name=c1;method=partial;keep_last=4'},
+    'truncate': {'TruncateData': 'column_name=c1;length=4'},
+    'filter': {'FilterRows': 'column_name=c0;operator=eq;value=eu'},
+    'mixed': {
+        'RemoveColumn': 'column_name=c3',
+        'AnonymizeData': 'column_name=c1;method=hmac',
+        'FilterRows': 'column_name=c0;operator=in;value=eu,us',
+    },
+}
+FORMATS = {
+    'csv': ('dataset.csv', 'text/csv', None),
+    'csv.gz': ('dataset.csv.gz', 'text/csv', 'gzip'),
+    'jsonl': ('dataset.jsonl', 'application/x-ndjson', None),
+    'parquet': ('dataset.parquet', 'application/vnd.apache.parquet', None),
+}
+# Rows generated to estimate the CSV bytes per row
+SAMPLE_ROWS = 1000
+
+
+def make_frame(rows: int, columns: int, seed: int = 0):
+    # Deterministic synthetic dataset: the same parameters always produce the same bytes.
+    # pandas is only imported by the process generating the objects, the benchmarked process loads them as bytes.
+    import numpy as np
+    import pandas as pd
+    rng = np.random.default_rng(seed)
+    data = {
+        'c0': np.array(REGIONS)[rng.integers(0, len(REGIONS), rows)],
+        'c1': pd.Series(rng.integers(0, 10 ** 9, rows)).map(lambda n: f'user{n}@example.com').to_numpy(),
+        'c2': rng.integers(0, 10 ** 6, rows),
+    }
+    for i in range(3, columns):
+        data[f'c{i}'] = pd.Series(rng.integers(0, 10 ** 12, rows)).map(lambda n: f'{n:x}').to_numpy()
+    return pd.DataFrame(data).iloc[:, :max(columns, 1)]
+
+
+def rows_for_size(size_bytes: int, columns: int) -> int:
+    # Row count of a CSV object of about size_bytes (the other formats use the same rows)
+    sample = make_frame(SAMPLE_ROWS, columns).to_csv(index=False).encode()
+    return max(int(size_bytes / (len(sample) / SAMPLE_ROWS)), 1)
+
+
+def make_object(data_format: str, size_bytes: int, columns: int) -> (str, StoredObject):
+    key, content_type, content_encoding = FORMATS[data_format]
+    df = make_frame(rows_for_size(size_bytes, columns), columns)
+    if data_format == 'parquet':
+        buffer = io.BytesIO()
+        df.to_parquet(buffer, index=False, row_group_size=100000)
+        data = buffer.getvalue()
+    elif data_format == 'jsonl':
+        data = df.to_json(orient='records', lines=True).encode()
+    else:
+        data = df.to_csv(index=False).encode()
+        if content_encoding == 'gzip':
+            data = gzip.compress(data, compresslevel=6)
+    return key, StoredObject(data, content_type, content_encoding)
+
+
+def load_object(path: str, data_format: str) -> (str, StoredObject):
+    key, content_type, content_encoding = FORMATS[data_format]
+    with open(path, 'rb') as fp:
+        return key, StoredObject(fp.read(), content_type, content_encoding)
+
+
+def make_policies(count: int, transform: str) -> list:
+    # count policies: count - 1 statements on other access points and the statement matching the requests last,
+    # so the authorizer has to index all of them
+    items = []
+    for i in range(count - 1):
+        arn = f'arn:aws:s3-object-lambda:{REGION}:{ACCOUNT_ID}:accesspoint/other-{i}'
+        items.append(_policy(f'other-{i}', arn, 'Allow', {'RemoveColumn': 'column_name=c1'}))
+    effect = 'Deny' if transform == 'deny' else 'Allow'
+    items.append(_policy('benchmark', ACCESS_POINT_ARN, effect, TRANSFORMS[transform]))
+    # Attachment copies maintained by iamX for POLICY_LOOKUP=attachment (skipped by the scan lookup)
+    for item in list(items):
+        arn = item['policy_document']['Statement'][0]['Resource'][:-2]
+        items.append(dict(item, id=f'{item["id"]}#attachment#{arn}', policy_id=item['id'], access_point_arn=arn))
+    return items
+
+
+def _policy(name: str, access_point_arn: str, effect: str, condition) -> dict:
+    statement = {'Sid': name, 'Effect': effect, 'Principal': ACCOUNT_ID, 'Resource': f'{access_point_arn}/*'}
+    if condition:
+        statement['Condition'] = condition
+    return {
+        'id': str(uuid.uuid5(uuid.NAMESPACE_URL, name)),
+        'policy_name': name,
+        'policy_document': {'Version': '2012-10-17', 'Statement': [statement]},
+    }
+
+
+def make_event(input_url: str, key: str) -> dict:
+    host = f'{ACCESS_POINT}-{ACCOUNT_ID}.s3-object-lambda.{REGION}.amazonaws.com'
+    return {
+        'xAmzRequestId': str(uuid.uuid4()),
+        'getObjectContext': {'inputS3Url': input_url, 'outputRoute': 'io-benchmark', 'outputToken': 'token'},
+        'configuration': {
+            'accessPointArn': ACCESS_POINT_ARN,
+            'supportingAccessPointArn': SUPPORTING_ACCESS_POINT_ARN,
+            'payload': ''
+        },
+        'userRequest': {'url': f'https://{host}/{key}', 'headers': {'Host': host, 'Accept-Encoding': 'identity'}},
+        'userIdentity': {
+            'type': 'IAMUser',
+            'principalId': 'AIDABENCHMARK',
+            'arn': USER_ARN,
+            'accountId': ACCOUNT_ID,
+        },
+        'protocolVersion': '1.00'
+    }